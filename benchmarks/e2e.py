@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark and regression test of the vpnp CLI against a fake Docker daemon and
+stand-in privileged tools (see harness/), runs on a plain Linux box without Docker or sudo.
+
+    $ python3 benchmarks/e2e.py --json e2e.json
+    $ python3 benchmarks/e2e.py --baseline e2e.json --threshold 0.25
+
+Each scenario step is run as a separate `vpnp` process, timed, and the resulting route
+table is checked. Every call made to Docker and the tools is recorded with its latency.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import tempfile
+import threading
+import subprocess
+from argparse import ArgumentParser
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, os.path.join(HERE, 'harness'))
+
+from fakedocker import Server, State  # noqa: E402
+import shim  # noqa: E402
+from hotpaths import profile_content, compare  # noqa: E402
+
+# bench0 has a routed domain, two VPN endpoints and tuning, bench1 is on the default bridge, bench2 has two tunnels
+PROFILES = ('bench0', 'bench1', 'bench2')
+TUNNEL_MTU = 1380
+TUN_BYTES = (12345, 6789)
+TUNING = '''\
+    [[tuning]]
+        cpuset = 0-1
+        memory = 512m
+        txqueuelen = 2000
+        [[[sysctls]]]
+            net.ipv4.tcp_congestion_control = bbr
+        [[[ulimits]]]
+            nofile = 65536
+'''
+# More routes than fit in one pty read, whatever --subnets is, so that the route listings
+# that vpnp parses span several reads. Written to BATCH_FILE in the root for `add-route -f`
+BATCH = ['198.18.%d.0/24' % i for i in range(256)]
+BATCH_FILE = 'batch.txt'
+TUNING_EXPECTED = ['Tuning: cpuset\t0-1\n', 'Tuning: memory\t536870912\n', 'Tuning: txqueuelen\t2000\n',
+                   'Tuning: sysctl net.ipv4.tcp_congestion_control\tbbr\n', 'Tuning: ulimit nofile\t65536:65536\n']
+
+
+def scenario(subnets):
+    """
+    Steps as (name, argv, expected route count afterwards), the -vpnpd steps go via the daemon
+    """
+    all_subnets = subnets * len(PROFILES)
+    return [
+        ('start', ['start', PROFILES[0]], subnets),
+        ('info', ['info', PROFILES[0]], subnets),
+        ('status', ['status', PROFILES[0]], subnets),
+        ('health', ['health', PROFILES[0]], subnets),
+        ('metrics', ['metrics'], subnets),
+        ('status-vpnpd', ['status', PROFILES[0]], subnets),
+        ('info-vpnpd', ['info', PROFILES[0]], subnets),
+        ('add-route-vpnpd', ['add-route', PROFILES[0], '192.0.2.0/24'], subnets + 1),
+        ('del-route-vpnpd', ['del-route', PROFILES[0], '192.0.2.0/24'], subnets),
+        ('add-routes', ['add-route', '-f', BATCH_FILE, PROFILES[0]], subnets + len(BATCH)),
+        ('status-routes', ['status', PROFILES[0]], subnets + len(BATCH)),
+        ('del-routes', ['del-route', '-f', BATCH_FILE, PROFILES[0]], subnets),
+        ('which-vpnpd', ['which', '10.0.0.1'], subnets),
+        ('check-vpnpd', ['check'], subnets),
+        ('bench', ['bench', '--local', '--count', '3', '--size', '1000000', PROFILES[0]], subnets),
+        ('restart', ['restart', PROFILES[0]], subnets),
+        ('watch', ['watch', '--once', PROFILES[0]], 0),
+        ('stop', ['stop', PROFILES[0]], 0),
+        ('start-detach', ['start', '--detach', '--timeout', '10', PROFILES[0]], subnets),
+        ('restart-detach', ['restart', '--detach', '--timeout', '10', PROFILES[0]], subnets),
+        ('stop-detach', ['stop', PROFILES[0]], 0),
+        ('standby', ['standby', PROFILES[0]], 0),
+        ('start-standby', ['start', PROFILES[0]], subnets),
+        ('stop-standby', ['stop', PROFILES[0]], 0),
+        ('start-all', ['start', 'all'], all_subnets),
+        ('status-all', ['status', 'all'], all_subnets),
+        ('restart-bridge', ['restart', PROFILES[1]], all_subnets),
+        ('stop-all', ['stop', 'all'], 0),
+        ('start-ecmp', ['start', PROFILES[2]], subnets),
+        ('health-ecmp', ['health', PROFILES[2]], subnets),
+        ('restart-ecmp', ['restart', PROFILES[2]], subnets),
+        ('stop-ecmp', ['stop', PROFILES[2]], 0),
+    ]
+
+
+def prepare(name, state):
+    """
+    Fail the health hook of one bench2 tunnel for the health-ecmp step, and kill the bench0
+    container once "watch" follows the events for the watch step
+    """
+    state.unhealthy.clear()
+    if name == 'watch':
+        def kill():
+            deadline = time.time() + 10
+            while not state.subscribers and time.time() < deadline:
+                time.sleep(0.01)
+            running = [c['Id'] for c in state.containers.values()
+                       if c['State'] == 'running' and c['Image'].startswith('vpnp/%s_' % PROFILES[0])]
+            state.kill(running[0])
+        threading.Thread(target=kill, daemon=True).start()
+    if name == 'health-ecmp':
+        running = sorted(c['IP'] for c in state.containers.values()
+                         if c['State'] == 'running' and c['Image'].startswith('vpnp/%s_' % PROFILES[2]))
+        state.unhealthy.add(running[0])
+        return running[1:]
+    return None
+
+
+def metrics_expected():
+    """
+    Lines expected in the metrics output with only the first profile started and healthy
+    """
+    return ['vpnp_up{profile="%s"} 1' % PROFILES[0], 'vpnp_up{profile="%s"} 0' % PROFILES[1],
+            'vpnp_health_exit_code{profile="%s"} 0' % PROFILES[0],
+            'interface="tun0",ip=', '} %d\n' % TUN_BYTES[0], '} %d\n' % TUN_BYTES[1]]
+
+
+def mtus(harness):
+    """
+    The set of route MTUs in the harness route table
+    """
+    with open(os.path.join(harness, 'routes.json'), 'rt') as fh:
+        routes = json.load(fh)['routes']
+    return set(r['attrs'][r['attrs'].index('mtu') + 1] if 'mtu' in r['attrs'] else None for r in routes)
+
+
+def nexthops(harness):
+    """
+    The set of nexthop lists of the routes in the harness route table
+    """
+    with open(os.path.join(harness, 'routes.json'), 'rt') as fh:
+        return set(tuple(sorted(r['via'])) for r in json.load(fh)['routes'])
+
+
+def setup(root, subnets, tables=False, endpoints=()):
+    home = os.path.join(root, 'home')
+    profiles = os.path.join(home, '.config', 'vpn-porthole', 'profiles')
+    os.makedirs(profiles)
+    with open(os.path.join(root, BATCH_FILE), 'wt') as fh:
+        fh.write(''.join('%s\n' % subnet for subnet in BATCH))
+    with open(os.path.join(home, '.config', 'vpn-porthole', 'settings.conf'), 'wt') as fh:
+        fh.write('[system]\n    sudo = harness\n[network]\n    name = vpnp\n')
+        if tables:
+            fh.write('[routing]\n    tables = True\n')
+    for i, name in enumerate(PROFILES):
+        content = profile_content(subnets).replace('\n    10.', '\n    %d.' % (10 + i))
+        if i == 2:
+            content = content.replace('password = bench\n', 'password = bench\ntunnels = 2\n')
+        if i == 0:
+            content = content.replace('[domains]\n', '[routed_domains]\n    svc.example.org = True\n[domains]\n')
+            content = content.replace('vpn = vpn.example.com\n', 'vpn = %s\n' % ', '.join(endpoints))
+            content = content.replace('[subnets]\n', '[endpoints]\n    probe = tcp\n[subnets]\n')
+            content = content.replace('    [[options]]\n    [[hooks]]', '    [[options]]\n%s    [[hooks]]' % TUNING)
+        if i == 1:
+            # On the default bridge, without a static IP
+            content = content.replace('    [[options]]\n    [[hooks]]',
+                                      '    [[options]]\n        net = --network bridge\n    [[hooks]]')
+        with open(os.path.join(profiles, '%s.conf' % name), 'wt') as fh:
+            fh.write(content)
+
+    harness = os.path.join(root, 'harness')
+    os.makedirs(harness)
+    bin_dir = os.path.join(root, 'bin')
+    shim.install(bin_dir)
+
+    env = dict(os.environ)
+    env.update({
+        'HOME': home,
+        'XDG_CACHE_HOME': os.path.join(home, '.cache'),
+        'PATH': bin_dir + os.pathsep + env.get('PATH', ''),
+        'DOCKER_HOST': 'unix://%s' % os.path.join(root, 'docker.sock'),
+        'VPNP_HARNESS_DIR': harness,
+        'VPNP_HARNESS_SUDO_PASSWORD': 'harness',
+        'PYTHONPATH': ROOT,
+    })
+    return env, harness
+
+
+def endpoints():
+    """
+    A closed and a listening local endpoint for the endpoint probe, and the listening socket
+    """
+    closed = socket.socket()
+    closed.bind(('127.0.0.1', 0))
+    listening = socket.socket()
+    listening.bind(('127.0.0.1', 0))
+    listening.listen(16)
+    ports = (closed.getsockname()[1], listening.getsockname()[1])
+    closed.close()
+    return ['127.0.0.1:%d' % port for port in ports], listening
+
+
+def main_routes(harness):
+    """
+    The routes in the main table of the harness route table
+    """
+    with open(os.path.join(harness, 'routes.json'), 'rt') as fh:
+        return [r['dst'] for r in json.load(fh)['routes'] if r['table'] == 'main']
+
+
+def leftovers(harness):
+    """
+    The ip rules, ipsets and iptables rules left in the harness route table
+    """
+    with open(os.path.join(harness, 'routes.json'), 'rt') as fh:
+        state = json.load(fh)
+    return state['rules'] + sorted(state.get('sets', {})) + state.get('iptables', [])
+
+
+def route_count(harness):
+    try:
+        with open(os.path.join(harness, 'routes.json'), 'rt') as fh:
+            return len([r for r in json.load(fh)['routes'] if r['dst'] != 'default'])
+    except FileNotFoundError:
+        return 0
+
+
+def call_stats(harness):
+    stats = {}
+    try:
+        with open(os.path.join(harness, 'calls.jsonl'), 'rt') as fh:
+            for line in fh:
+                call = json.loads(line)
+                stat = stats.setdefault(call['tool'], {'count': 0, 'seconds': 0.0})
+                stat['count'] += 1
+                stat['seconds'] += call['seconds']
+    except FileNotFoundError:
+        pass
+    return stats
+
+
+def main():
+    parser = ArgumentParser(description='vpn-porthole end-to-end benchmark with a fake Docker daemon')
+    parser.add_argument('--json', default=None, help='Write results to this JSON file')
+    parser.add_argument('--baseline', default=None, help='Compare against results in this JSON file')
+    parser.add_argument('--threshold', default=0.25, type=float,
+                        help='Allowed slowdown relative to the baseline (default: 0.25)')
+    parser.add_argument('--repeat', default=3, type=int, help='Repeats of the scenario (default: 3)')
+    parser.add_argument('--subnets', default=200, type=int,
+                        help='Subnets per benchmark profile (default: 200)')
+    parser.add_argument('--tables', default=False, action='store_true',
+                        help='Run with a routing table per profile ([routing] tables)')
+    parser.add_argument('--verbose', default=False, action='store_true', help='Show vpnp output')
+    args = parser.parse_args()
+
+    timings = {}
+    failures = 0
+    with tempfile.TemporaryDirectory(prefix='vpnp-e2e-') as root:
+        vpn_endpoints, listening = endpoints()
+        env, harness = setup(root, args.subnets, args.tables, vpn_endpoints)
+        # The container interfaces (sit0 is not a tunnel) for the detached start and path MTU
+        # discovery, the tun byte counters and the tuning
+        state = State(os.path.join(harness, 'calls.jsonl'),
+                      hook_output={'ls /sys/class/net': 'lo\neth0\nsit0\ntun0\n',
+                                   '/mtu': 'lo 65536\neth0 1500\nsit0 1280\ntun0 %d\n' % TUNNEL_MTU,
+                                   '/rx_bytes': 'lo 0 0\neth0 900 800\nsit0 0 0\ntun0 %d %d\n' % TUN_BYTES,
+                                   'tx_queue_len': 'txqueuelen tun0 2000\n'
+                                                   'sysctl net.ipv4.tcp_congestion_control bbr\n'})
+        server = Server(os.path.join(root, 'docker.sock'), state)
+        server.start()
+        vpnpd = subprocess.Popen([sys.executable, '-m', 'vpnporthole.daemon'], env=env, stdin=subprocess.DEVNULL,
+                                 stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=root)
+        vpnpd_socket = os.path.join(env['XDG_CACHE_HOME'], 'vpn-porthole', 'vpnpd', 'vpnpd.sock')
+        while not os.path.exists(vpnpd_socket) and vpnpd.poll() is None:
+            time.sleep(0.01)
+
+        for _ in range(args.repeat):
+            for name, argv, expected_routes in scenario(args.subnets):
+                expected_nexthops = prepare(name, state)
+                start = time.perf_counter()
+                module = 'vpnporthole.client' if name.endswith('-vpnpd') else 'vpnporthole.cli'
+                p = subprocess.run([sys.executable, '-m', module] + argv, env=env,
+                                   stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT, cwd=root)
+                seconds = time.perf_counter() - start
+                timings.setdefault(name, []).append(seconds)
+
+                routes = route_count(harness)
+                ok = routes == expected_routes
+                if not ok:
+                    sys.stdout.write('FAIL %s: %d routes, expected %d\n' % (name, routes, expected_routes))
+                elif args.tables and main_routes(harness):
+                    ok = False
+                    sys.stdout.write('FAIL %s: routes in the main table %s\n' % (name, main_routes(harness)))
+                elif not routes and leftovers(harness):
+                    ok = False
+                    sys.stdout.write('FAIL %s: left %s\n' % (name, leftovers(harness)))
+                elif name == 'start' and len(leftovers(harness)) != (5 if args.tables else 4):
+                    ok = False
+                    sys.stdout.write('FAIL %s: expected the routed domain rules, got %s\n' % (name, leftovers(harness)))
+                elif routes and mtus(harness) != {str(TUNNEL_MTU)}:
+                    ok = False
+                    sys.stdout.write('FAIL %s: route MTUs %s, expected %d\n' % (name, mtus(harness), TUNNEL_MTU))
+                elif name in ('start', 'info') and 'Endpoint: %s' % vpn_endpoints[1] not in p.stdout.decode('utf-8'):
+                    ok = False
+                    sys.stdout.write('FAIL %s: expected the endpoint %s\n' % (name, vpn_endpoints[1]))
+                elif name.startswith('start') and ', not ' in p.stdout.decode('utf-8'):
+                    ok = False
+                    sys.stdout.write('FAIL %s: tuning did not take\n' % name)
+                elif name == 'info' and not all(t in p.stdout.decode('utf-8') for t in TUNING_EXPECTED):
+                    ok = False
+                    sys.stdout.write('FAIL %s: expected %s\n' % (name, TUNING_EXPECTED))
+                elif name == 'which-vpnpd' and '\n10.0.0.1 %s ' % PROFILES[0] not in '\n' + p.stdout.decode('utf-8'):
+                    ok = False
+                    sys.stdout.write('FAIL %s: expected 10.0.0.1 via %s\n' % (name, PROFILES[0]))
+                elif name == 'metrics' and not all(m in p.stdout.decode('utf-8') for m in metrics_expected()):
+                    ok = False
+                    sys.stdout.write('FAIL %s: expected %s\n' % (name, metrics_expected()))
+                elif name.endswith('-ecmp') and routes:
+                    expected_nexthops = expected_nexthops or sorted(
+                        c['IP'] for c in state.containers.values()
+                        if c['State'] == 'running' and c['Image'].startswith('vpnp/%s_' % PROFILES[2]))
+                    ok = nexthops(harness) == {tuple(expected_nexthops)}
+                    if not ok:
+                        sys.stdout.write('FAIL %s: nexthops %s, expected %s\n' % (
+                            name, sorted(nexthops(harness)), expected_nexthops))
+                if not ok:
+                    failures += 1
+                if args.verbose or not ok:
+                    sys.stdout.write('== %s\n' % name)
+                    sys.stdout.write(p.stdout.decode('utf-8', 'replace'))
+        vpnpd.terminate()
+        vpnpd.wait()
+        server.shutdown()
+        listening.close()
+        calls = call_stats(harness)
+
+    results = {name: {'seconds': min(values), 'number': len(values)} for name, values in timings.items()}
+    for name, _, _ in scenario(args.subnets):
+        sys.stdout.write('%-14s %10.1f ms\n' % (name, results[name]['seconds'] * 1e3))
+    for tool, stat in sorted(calls.items()):
+        sys.stdout.write('%-14s %6d calls %10.1f ms\n' % (tool, stat['count'], stat['seconds'] * 1e3))
+
+    if args.json:
+        with open(args.json, 'wt') as fh:
+            json.dump({'subnets': args.subnets, 'benchmarks': results, 'calls': calls},
+                      fh, indent=2, sort_keys=True)
+
+    exitcode = 1 if failures else 0
+    if args.baseline:
+        exitcode = compare(results, args.baseline, args.threshold) or exitcode
+    return exitcode
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,465 @@
+"""
+A fake Docker Engine API served on a Unix socket, implementing the subset of endpoints
+that vpn-porthole uses. Every request is recorded with its latency.
+"""
+import os
+import re
+import json
+import time
+import uuid
+import struct
+import threading
+import subprocess
+import socketserver
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+class State(object):
+    def __init__(self, log_file, hook_output=None):
+        self.lock = threading.Lock()
+        self.log_file = log_file
+        self.images = {}
+        self.containers = {}
+        self.execs = {}
+        self.networks = {}
+        self.unhealthy = set()  # container IPs whose health hook fails
+        self.next_ip = 2
+        self.hook_output = hook_output or {}
+        self.events = []
+        self.subscribers = 0  # open /events streams
+        self.changed = threading.Condition(self.lock)
+
+    def record(self, **kwargs):
+        with self.lock:
+            with open(self.log_file, 'at') as fh:
+                fh.write(json.dumps(kwargs) + '\n')
+
+    def add_image(self, tag):
+        if ':' not in tag:
+            tag += ':latest'
+        image_id = 'sha256:' + uuid.uuid4().hex * 2
+        with self.lock:
+            self.images[image_id] = {'Id': image_id, 'RepoTags': [tag], 'Size': 123 * 1024 * 1024}
+        return image_id
+
+    def add_container(self, image, state='running', name=None, network='bridge', ip=None, **extra):
+        container_id = uuid.uuid4().hex * 2
+        with self.lock:
+            if not ip:
+                prefix = '172.17.0' if network == 'bridge' else '172.30.200'
+                ip = '%s.%d' % (prefix, self.next_ip)
+                self.next_ip += 1
+            in_use = [c for c in self.containers.values()
+                      if c['State'] == 'running' and c['IP'] == ip and c['Network'] == network]
+            if in_use:
+                raise ValueError('Address already in use: %s' % ip)
+            self.containers[container_id] = {
+                'Id': container_id,
+                'Image': image,
+                'State': state,
+                'Names': ['/%s' % (name or container_id[:12])],
+                'Network': network,
+                'IP': ip,
+                'Started': time.time(),
+                'Extra': extra,
+            }
+        self.emit(self.containers[container_id], 'start')
+        return container_id, ip
+
+    def emit(self, container, action, **attributes):
+        """
+        Add a container event to the /events stream
+        """
+        now = time.time()
+        attributes.update({'image': container['Image'], 'name': container['Names'][0][1:]})
+        with self.changed:
+            self.events.append({'status': action, 'id': container['Id'], 'from': container['Image'],
+                                'Type': 'container', 'Action': action,
+                                'Actor': {'ID': container['Id'], 'Attributes': attributes},
+                                'time': int(now), 'timeNano': int(now * 1e9)})
+            self.changed.notify_all()
+
+    def kill(self, container_id, exit_code=1):
+        """
+        The container exits by itself, e.g. the VPN client failed
+        """
+        container = self.containers[container_id]
+        container['State'] = 'exited'
+        self.emit(container, 'die', exitCode=str(exit_code))
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, state):
+        self.state = state
+        if os.path.exists(path):
+            os.unlink(path)
+        socketserver.UnixStreamServer.__init__(self, path, Handler)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    __version = re.compile(r'^/v[0-9.]+')
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def address_string(self):
+        return 'unix'
+
+    def do_GET(self):
+        self.__dispatch('GET')
+
+    def do_POST(self):
+        self.__dispatch('POST')
+
+    def do_DELETE(self):
+        self.__dispatch('DELETE')
+
+    def __dispatch(self, method):
+        start = time.perf_counter()
+        url = urlparse(self.path)
+        path = self.__version.sub('', url.path)
+        query = parse_qs(url.query)
+        body = self.__read_body()
+        self.close_connection = True
+        status = 404
+        try:
+            for pattern, route_method, handler in ROUTES:
+                m = re.match(pattern + '$', path)
+                if m and route_method == method:
+                    status = handler(self, query, body, *m.groups())
+                    break
+            else:
+                self.__json(404, {'message': 'not found: %s %s' % (method, path)})
+        finally:
+            self.state.record(tool='docker-api', method=method, path=path, status=status,
+                              seconds=time.perf_counter() - start)
+
+    def __read_body(self):
+        if 'Content-Length' in self.headers:
+            return self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().strip().split(b';')[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            return b''.join(chunks)
+        return b''
+
+    def __json(self, status, obj):
+        data = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(data)
+        return status
+
+    def __empty(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        return status
+
+    def __chunked(self, chunks):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        for chunk in chunks:
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+        self.wfile.write(b'0\r\n\r\n')
+        return 200
+
+    def __raw_stream(self, frames):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/vnd.docker.raw-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.flush()
+        # docker-py reads the frames from the raw socket, so keep them out of the header read
+        time.sleep(0.02)
+        for frame in frames:
+            self.wfile.write(struct.pack('>BxxxL', 1, len(frame)) + frame)
+        return 200
+
+    def __container(self, container_id):
+        container = self.state.containers.get(container_id)
+        if container:
+            return container
+        for container in self.state.containers.values():
+            if container_id in container['Names'] or container['Names'][0] == '/' + container_id:
+                return container
+        return None
+
+    # Handlers
+
+    def ping(self, query, body):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(b'OK')
+        return 200
+
+    def version(self, query, body):
+        return self.__json(200, {'Version': '1.12.6', 'ApiVersion': '1.24', 'Os': 'linux'})
+
+    def images(self, query, body):
+        return self.__json(200, list(self.state.images.values()))
+
+    def build(self, query, body):
+        tag = query.get('t', ['none'])[0]
+        image_id = self.state.add_image(tag)
+        return self.__chunked([
+            json.dumps({'stream': 'Step 1/1 : FROM debian\n'}).encode('utf-8'),
+            json.dumps({'stream': 'Successfully built %s\n' % image_id[7:19]}).encode('utf-8'),
+        ])
+
+    def remove_image(self, query, body, name):
+        with self.state.lock:
+            for image_id, image in list(self.state.images.items()):
+                if image_id == name or name in image['RepoTags'] or name + ':latest' in image['RepoTags']:
+                    del self.state.images[image_id]
+        return self.__empty(200)
+
+    def containers(self, query, body):
+        show_all = query.get('all', ['0'])[0] in ('1', 'True', 'true')
+        return self.__json(200, [{k: c[k] for k in ('Id', 'Image', 'State', 'Names')}
+                                 for c in self.state.containers.values()
+                                 if show_all or c['State'] == 'running'])
+
+    def inspect(self, query, body, container_id):
+        c = self.__container(container_id)
+        if not c:
+            return self.__json(404, {'message': 'No such container: %s' % container_id})
+        running = c['State'] == 'running'
+        ip = c['IP'] if running else ''
+        # The host as seen from the fake containers, see exec_start()
+        gateway = '127.0.0.1' if running else ''
+        return self.__json(200, {
+            'Id': c['Id'],
+            'Name': c['Names'][0],
+            'Image': c['Image'],
+            'State': {'Status': c['State'], 'Running': running,
+                      'StartedAt': time.strftime('%Y-%m-%dT%H:%M:%S.000000000Z',
+                                                 time.gmtime(c['Started']))},
+            'Config': {'Image': c['Image'], 'Tty': True, 'Labels': c['Extra'].get('Labels', {})},
+            'HostConfig': c['Extra'].get('HostConfig', {}),
+            'NetworkSettings': {'IPAddress': ip if c['Network'] == 'bridge' else '',
+                                'Gateway': gateway if c['Network'] == 'bridge' else '',
+                                'Networks': {c['Network']: {'IPAddress': ip, 'Gateway': gateway}}
+                                if c['Network'] else {}},
+        })
+
+    def stop(self, query, body, container_id):
+        c = self.__container(container_id)
+        if not c:
+            return self.__json(404, {'message': 'No such container: %s' % container_id})
+        if c['State'] == 'running':
+            c['State'] = 'exited'
+            self.state.emit(c, 'die', exitCode='0')
+        return self.__empty(204)
+
+    def remove(self, query, body, container_id):
+        c = self.__container(container_id)
+        if not c:
+            return self.__json(404, {'message': 'No such container: %s' % container_id})
+        with self.state.lock:
+            del self.state.containers[c['Id']]
+        return self.__empty(204)
+
+    def logs(self, query, body, container_id):
+        c = self.__container(container_id)
+        if not c:
+            return self.__json(404, {'message': 'No such container: %s' % container_id})
+        lines = ['Connected as 10.99.0.1, using SSL\n', 'Established DTLS connection\n']
+        tail = query.get('tail', ['all'])[0]
+        if tail != 'all':
+            lines = lines[-int(tail):] if int(tail) else []
+        return self.__chunked([line.encode('utf-8') for line in lines])
+
+    def rename(self, query, body, container_id):
+        c = self.__container(container_id)
+        if not c:
+            return self.__json(404, {'message': 'No such container: %s' % container_id})
+        c['Names'] = ['/%s' % query['name'][0]]
+        return self.__empty(204)
+
+    def exec_create(self, query, body, container_id):
+        c = self.__container(container_id)
+        if not c:
+            return self.__json(404, {'message': 'No such container: %s' % container_id})
+        exec_id = uuid.uuid4().hex
+        with self.state.lock:
+            req = json.loads(body.decode('utf-8'))
+            self.state.execs[exec_id] = {'Container': c['Id'], 'Cmd': req['Cmd'], 'User': req.get('User') or '',
+                                         'Running': False, 'ExitCode': 0}
+        return self.__json(201, {'Id': exec_id})
+
+    def exec_start(self, query, body, exec_id):
+        exe = self.state.execs.get(exec_id)
+        if not exe:
+            return self.__json(404, {'message': 'No such exec instance: %s' % exec_id})
+        cmd = exe['Cmd']
+        if json.loads(body.decode('utf-8') or '{}').get('Detach'):
+            # A detached start hook keeps running, like openconnect
+            exe['Running'] = '/vpnp/start' in ' '.join(cmd)
+            return self.__empty(200)
+        if cmd[0] in ('bash', '/bin/bash'):
+            # The fake containers share the host network, so run e.g. `vpnp bench` probes locally
+            p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            exe['ExitCode'] = p.returncode
+            return self.__raw_stream([p.stdout] if p.stdout else [])
+        if cmd[0] != '/vpnp/exec':
+            # Canned output for other commands, matched on a part of the command line
+            command = ' '.join(cmd)
+            output = next((v for k, v in self.state.hook_output.items() if k in command), '')
+            if '> $i/tx_queue_len' in command and exe['User'] != 'root':
+                # Only root may write to /sys, not the USER of the image
+                output = re.sub(r'^txqueuelen (\S+) \d+$', r'error \1 Permission denied\ntxqueuelen \1 1000',
+                                output, flags=re.MULTILINE)
+            return self.__raw_stream([output.encode('utf-8')] if output else [])
+        cmd = cmd[1:]
+        prefix = os.path.basename(cmd[0])
+        output = self.state.hook_output.get(' '.join(cmd), '')
+        frames = [(' [%s] %s\n' % (prefix, line)).encode('utf-8') for line in output.splitlines()]
+        container = self.state.containers.get(exe['Container']) or {}
+        failed = cmd[0] == '/vpnp/health' and container.get('IP') in self.state.unhealthy
+        frames.append(b'/vpnp/exec:EXITCODE=%d\n' % (1 if failed else 0))
+        return self.__raw_stream(frames)
+
+    def exec_inspect(self, query, body, exec_id):
+        exe = self.state.execs.get(exec_id)
+        if not exe:
+            return self.__json(404, {'message': 'No such exec instance: %s' % exec_id})
+        return self.__json(200, {'ID': exec_id, 'Running': exe['Running'], 'ExitCode': exe['ExitCode']})
+
+    def events(self, query, body):
+        filters = json.loads(query.get('filters', ['{}'])[0])
+        since = query.get('since', [None])[0]
+
+        def match(event):
+            fields = {'type': [event['Type']], 'event': [event['Action']],
+                      'image': [event['from'], event['from'].split(':')[0]],
+                      'container': [event['id'], event['Actor']['Attributes']['name']]}
+            return all(set(values) & set(fields.get(key, values)) for key, values in filters.items())
+
+        with self.state.lock:
+            index = len(self.state.events)
+            if since is not None:
+                index = len([e for e in self.state.events if e['time'] < int(since)])
+            self.state.subscribers += 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.flush()
+        # Stream until the client hangs up
+        try:
+            while True:
+                with self.state.changed:
+                    self.state.changed.wait_for(lambda: len(self.state.events) > index, timeout=0.5)
+                    events = self.state.events[index:]
+                index += len(events)
+                for event in events:
+                    if match(event):
+                        chunk = json.dumps(event).encode('utf-8')
+                        self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            with self.state.lock:
+                self.state.subscribers -= 1
+        return 200
+
+    def networks(self, query, body):
+        filters = json.loads(query.get('filters', ['{}'])[0])
+        names = filters.get('name') or filters.get('names')
+        return self.__json(200, [n for n in self.state.networks.values()
+                                 if not names or any(name in n['Name'] for name in names)])
+
+    def create_network(self, query, body):
+        req = json.loads(body.decode('utf-8'))
+        if any(n['Name'] == req['Name'] for n in self.state.networks.values()):
+            return self.__json(409, {'message': 'network with name %s already exists' % req['Name']})
+        network_id = uuid.uuid4().hex * 2
+        with self.state.lock:
+            self.state.networks[network_id] = {'Id': network_id, 'Name': req['Name'],
+                                               'Driver': req.get('Driver'), 'IPAM': req.get('IPAM')}
+        return self.__json(201, {'Id': network_id, 'Warning': ''})
+
+    def connect_network(self, query, body, network):
+        req = json.loads(body.decode('utf-8'))
+        c = self.__container(req['Container'])
+        if not c:
+            return self.__json(404, {'message': 'No such container: %s' % req['Container']})
+        config = req.get('EndpointConfig') or {}
+        c['Network'] = network
+        c['IP'] = (config.get('IPAMConfig') or {}).get('IPv4Address') or c['IP']
+        return self.__empty(200)
+
+    def disconnect_network(self, query, body, network):
+        req = json.loads(body.decode('utf-8'))
+        c = self.__container(req['Container'])
+        if not c:
+            return self.__json(404, {'message': 'No such container: %s' % req['Container']})
+        c['Network'] = None
+        return self.__empty(200)
+
+    def harness_add_container(self, query, body):
+        req = json.loads(body.decode('utf-8'))
+        try:
+            container_id, ip = self.state.add_container(req['Image'], name=req.get('Name'),
+                                                        network=req.get('Network') or 'bridge',
+                                                        ip=req.get('IP'),
+                                                        HostConfig=req.get('HostConfig') or {},
+                                                        Labels=req.get('Labels') or {})
+        except ValueError as e:
+            return self.__json(409, {'message': str(e)})
+        return self.__json(201, {'Id': container_id, 'IP': ip})
+
+
+ROUTES = [
+    (r'/_ping', 'GET', Handler.ping),
+    (r'/version', 'GET', Handler.version),
+    (r'/images/json', 'GET', Handler.images),
+    (r'/build', 'POST', Handler.build),
+    (r'/images/([^/]+(?:/[^/]+)?)', 'DELETE', Handler.remove_image),
+    (r'/containers/json', 'GET', Handler.containers),
+    (r'/containers/([^/]+)/json', 'GET', Handler.inspect),
+    (r'/containers/([^/]+)/stop', 'POST', Handler.stop),
+    (r'/containers/([^/]+)', 'DELETE', Handler.remove),
+    (r'/containers/([^/]+)/logs', 'GET', Handler.logs),
+    (r'/containers/([^/]+)/rename', 'POST', Handler.rename),
+    (r'/containers/([^/]+)/exec', 'POST', Handler.exec_create),
+    (r'/exec/([^/]+)/start', 'POST', Handler.exec_start),
+    (r'/exec/([^/]+)/json', 'GET', Handler.exec_inspect),
+    (r'/events', 'GET', Handler.events),
+    (r'/networks', 'GET', Handler.networks),
+    (r'/networks/create', 'POST', Handler.create_network),
+    (r'/networks/([^/]+)/connect', 'POST', Handler.connect_network),
+    (r'/networks/([^/]+)/disconnect', 'POST', Handler.disconnect_network),
+    (r'/_harness/containers', 'POST', Handler.harness_add_container),
+]
@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+"""
+Stand-ins for the privileged and external tools that vpn-porthole calls: sudo, ip, iptables,
+ipset, route, docker-machine and docker. The tool is chosen by the name this script is invoked as
+(see install()). Every call is recorded to $VPNP_HARNESS_DIR/calls.jsonl with its latency.
+
+The docker stand-in simulates the openconnect prompts for `docker run ... /vpnp/start` and
+registers the "container" with the fake Docker daemon on $DOCKER_HOST.
+"""
+import os
+import sys
+import json
+import time
+import fcntl
+import shlex
+import signal
+import socket
+import subprocess
+from http.client import HTTPConnection
+
+TOOLS = ('sudo', 'ip', 'route', 'docker-machine', 'docker', 'iptables', 'ipset')
+HARNESS_DIR = os.environ.get('VPNP_HARNESS_DIR', '.')
+
+
+def install(bin_dir):
+    """
+    Create a symlink per tool in bin_dir, to be put first on the PATH
+    """
+    os.makedirs(bin_dir, exist_ok=True)
+    for tool in TOOLS:
+        link = os.path.join(bin_dir, tool)
+        if not os.path.lexists(link):
+            os.symlink(os.path.abspath(__file__), link)
+    os.chmod(os.path.abspath(__file__), 0o755)
+
+
+def record(tool, argv, start, exitcode):
+    with open(os.path.join(HARNESS_DIR, 'calls.jsonl'), 'at') as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        fh.write(json.dumps({'tool': tool, 'argv': argv, 'exitcode': exitcode,
+                             'seconds': time.perf_counter() - start}) + '\n')
+
+
+class UnixHTTPConnection(HTTPConnection):
+    def __init__(self, path):
+        HTTPConnection.__init__(self, 'localhost')
+        self.__path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.__path)
+
+
+def docker_api(method, path, obj=None):
+    conn = UnixHTTPConnection(os.environ['DOCKER_HOST'][len('unix://'):])
+    body = json.dumps(obj) if obj is not None else None
+    conn.request(method, path, body=body, headers={'Content-Type': 'application/json'})
+    res = conn.getresponse()
+    data = res.read()
+    obj = json.loads(data.decode('utf-8')) if data else None
+    if res.status >= 400:
+        raise RuntimeError(obj['message'] if obj else res.reason)
+    return obj
+
+
+def option(args, name, default=None):
+    return args[args.index(name) + 1] if name in args else default
+
+
+def host_config(args):
+    """
+    The HostConfig that Docker makes of the resource options of docker run
+    """
+    def values(name):
+        return [args[i + 1] for i, arg in enumerate(args[:-1]) if arg == name]
+
+    ulimits = []
+    for ulimit in values('--ulimit'):
+        name, _, limits = ulimit.partition('=')
+        soft, _, hard = limits.partition(':')
+        ulimits.append({'Name': name, 'Soft': int(soft), 'Hard': int(hard or soft)})
+    return {'Memory': int(option(args, '--memory', '0')), 'CpusetCpus': option(args, '--cpuset-cpus', ''),
+            'NanoCpus': int(float(option(args, '--cpus', '0')) * 1e9),
+            'Sysctls': dict(sysctl.split('=', 1) for sysctl in values('--sysctl')), 'Ulimits': ulimits or None}
+
+
+class RouteTable(object):
+    def __init__(self):
+        self.path = os.path.join(HARNESS_DIR, 'routes.json')
+
+    def __enter__(self):
+        self.fh = open(self.path, 'a+')
+        fcntl.flock(self.fh, fcntl.LOCK_EX)
+        self.fh.seek(0)
+        content = self.fh.read()
+        self.state = json.loads(content) if content else {'routes': [], 'rules': []}
+        return self.state
+
+    def __exit__(self, *args):
+        self.fh.seek(0)
+        self.fh.truncate()
+        json.dump(self.state, self.fh)
+        self.fh.close()
+
+
+def ip_route(state, args):
+    if not args:
+        args = ['show']
+    cmd, args = args[0], args[1:]
+
+    table = 'main'
+    if 'table' in args:
+        i = args.index('table')
+        table = args[i + 1]
+        args = args[:i] + args[i + 2:]
+    routes = state['routes']
+
+    if cmd in ('add', 'replace', 'change', 'append'):
+        dst, rest = args[0], args[1:]
+        vias, attrs = [], []
+        i = 0
+        while i < len(rest):
+            if rest[i] == 'via':
+                vias.append(rest[i + 1])
+                i += 2
+            elif rest[i] == 'nexthop':
+                i += 1
+            else:
+                attrs.append(rest[i])
+                i += 1
+        existing = [r for r in routes if r['dst'] == dst and r['table'] == table]
+        if existing and cmd == 'add':
+            sys.stderr.write('RTNETLINK answers: File exists\n')
+            return 2
+        for r in existing:
+            routes.remove(r)
+        routes.append({'dst': dst, 'via': vias, 'table': table, 'attrs': attrs})
+        return 0
+    if cmd in ('del', 'delete'):
+        dst = args[0]
+        existing = [r for r in routes if r['dst'] == dst and r['table'] == table]
+        if not existing:
+            sys.stderr.write('RTNETLINK answers: No such process\n')
+            return 2
+        routes.remove(existing[0])
+        return 0
+    if cmd == 'flush':
+        state['routes'] = [r for r in routes if r['table'] != table]
+        return 0
+    if cmd in ('show', 'list'):
+        via = args[args.index('via') + 1] if 'via' in args else None
+        for r in routes:
+            if r['table'] != table and table != 'all':
+                continue
+            if via and via not in r['via']:
+                continue
+            if len(r['via']) > 1:
+                hops = ''.join('\tnexthop via %s dev docker0 weight 1 ' % v for v in r['via'])
+                sys.stdout.write('%s %s%s\n' % (r['dst'], ' '.join(r['attrs']), hops))
+            else:
+                sys.stdout.write('%s via %s dev docker0 %s\n' % (r['dst'], r['via'][0], ' '.join(r['attrs'])))
+        return 0
+    sys.stderr.write('ip route: unsupported "%s"\n' % cmd)
+    return 1
+
+
+def ip_rule(state, args):
+    cmd, args = (args[0], args[1:]) if args else ('show', [])
+    if cmd in ('add', 'del', 'delete'):
+        pref = int(option(args, 'pref', option(args, 'priority', 0)))
+        table = option(args, 'lookup', option(args, 'table', 'main'))
+        keys = ('pref', 'priority', 'lookup', 'table')
+        rest = [a for i, a in enumerate(args) if a not in keys and (i == 0 or args[i - 1] not in keys)]
+        rule = [pref, 'from all lookup %s%s' % (table, ''.join(' ' + a for a in rest))]
+        if cmd == 'add':
+            state['rules'].append(rule)
+            return 0
+        if rule not in state['rules']:
+            sys.stderr.write('RTNETLINK answers: No such file or directory\n')
+            return 2
+        state['rules'].remove(rule)
+        return 0
+    rules = [[0, 'from all lookup local']] + state['rules'] + [[32766, 'from all lookup main'],
+                                                               [32767, 'from all lookup default']]
+    for pref, rule in sorted(rules, key=lambda r: r[0]):
+        sys.stdout.write('%d:\t%s\n' % (pref, rule))
+    return 0
+
+
+def ip(args):
+    args = [a for a in args if a not in ('-o', '-4', '-force')]
+    if args and args[0] == '-batch':
+        with open(args[1], 'rt') as fh:
+            commands = [shlex.split(line) for line in fh if line.strip()]
+    else:
+        commands = [args]
+
+    exitcode = 0
+    with RouteTable() as state:
+        for command in commands:
+            obj, rest = command[0], command[1:]
+            if obj in ('route', 'r'):
+                code = ip_route(state, rest)
+            elif obj in ('rule', 'ru'):
+                code = ip_rule(state, rest)
+            else:
+                code = 0
+            exitcode = exitcode or code
+    return exitcode
+
+
+def ipset(args):
+    args = [a for a in args if a != '-exist']
+    if args[:1] == ['-file']:
+        with open(args[1], 'rt') as fh:
+            commands = [shlex.split(line) for line in fh if line.strip()]
+        args = args[2:]
+    else:
+        commands = None
+    with RouteTable() as state:
+        sets = state.setdefault('sets', {})
+        if args[0] == 'restore':
+            for command in commands:
+                if command[0] == 'add':
+                    sets.setdefault(command[1], {})[command[2]] = int(option(command, 'timeout', 0))
+            return 0
+        if args[0] == 'create':
+            sets.setdefault(args[1], {})
+            return 0
+        if args[0] == 'destroy':
+            if sets.pop(args[1], None) is None:
+                sys.stderr.write('ipset v7.15: The set with the given name does not exist\n')
+                return 1
+            return 0
+        if args[0] == 'list':
+            for name, members in sorted(sets.items()):
+                sys.stdout.write('Name: %s\nMembers:\n%s' % (name, ''.join(
+                    '%s timeout %d\n' % member for member in sorted(members.items()))))
+            return 0
+    sys.stderr.write('ipset: unsupported "%s"\n' % args[0])
+    return 1
+
+
+def iptables(args):
+    table = option(args, '-t', 'filter')
+    args = [a for i, a in enumerate(args) if a != '-t' and (i == 0 or args[i - 1] != '-t')]
+    cmd, rule = args[0], '%s %s' % (table, ' '.join(args[1:]))
+    with RouteTable() as state:
+        rules = state.setdefault('iptables', [])
+        if cmd == '-A':
+            rules.append(rule)
+            return 0
+        if cmd in ('-C', '-D'):
+            if rule not in rules:
+                sys.stderr.write('iptables: Bad rule (does a matching rule exist in that chain?).\n')
+                return 1
+            if cmd == '-D':
+                rules.remove(rule)
+            return 0
+    sys.stderr.write('iptables: unsupported "%s"\n' % cmd)
+    return 2
+
+
+def sudo(args):
+    prompt = None
+    while args and args[0].startswith('-'):
+        if args[0] == '-p':
+            prompt = args[1]
+            args = args[2:]
+        else:
+            args = args[1:]
+    if prompt:
+        sys.stderr.write(prompt)
+        sys.stderr.flush()
+        password = sys.stdin.readline().rstrip('\n')
+        expected = os.environ.get('VPNP_HARNESS_SUDO_PASSWORD')
+        if expected is not None and password != expected:
+            sys.stderr.write('Sorry, try again.\n')
+            return 1
+    # Privileged writes land in the harness directory rather than the real /etc
+    args = [os.path.join(HARNESS_DIR, 'root', a[1:]) if a.startswith('/etc/') else a for a in args]
+    for a in args:
+        if a.startswith(os.path.join(HARNESS_DIR, 'root')):
+            os.makedirs(os.path.dirname(a), exist_ok=True)
+    return subprocess.call(args)
+
+
+def docker_machine(args):
+    if args[0] == 'ip':
+        sys.stdout.write('192.168.99.100\n')
+    elif args[0] == 'env':
+        for name, value in (('DOCKER_TLS_VERIFY', '1'), ('DOCKER_HOST', os.environ.get('DOCKER_HOST', '')),
+                            ('DOCKER_CERT_PATH', HARNESS_DIR), ('DOCKER_MACHINE_NAME', args[1])):
+            sys.stdout.write('export %s="%s"\n' % (name, value))
+    elif args[0] == 'ssh':
+        return subprocess.call(args[2:])
+    return 0
+
+
+def openconnect_prompts(connected=None):
+    sys.stdout.write('POST https://vpn.example.com/\n')
+    sys.stdout.write('Please enter your username and password.\n')
+    for prompt in ('Username:', 'Password:'):
+        sys.stdout.write(prompt)
+        sys.stdout.flush()
+        sys.stdin.readline()
+    time.sleep(float(os.environ.get('VPNP_HARNESS_CONNECT_DELAY', '0')))
+    if connected:
+        # vpnp hangs up once it sees "Established", so the container must exist by then
+        connected()
+    sys.stdout.write('Connected as 10.99.0.1, using SSL\n')
+    sys.stdout.write('Established DTLS connection\n')
+    sys.stdout.flush()
+
+
+def docker(args):
+    cmd, args = args[0], args[1:]
+    if cmd == 'run':
+        image = [a for a in args if a.startswith('vpnp/')][0]
+        container = {'Image': image, 'Name': option(args, '--name'), 'Network': option(args, '--network'),
+                     'IP': option(args, '--ip'), 'HostConfig': host_config(args),
+                     'Labels': dict(label.split('=', 1) for i, label in enumerate(args[1:])
+                                    if args[i] == '--label')}
+        try:
+            if '-d' in args:
+                res = docker_api('POST', '/_harness/containers', container)
+                sys.stdout.write('%s\n' % res['Id'])
+                return 0
+            openconnect_prompts(lambda: docker_api('POST', '/_harness/containers', container))
+        except RuntimeError as e:
+            sys.stderr.write('docker: Error response from daemon: %s.\n' % e)
+            return 125
+        return 0
+    if cmd == 'exec':
+        if '-i' in args and '-it' not in args:
+            sys.stdin.read()
+            return 0
+        if '-it' in args and '/vpnp/start' in args[-1]:
+            openconnect_prompts()
+        return 0
+    return 0
+
+
+def main():
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    tool = os.path.basename(sys.argv[0])
+    args = sys.argv[1:]
+    start = time.perf_counter()
+    time.sleep(float(os.environ.get('VPNP_HARNESS_DELAY', '0')))
+    exitcode = 0
+    try:
+        if tool == 'sudo':
+            exitcode = sudo(args)
+        elif tool == 'ip':
+            exitcode = ip(args)
+        elif tool == 'ipset':
+            exitcode = ipset(args)
+        elif tool == 'iptables':
+            exitcode = iptables(args)
+        elif tool == 'docker-machine':
+            exitcode = docker_machine(args)
+        elif tool == 'docker':
+            exitcode = docker(args)
+        return exitcode
+    finally:
+        sys.stdout.flush()
+        record(tool, args, start, exitcode)
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks for the vpn-porthole hot paths, runs offline without Docker or sudo.
+
+    $ python3 benchmarks/hotpaths.py --json bench.json
+    $ python3 benchmarks/hotpaths.py --baseline bench.json --threshold 0.25
+
+Each benchmark reports the best time per call over several repeats. When a baseline is
+given, any benchmark slower than baseline * (1 + threshold) is a regression and the
+exitcode is 1.
+"""
+import os
+import sys
+import io
+import json
+import time
+import platform
+import tempfile
+import contextlib
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BENCHMARKS = []
+
+
+def benchmark(number):
+    def decorate(setup):
+        BENCHMARKS.append((setup.__name__, number, setup))
+        return setup
+    return decorate
+
+
+def subnet_strings(count):
+    return ['10.%d.%d.0/24' % (i // 256 % 256, i % 256) for i in range(count)]
+
+
+@contextlib.contextmanager
+def config_root(subnet_count):
+    """
+    Point Settings at a temporary ~/.config/vpn-porthole with a large "bench" profile
+    """
+    old_home = os.environ.get('HOME')
+    with tempfile.TemporaryDirectory(prefix='vpnp-bench-') as home:
+        root = os.path.join(home, '.config', 'vpn-porthole')
+        os.makedirs(os.path.join(root, 'profiles'))
+        with open(os.path.join(root, 'settings.conf'), 'wt') as fh:
+            fh.write('[system]\n    sudo = bench\n')
+        with open(os.path.join(root, 'profiles', 'bench.conf'), 'wt') as fh:
+            fh.write(profile_content(subnet_count))
+        os.environ['HOME'] = home
+        try:
+            yield
+        finally:
+            if old_home is None:
+                del os.environ['HOME']
+            else:
+                os.environ['HOME'] = old_home
+
+
+def profile_content(subnet_count):
+    lines = ['vpn = vpn.example.com', 'username = bench', 'password = bench', '[subnets]']
+    lines.extend('    %s = True' % s for s in subnet_strings(subnet_count))
+    lines.extend(['[domains]', '    example.org = True'])
+    lines.extend(['[build]', '    [[options]]', '        proxy = proxy.example.com:80',
+                  '    [[files]]', "        Dockerfile.tmpl = '''",
+                  '            FROM debian',
+                  '            RUN useradd -ms /bin/bash {{local.user.name}} --uid {{local.user.uid}}',
+                  '            {{vpnp.hooks}}',
+                  '            USER {{local.user.name}}',
+                  "        '''"])
+    lines.extend(['[run]', '    [[options]]', '    [[hooks]]', "        start = '''",
+                  '            #!/bin/bash',
+                  '            sudo openconnect {{vpn.addr}} --interface tun1',
+                  "        '''"])
+    return '\n'.join(lines) + '\n'
+
+
+@benchmark(number=20)
+def ip_subnet_parse():
+    from vpnporthole.ip import IPv4Subnet
+    strings = subnet_strings(1000)
+    return lambda: [IPv4Subnet(s) for s in strings]
+
+
+@benchmark(number=20)
+def ip_subnet_hash():
+    from vpnporthole.ip import IPv4Subnet
+    subnets = [IPv4Subnet(s) for s in subnet_strings(1000)]
+    return lambda: set(subnets)
+
+
+@benchmark(number=20)
+def ip_subnet_contains():
+    from vpnporthole.ip import IPv4Subnet
+    outer = IPv4Subnet('10.0.0.0/12')
+    subnets = [IPv4Subnet(s) for s in subnet_strings(1000)]
+    return lambda: [s in outer for s in subnets]
+
+
+@benchmark(number=20)
+def ip_radix_lookup():
+    from vpnporthole.ip import IPv4RadixTree, IPv4Address
+    tree = IPv4RadixTree()
+    for s in subnet_strings(1000):
+        tree.add(s, s)
+    addrs = [IPv4Address('10.%d.%d.1' % (i // 256 % 256, i % 256)) for i in range(1000)]
+    return lambda: [tree.lookup(a) for a in addrs]
+
+
+@benchmark(number=5)
+def settings_load_large_profile():
+    from vpnporthole.settings import Settings
+    return lambda: Settings('bench').subnets()
+
+
+@benchmark(number=5)
+def settings_overlaps_large_profile():
+    from vpnporthole.settings import Settings
+    settings = Settings('bench')
+    return lambda: settings.overlaps()
+
+
+@benchmark(number=50)
+def settings_render_hooks():
+    from vpnporthole.settings import Settings
+    settings = Settings('bench')
+    settings.ctx  # warm up
+    return lambda: (settings.run_hook_files(), settings.build_files())
+
+
+@benchmark(number=20)
+def pexpect_out_write():
+    from vpnporthole.system.base import Pexpect
+    chunk = b''.join(b'openconnect: verbose line %d of output\r\n' % i for i in range(1000))
+
+    def run():
+        out = Pexpect.Out(('Password', 'Username'), False)
+        for _ in range(10):
+            out.write(chunk)
+    return run
+
+
+@benchmark(number=20)
+def docker_exec_parse():
+    from vpnporthole.settings import Settings
+    from vpnporthole.system.base import SystemCallsBase
+
+    class DockerClient(object):
+        def exec_create(self, container_id, args):
+            return {'Id': 'exec'}
+
+        def exec_start(self, exec_id, stream):
+            for i in range(1000):
+                yield b' [health] line %d of hook output\n' % i
+            yield b'/vpnp/exec:EXITCODE=0\n'
+
+    sc = SystemCallsBase('vpnp/bench_user', Settings('bench'))
+    sc.container_ip('172.17.0.2')
+    client = DockerClient()
+    return lambda: sc.docker_exec(client, 'container', ['/vpnp/health'])
+
+
+def measure(number, setup, repeat):
+    fn = setup()
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = (time.perf_counter() - start) / number
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    parser = ArgumentParser(description='vpn-porthole hot path microbenchmarks')
+    parser.add_argument('--json', default=None, help='Write results to this JSON file')
+    parser.add_argument('--baseline', default=None, help='Compare against results in this JSON file')
+    parser.add_argument('--threshold', default=0.25, type=float,
+                        help='Allowed slowdown relative to the baseline (default: 0.25)')
+    parser.add_argument('--repeat', default=5, type=int, help='Repeats per benchmark (default: 5)')
+    parser.add_argument('--subnets', default=5000, type=int,
+                        help='Subnets in the benchmark profile (default: 5000)')
+    parser.add_argument('filter', nargs='*', help='Only run benchmarks whose name contains these')
+    args = parser.parse_args()
+
+    results = {}
+    with config_root(args.subnets):
+        for name, number, setup in BENCHMARKS:
+            if args.filter and not any(f in name for f in args.filter):
+                continue
+            with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+                seconds = measure(number, setup, args.repeat)
+            results[name] = {'seconds': seconds, 'number': number}
+            sys.stdout.write('%-34s %12.1f us\n' % (name, seconds * 1e6))
+
+    if args.json:
+        with open(args.json, 'wt') as fh:
+            json.dump({'python': platform.python_version(),
+                       'subnets': args.subnets,
+                       'benchmarks': results}, fh, indent=2, sort_keys=True)
+
+    if args.baseline:
+        return compare(results, args.baseline, args.threshold)
+    return 0
+
+
+def compare(results, baseline_file, threshold):
+    with open(baseline_file, 'rt') as fh:
+        baseline = json.load(fh)['benchmarks']
+    exitcode = 0
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        ratio = result['seconds'] / baseline[name]['seconds']
+        status = 'OK'
+        if ratio > 1 + threshold:
+            status = 'REGRESSION'
+            exitcode = 1
+        sys.stdout.write('%-10s %-34s %6.2fx\n' % (status, name, ratio))
+    return exitcode
+
+
+if __name__ == '__main__':
+    exit(main())
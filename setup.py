@@ -12,7 +12,8 @@ setup(
     packages=['vpnporthole', 'vpnporthole.system'],
     entry_points={
         "console_scripts": [
-            "vpnp=vpnporthole.cli:main",
+            "vpnp=vpnporthole.client:main",
+            "vpnpd=vpnporthole.daemon:main",
         ]
     },
     install_requires=[
@@ -1,3 +1,28 @@
-from vpnporthole.session import Session
+from importlib import import_module
 
-__all__ = ['Session']
+# Imported on first use, so that the thin vpnp client starts without loading docker
+_modules = {
+    'Session': 'vpnporthole.session',
+    'Settings': 'vpnporthole.settings',
+    'VpnpError': 'vpnporthole.exceptions',
+    'ConfigError': 'vpnporthole.exceptions',
+    'ProfileNameError': 'vpnporthole.exceptions',
+    'BuildError': 'vpnporthole.exceptions',
+    'SudoError': 'vpnporthole.exceptions',
+    'DockerEnvError': 'vpnporthole.exceptions',
+    'LockTimeout': 'vpnporthole.exceptions',
+    'ExecResult': 'vpnporthole.results',
+    'Image': 'vpnporthole.results',
+    'SessionInfo': 'vpnporthole.results',
+    'Tunnel': 'vpnporthole.results',
+}
+
+__all__ = ['Session', 'Settings',
+           'VpnpError', 'ConfigError', 'ProfileNameError', 'BuildError', 'SudoError', 'DockerEnvError', 'LockTimeout',
+           'ExecResult', 'Image', 'SessionInfo', 'Tunnel']
+
+
+def __getattr__(name):
+    if name not in _modules:
+        raise AttributeError("module 'vpnporthole' has no attribute '%s'" % name)
+    return getattr(import_module(_modules[name]), name)
@@ -0,0 +1,146 @@
+import re
+import time
+import socket
+import threading
+import socketserver
+
+PROBES = ('latency', 'connect', 'throughput')
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """
+    Nearest-rank percentiles of values as {point: value}
+
+    >>> percentiles([4, 1, 3, 2], (50, 100))
+    {50: 2, 100: 4}
+    """
+    ordered = sorted(values)
+    ret = {}
+    for point in points:
+        rank = max(1, -(-point * len(ordered) // 100))
+        ret[point] = ordered[rank - 1]
+    return ret
+
+
+def request(host, path):
+    return ('GET %s HTTP/1.0\r\nHost: %s\r\n\r\n' % (path, host)).encode('ascii')
+
+
+def host_probe(probe, host, port, path, count, timeout=5):
+    """
+    Run a probe from the host, returning the latency or connect times in seconds, or the
+    throughput in bytes per second, one per successful attempt
+    """
+    values = []
+    for _ in range(count):
+        try:
+            start = time.perf_counter()
+            sock = socket.create_connection((host, port), timeout)
+            try:
+                if probe == 'connect':
+                    values.append(time.perf_counter() - start)
+                    continue
+                if probe == 'latency':
+                    # Request to first response byte, on an established connection
+                    start = time.perf_counter()
+                    sock.sendall(request(host, path))
+                    if sock.recv(1):
+                        values.append(time.perf_counter() - start)
+                    continue
+                sock.sendall(request(host, path))
+                size = 0
+                while True:
+                    data = sock.recv(256 * 1024)
+                    if not data:
+                        break
+                    size += len(data)
+                values.append(size / (time.perf_counter() - start))
+            finally:
+                sock.close()
+        except (OSError, socket.timeout):
+            pass
+    return values
+
+
+def container_script(probe, host, port, path, count):
+    """
+    A bash script for a probe from inside the container, which prints a duration in
+    nanoseconds, or "<bytes> <nanoseconds>" for throughput, per successful attempt
+    """
+    req = 'GET %s HTTP/1.0\\r\\nHost: %s\\r\\n\\r\\n' % (path, host)
+    connect = 'exec 3<>/dev/tcp/%s/%d 2>/dev/null || continue' % (host, port)
+    # bash 5 has a clock without forking date
+    clock = ('t() { if [ -n "$EPOCHREALTIME" ]; then T=${EPOCHREALTIME//[.,]/}000; '
+             'else T=$(date +%s%N); fi; }')
+    if probe == 'connect':
+        body = 't; s=$T; %s; t; echo $((T - s))' % connect
+    elif probe == 'latency':
+        body = '%s; t; s=$T; printf "%s" >&3; read -r -t 5 -u 3 line || continue; t; echo $((T - s))' % (
+            connect, req)
+    else:
+        body = 't; s=$T; %s; printf "%s" >&3; n=$(cat <&3 | wc -c); t; echo "$n $((T - s))"' % (connect, req)
+    return '%s; for i in $(seq %d); do %s; exec 3<&-; done' % (clock, count, body)
+
+
+def parse_container_output(probe, lines):
+    values = []
+    for line in lines:
+        words = line.split()
+        if not words or not all(re.match(r'^\d+$', w) for w in words):
+            continue
+        if probe == 'throughput' and len(words) == 2 and int(words[1]):
+            values.append(int(words[0]) / (int(words[1]) / 1e9))
+        elif probe != 'throughput' and len(words) == 1:
+            values.append(int(words[0]) / 1e9)
+    return values
+
+
+class LocalTarget(object):
+    """
+    A local stand-in for a target in the VPN: an HTTP server that answers any GET with
+    size bytes, listening on the given addresses on one port
+    """
+    def __init__(self, addresses=('127.0.0.1',), size=10 * 1024 * 1024):
+        self.__addresses = addresses
+        self.__size = size
+        self.__servers = []
+        self.port = None
+
+    def __enter__(self):
+        size = self.__size
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                self.request.settimeout(5)
+                try:
+                    if not self.request.recv(4096):
+                        return  # A connect probe
+                    self.request.sendall(b'HTTP/1.0 200 OK\r\nContent-Length: %d\r\n\r\n' % size)
+                    chunk = b'\0' * (256 * 1024)
+                    sent = 0
+                    while sent < size:
+                        sent += self.request.send(chunk[:size - sent])
+                except OSError:
+                    pass  # The latency probe hangs up after the first line
+
+        class Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        for address in self.__addresses:
+            try:
+                server = Server((address, self.port or 0), Handler)
+            except OSError:
+                continue
+            self.port = server.server_address[1]
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self.__servers.append(server)
+        return self
+
+    def __exit__(self, *args):
+        for server in self.__servers:
+            server.shutdown()
+            server.server_close()
+
+    def listening(self, address):
+        return any(s.server_address[0] == address for s in self.__servers)
@@ -1,9 +1,37 @@
 #!/usr/bin/env python3
+import os
 import sys
 
 from vpnporthole.session import Session
 from vpnporthole.settings import Settings
 from vpnporthole.argparsetree import ArgParseTree
+from vpnporthole.exceptions import VpnpError
+from vpnporthole.lock import running
+
+
+def prompt(text, secret):
+    """
+    Ask on the terminal, for what Settings needs but is left blank
+    """
+    if secret:
+        import getpass
+        return getpass.getpass(text)
+    return input(text)
+
+
+def new_settings(profile_name):
+    """
+    The Settings of a profile for a command, vpnpd replaces this to reuse them across commands
+    """
+    return Settings(profile_name, prompt=prompt)
+
+
+def new_session(profile_name):
+    """
+    The (Settings, Session) of a profile for a command, vpnpd replaces this to reuse them across commands
+    """
+    settings = new_settings(profile_name)
+    return settings, Session(settings)
 
 
 class Main(ArgParseTree):
@@ -24,12 +52,10 @@ class Action(ArgParseTree):
         if args.profile == 'all':
             profile_names = Settings.list_profile_names()
             for profile_name in sorted(profile_names):
-                self.settings = Settings(profile_name)
-                session = Session(self.settings)
+                self.settings, session = new_session(profile_name)
                 self.go(session, args)
         else:
-            self.settings = Settings(args.profile)
-            session = Session(self.settings)
+            self.settings, session = new_session(args.profile)
             return self.go(session, args)
 
     def go(self, session, args):
@@ -52,25 +78,74 @@ class Start(Action):
     """\
     Start profile
 
-    Start the docker container for this profile, requires user to enter password none configured
+    Start the docker container for this profile, requires user to enter password none configured.
+    With --detach the container runs in the background, the credentials are passed to the start
+    hook on stdin, and vpnp returns once the tunnel is up and the health hook passes
     """
+    def args(self, parser):
+        super(Start, self).args(parser)
+        parser.add_argument('--detach', default=False, action='store_true',
+                            help="Start the container in the background, without a terminal")
+        parser.add_argument('--credentials', default=None,
+                            help="File with the username and password on two lines, or '-' for stdin "
+                                 "(default: from the profile)")
+        parser.add_argument('--timeout', default=60, type=int,
+                            help="Seconds to wait for the tunnel with --detach (default: 60)")
+
+    def credentials(self, args):
+        if not args.credentials:
+            return None
+        if args.credentials == '-':
+            lines = sys.stdin.read().splitlines()
+        else:
+            with open(args.credentials, 'rt') as fh:
+                lines = fh.read().splitlines()
+        if len(lines) < 2:
+            raise ValueError('Expected a username and password in "%s"' % args.credentials)
+        return lines[0], lines[1]
+
     def go(self, session, args):
         try:
-            if session.start():
+            credentials = self.credentials(args)
+        except ValueError as e:
+            sys.stderr.write('! %s\n' % e)
+            return 1
+        try:
+            if session.start(detach=args.detach, credentials=credentials, timeout=args.timeout):
+                if self.settings.standby_enabled():
+                    self.refill_standby()
+                if self.settings.dns_forwarder():
+                    self.start_dns()
                 return 0
             return 1
         except KeyboardInterrupt:
             return 1
 
+    def refill_standby(self):
+        import subprocess
+        argv = [sys.executable, '-m', 'vpnporthole.cli', 'standby', self.settings.profile_name]
+        with open(os.devnull, 'r+b') as devnull:
+            subprocess.Popen(argv, stdin=devnull, stdout=devnull, stderr=devnull, start_new_session=True)
+
+    def start_dns(self):
+        import subprocess
+        subprocess.call([sys.executable, '-m', 'vpnporthole.cli', 'dns', '--detach'])
+
 
 class Stop(Action):
     """\
     Stop profile
 
-    Stop the docker container for this profile
+    Stop the docker container for this profile. With --keep-routes, and a static IP on the vpnp
+    network, the routes and domains are left in place for the next start
     """
+    def args(self, parser):
+        super(Stop, self).args(parser)
+        parser.add_argument('--keep-routes', default=False, action='store_true',
+                            help="Leave the routes and domains to the static IP in place")
+
     def go(self, session, args):
-        if session.stop():
+        if session.stop(keep_routes=args.keep_routes):
             return 0
         return 1
 
@@ -89,7 +164,7 @@ class Status(Action):
             status = 'STOPPED'
             exitcode = 1
         sys.stdout.write("%s %s %s@%s\n" % (status, self.settings.profile_name,
-                                            self.settings.username(), self.settings.vpn()))
+                                            self.settings.username(), session.endpoint()))
         return exitcode
 
 
@@ -106,7 +181,7 @@ class Health(Action):
         else:
             status = 'BAD'
         sys.stdout.write("%s %s %s@%s\n" % (status, self.settings.profile_name,
-                                            self.settings.username(), self.settings.vpn()))
+                                            self.settings.username(), session.endpoint()))
         return exitcode
 
 
@@ -143,6 +218,28 @@ class Info(Action):
         return 1
 
 
+class Standby(Action):
+    """\
+    Prepare standby container
+
+    Start a container for this profile that idles until it is taken by "start", so that "start" only
+    needs to authenticate. "start" refills the standby in the background if [standby] is enabled
+    """
+    def args(self, parser):
+        super(Standby, self).args(parser)
+        parser.add_argument('--drain', default=False, action='store_true',
+                            help="Remove the standby container instead")
+
+    def go(self, session, args):
+        if args.drain:
+            ok = session.drain_standby()
+        else:
+            ok = session.standby()
+        if ok:
+            return 0
+        return 1
+
+
 class Rm(Action):
     """\
     Stop the profile, and remove the docker container
@@ -155,29 +252,302 @@ class Rm(Action):
         return 1
 
 
-class Restart(Action):
+class Restart(Start):
     """\
     Restart profile
 
-    Restart Docker container for this profile
+    Restart Docker container for this profile. The new container is brought up alongside the
+    old one, the routes and domains are switched over to it, and then the old one is stopped
     """
     def go(self, session, args):
-        if session.status():
-            if not session.stop():
-                sys.stderr.write("Failed to stop!\n")
-                return 1
-            if session.start():
-                return 0
-            sys.stderr.write("Failed to start!\n")
+        if not session.status():
+            sys.stderr.write("Not running!\n")
+            return 1
+        try:
+            credentials = self.credentials(args)
+        except ValueError as e:
+            sys.stderr.write('! %s\n' % e)
             return 1
-        sys.stderr.write("Not running!\n")
+        try:
+            if session.restart(detach=args.detach, credentials=credentials, timeout=args.timeout):
+                if self.settings.standby_enabled():
+                    self.refill_standby()
+                if self.settings.dns_forwarder():
+                    self.start_dns()
+                return 0
+        except KeyboardInterrupt:
+            pass
+        sys.stderr.write("Failed to restart!\n")
         return 1
 
 
+class Logs(Action):
+    """\
+    Show profile logs
+
+    Show the output of the docker container for this profile, optionally saving it to size capped
+    log files that are rotated, in ~/.cache/vpn-porthole/logs/
+    """
+    @staticmethod
+    def tail_lines(value):
+        from argparse import ArgumentTypeError
+
+        if value == 'all':
+            return value
+        if not value.isdigit():
+            raise ArgumentTypeError('expected a number of lines or "all", not "%s"' % value)
+        return int(value)
+
+    def args(self, parser):
+        super(Logs, self).args(parser)
+        parser.add_argument('-f', '--follow', default=False, action='store_true',
+                            help="Follow the log output")
+        parser.add_argument('--since', default=None,
+                            help="Show logs since an epoch or a relative time, e.g.: 10m, 2h, 1d")
+        parser.add_argument('--tail', default='all', type=self.tail_lines,
+                            help="Number of lines to show from the end of the logs (default: all)")
+        parser.add_argument('--save', default=False, action='store_true',
+                            help="Also write the logs to a rotated log file")
+        parser.add_argument('--max-bytes', default=10 * 1024 * 1024, type=int,
+                            help="Size at which the log file is rotated (default: 10MB)")
+        parser.add_argument('--backups', default=5, type=int,
+                            help="Number of rotated log files to keep (default: 5)")
+        parser.add_argument('--quiet', default=False, action='store_true',
+                            help="Don't write the logs to stdout")
+        parser.add_argument('--detach', default=False, action='store_true',
+                            help="Follow and save the logs in a background process")
+
+    def go(self, session, args):
+        from vpnporthole.logs import RotatingLog, parse_since
+
+        try:
+            since = parse_since(args.since) if args.since else None
+        except ValueError as e:
+            sys.stderr.write('! %s\n' % e)
+            return 1
+        log_file = os.path.join(Settings.cache_dir('logs'), '%s.log' % self.settings.profile_name)
+
+        if args.detach:
+            import subprocess
+            argv = [sys.executable, '-m', 'vpnporthole.cli', 'logs', '--follow', '--save', '--quiet',
+                    '--tail', str(args.tail), '--max-bytes', str(args.max_bytes),
+                    '--backups', str(args.backups), self.settings.profile_name]
+            if args.since:
+                argv[-1:-1] = ['--since', args.since]
+            with open(os.devnull, 'r+b') as devnull:
+                p = subprocess.Popen(argv, stdin=devnull, stdout=devnull, stderr=devnull,
+                                     start_new_session=True)
+            sys.stdout.write("Logging %s to %s (pid %d)\n" % (self.settings.profile_name, log_file, p.pid))
+            return 0
+
+        sinks = []
+        if not args.quiet:
+            sinks.append(sys.stdout)
+        log = None
+        if args.save:
+            log = RotatingLog(log_file, args.max_bytes, args.backups)
+            sinks.append(log)
+        try:
+            if session.logs(sinks, follow=args.follow, since=since, tail=args.tail):
+                return 0
+            return 1
+        except KeyboardInterrupt:
+            return 0
+        finally:
+            if log:
+                log.close()
+
+
+class Bench(Action):
+    """\
+    Benchmark profile tunnel
+
+    Measure the request latency, TCP connect time and HTTP download throughput to a target in
+    the routed subnets, from the host over the installed route and from inside the container.
+    With --local a local HTTP server is used as a stand-in target
+    """
+    def args(self, parser):
+        super(Bench, self).args(parser)
+        parser.add_argument('target', nargs='?',
+                            help="Host or host:port of an HTTP server in the VPN, e.g.: 10.1.2.3:80")
+        parser.add_argument('--path', default='/', help="Path to download for throughput (default: /)")
+        parser.add_argument('--count', default=10, type=int, help="Attempts per probe (default: 10)")
+        parser.add_argument('--local', default=False, action='store_true',
+                            help="Benchmark against a local stand-in server instead of a target")
+        parser.add_argument('--size', default=10 * 1024 * 1024, type=int,
+                            help="Bytes served by the --local server per request (default: 10MB)")
+        parser.add_argument('--no-host', default=False, action='store_true', help="Skip the probes from the host")
+        parser.add_argument('--no-container', default=False, action='store_true',
+                            help="Skip the probes from inside the container")
+        parser.add_argument('--json', default=None, help="Also write the results to this JSON file")
+
+    def run(self, args):
+        if not args.local and not args.target:
+            sys.stderr.write('! Expected a target or --local\n')
+            return 1
+        return super(Bench, self).run(args)
+
+    def go(self, session, args):
+        import json
+        from vpnporthole.bench import LocalTarget, PROBES
+
+        if not session.status():
+            sys.stderr.write("Not running!\n")
+            return 1
+
+        if args.local:
+            gateway = session.gateway()
+            with LocalTarget(sorted(set(['127.0.0.1', gateway or '127.0.0.1'])), args.size) as target:
+                sources = [('host', '127.0.0.1', target.port)]
+                if gateway and target.listening(gateway):
+                    sources.append(('container', gateway, target.port))
+                else:
+                    sys.stderr.write('! Unable to listen on %s for the container\n' % gateway)
+                results = self.probe(session, sources, PROBES, args)
+        else:
+            host, _, port = args.target.partition(':')
+            port = int(port or 80)
+            self.check_routed(session, host)
+            results = self.probe(session, [('host', host, port), ('container', host, port)], PROBES, args)
+
+        if args.json:
+            with open(args.json, 'wt') as fh:
+                json.dump(results, fh, indent=2, sort_keys=True)
+        return 0 if results and all(r['count'] for r in results) else 1
+
+    def check_routed(self, session, host):
+        import socket
+        from vpnporthole.ip import IPv4Subnet
+        try:
+            addr = socket.gethostbyname(host)
+        except socket.gaierror:
+            return
+        if not any(addr in IPv4Subnet(subnet) for subnet in session.routes()):
+            sys.stderr.write('! %s is not routed via %s\n' % (addr, self.settings.profile_name))
+
+    def probe(self, session, sources, probes, args):
+        from vpnporthole.bench import host_probe, container_script, parse_container_output, percentiles
+
+        results = []
+        for source, host, port in sources:
+            if (source == 'host' and args.no_host) or (source == 'container' and args.no_container):
+                continue
+            for probe in probes:
+                if source == 'host':
+                    values = host_probe(probe, host, port, args.path, args.count)
+                else:
+                    script = container_script(probe, host, port, args.path, args.count)
+                    out = session.exec_lines(['bash', '-c', script])
+                    values = parse_container_output(probe, out[1] if out else [])
+                scale, unit = (1e-6, 'MB/s') if probe == 'throughput' else (1e3, 'ms')
+                result = {'source': source, 'probe': probe, 'unit': unit, 'count': len(values)}
+                if values:
+                    result.update(('p%d' % p, v * scale) for p, v in percentiles(values).items())
+                    sys.stdout.write('%-9s %-10s %3d  p50 %9.2f  p90 %9.2f  p99 %9.2f %s\n' % (
+                        source, probe, len(values), result['p50'], result['p90'], result['p99'], unit))
+                else:
+                    sys.stdout.write('%-9s %-10s   0  failed\n' % (source, probe))
+                results.append(result)
+        return results
+
+
+class Watch(Action):
+    """\
+    Watch for dead containers
+
+    Follow the Docker events and, as soon as a container of the profile exits other than by "stop" or
+    "restart", e.g. the VPN client failed or it ran out of memory, take the routes and domains off it,
+    rather than leave them pointing at a dead IP. The routes go via the remaining tunnels if there are
+    any. With --restart the profile is then started again in the background
+    """
+    def args(self, parser):
+        super(Watch, self).args(parser)
+        parser.add_argument('--restart', default=False, action='store_true',
+                            help="Start the profile again with \"start --detach\"")
+        parser.add_argument('--once', default=False, action='store_true',
+                            help="Exit once a dead container has been handled")
+
+    def run(self, args):
+        import threading
+        if args.profile == 'all':
+            names = sorted(Settings.list_profile_names())
+        else:
+            names = [args.profile]
+
+        done = threading.Event()
+
+        def follow(name):
+            try:
+                self.follow(name, new_session(name)[1], args)
+            finally:
+                if args.once:
+                    done.set()
+
+        threads = [threading.Thread(target=follow, args=(name,), daemon=True) for name in names]
+        for thread in threads:
+            thread.start()
+        while not done.is_set() and any(t.is_alive() for t in threads):
+            done.wait(1)
+        return 0
+
+    def follow(self, profile_name, session, args):
+        import subprocess
+        for container_id in session.watch():
+            sys.stdout.write("DIED %s %s\n" % (profile_name, container_id[:12]))
+            sys.stdout.flush()
+            if args.restart:
+                subprocess.call([sys.executable, '-m', 'vpnporthole.cli', 'start', '--detach', profile_name])
+            if args.once:
+                return 0
+        return 0
+
+
 class RouteAction(Action):
+    subnet_list = None
+
     def args(self, parser):
         super(RouteAction, self).args(parser)
-        parser.add_argument('subnet', help="IPv4 subnet to route into active profile, e.g.: 10.1.2.0/24")
+        parser.add_argument('subnet', nargs='?',
+                            help="IPv4 subnet to route into active profile, e.g.: 10.1.2.0/24, "
+                                 "or '-' to read a list of subnets from stdin")
+        parser.add_argument('-f', '--file', default=None,
+                            help="Read a list of subnets from a file, one per line")
+        parser.add_argument('--aggregate', default=False, action='store_true',
+                            help="Aggregate the subnets into the fewest covering subnets")
+
+    def run(self, args):
+        if args.file is None and args.subnet is None:
+            sys.stderr.write('! Expected a subnet, "-" or --file\n')
+            return 1
+        # Read once, for every profile of "all"
+        try:
+            self.subnet_list = self.subnets(args)
+        except ValueError as e:
+            sys.stderr.write('! %s\n' % e)
+            return 1
+        return super(RouteAction, self).run(args)
+
+    def subnets(self, args):
+        from vpnporthole.ip import read_subnets, collapse_subnets
+
+        if args.file:
+            with open(args.file, 'rt') as fh:
+                subnets = list(read_subnets(fh))
+        elif args.subnet == '-':
+            subnets = list(read_subnets(sys.stdin))
+        else:
+            subnets = list(read_subnets([args.subnet]))
+        if args.aggregate:
+            subnets = collapse_subnets(subnets)
+        return subnets
+
+    def go(self, session, args):
+        if self.apply(session, self.subnet_list):
+            return 0
+        return 1
+
+    def apply(self, session, subnets):
+        raise NotImplementedError()
 
 
 class AddRoute(RouteAction):
@@ -186,10 +556,8 @@ class AddRoute(RouteAction):
     """
     name = 'add-route'
 
-    def go(self, session, args):
-        if session.add_route(args.subnet):
-            return 0
-        return 1
+    def apply(self, session, subnets):
+        return session.add_routes(subnets)
 
 
 class DelRoute(RouteAction):
@@ -198,10 +566,8 @@ class DelRoute(RouteAction):
     """
     name = 'del-route'
 
-    def go(self, session, args):
-        if session.del_route(args.subnet):
-            return 0
-        return 1
+    def apply(self, session, subnets):
+        return session.del_routes(subnets)
 
 
 class DomainAction(Action):
@@ -234,6 +600,296 @@ class DelDomain(DomainAction):
         return 1
 
 
+class Which(ArgParseTree):
+    """\
+    Which profile routes an address
+
+    Find the profile, subnet and container IP that traffic to an address or hostname will use
+    """
+    def args(self, parser):
+        parser.add_argument('address', help="IPv4 address or hostname, e.g.: 10.1.2.3")
+
+    def run(self, args):
+        import socket
+        from vpnporthole.ip import IPv4RadixTree
+
+        try:
+            addr = socket.gethostbyname(args.address)
+        except socket.gaierror as e:
+            sys.stderr.write('! Unable to resolve "%s": %s\n' % (args.address, e))
+            return 1
+
+        tree = IPv4RadixTree()
+        for profile_name in sorted(Settings.list_profile_names()):
+            # A broken profile, or one that Docker cannot be asked about (its errors are OSErrors),
+            # must not hide the others
+            try:
+                settings, session = new_session(profile_name)
+                for subnet in settings.subnets():
+                    tree.add(subnet, (profile_name, None))
+                if not session.status():
+                    continue
+                for subnet in session.routes():
+                    tree.add(subnet, (profile_name, session.ip))
+            except (VpnpError, OSError) as e:
+                sys.stderr.write('! Unable to list routes for "%s": %s\n' % (profile_name, e))
+
+        found = tree.lookup(addr)
+        if not found:
+            sys.stdout.write("%s not routed\n" % addr)
+            return 1
+        subnet, (profile_name, ip) = found
+        sys.stdout.write("%s %s %s %s\n" % (addr, profile_name, subnet, ip or '-'))
+        return 0
+
+
+class Check(ArgParseTree):
+    """\
+    Check profiles
+
+    Report subnets that overlap across or within profiles, and static IPs on the vpnp network
+    and routing tables that clash
+    """
+    def run(self, args):
+        from vpnporthole.ip import find_overlaps
+
+        all_subnets = Settings.all_subnets()
+        exitcode = 0
+        for outer, outer_name, inner, inner_name in find_overlaps(all_subnets):
+            sys.stdout.write('OVERLAP %s (%s) %s (%s)\n' % (inner, inner_name, outer, outer_name))
+            exitcode = 1
+
+        ips = {}
+        tables = {}
+        for name in sorted(Settings.list_profile_names()):
+            settings = new_settings(name)
+            marks = [settings.route_mark()] if settings.routed_domains() else []
+            for table in list(settings.route_tables() or ()) + marks:
+                if table in tables:
+                    sys.stdout.write('TABLE %d (%s) (%s)\n' % (table, tables[table], name))
+                    exitcode = 1
+                tables.setdefault(table, name)
+            ip = settings.network_ip()
+            if not ip:
+                continue
+            if ip not in settings.network_subnet():
+                sys.stdout.write('IP %s (%s) outside %s\n' % (ip, name, settings.network_subnet()))
+                exitcode = 1
+            if ip in ips:
+                sys.stdout.write('IP %s (%s) (%s)\n' % (ip, ips[ip], name))
+                exitcode = 1
+            ips.setdefault(ip, name)
+        if exitcode == 0:
+            profiles = len(set(name for _, name in all_subnets))
+            sys.stdout.write('OK %d subnets in %d profiles\n' % (len(all_subnets), profiles))
+        return exitcode
+
+
+class Dns(ArgParseTree):
+    """\
+    Split-DNS forwarder
+
+    Serve DNS for the domains of all running profiles, forwarding each query to the containers of the
+    profile with the longest matching domain, through a TTL cache. Other names are refused. The addresses
+    of routed domains are routed via their profile. Enable it with [dns] in settings.conf, "start" then
+    runs it in the background
+    """
+    def args(self, parser):
+        parser.add_argument('--detach', default=False, action='store_true',
+                            help="Run in the background, if not already running")
+        parser.add_argument('--stop', default=False, action='store_true',
+                            help="Stop the background forwarder")
+        parser.add_argument('--stats', default=False, action='store_true',
+                            help="Show the cache and upstream counters of the running forwarder")
+
+    def run(self, args):
+        cache_dir = Settings.cache_dir('dns')
+        pid_file = os.path.join(cache_dir, 'forwarder.pid')
+        stats_file = os.path.join(cache_dir, 'stats.json')
+        if args.stats:
+            return self.stats(stats_file)
+        if args.stop:
+            pid = running(pid_file)
+            if not pid:
+                sys.stderr.write('! DNS forwarder is not running\n')
+                return 1
+            import signal
+            os.kill(pid, signal.SIGTERM)
+            return 0
+
+        dns = Settings.forwarder_settings()
+        if not dns:
+            sys.stderr.write('! DNS forwarder is not enabled, see [dns] in settings.conf\n')
+            return 1
+        if running(pid_file):
+            if args.detach:
+                return 0
+            sys.stderr.write('! DNS forwarder is already running\n')
+            return 1
+        if args.detach:
+            import subprocess
+            argv = [sys.executable, '-m', 'vpnporthole.cli', 'dns']
+            with open(os.devnull, 'r+b') as devnull, open(os.path.join(cache_dir, 'forwarder.log'), 'ab') as log:
+                subprocess.Popen(argv, stdin=devnull, stdout=devnull, stderr=log, start_new_session=True)
+            return 0
+
+        from vpnporthole.dns import DnsCache, AddressSets, Forwarder, serve
+        sessions = {}  # profile name: (Settings, Session)
+        set_profiles = {}
+
+        def refresh():
+            routes = {}
+            routed = {}
+            for name in sorted(Settings.list_profile_names()):
+                try:
+                    # A new Session when the settings or profile file changed
+                    settings = Settings.load(name)
+                    if name not in sessions or sessions[name][0] is not settings:
+                        sessions[name] = (settings, Session(settings))
+                    session = sessions[name][1]
+                    for domain, ips in session.dns_routes().items():
+                        routes.setdefault(domain, ips)
+                    for domain, route_set in session.routed_sets().items():
+                        routed.setdefault(domain, route_set)
+                        set_profiles[route_set] = name
+                except Exception as e:
+                    sys.stderr.write('! Unable to list domains for "%s": %s\n' % (name, e))
+            return routes, routed
+
+        def write(entries):
+            by_set = {}
+            for route_set, ip, timeout in entries:
+                by_set.setdefault(route_set, []).append((ip, timeout))
+            for route_set, addresses in sorted(by_set.items()):
+                sessions[set_profiles[route_set]][1].add_routed_addresses(addresses)
+
+        cache = DnsCache(dns['cache_size'], dns['max_ttl'], dns['negative_ttl'])
+        forwarder = Forwarder(cache, dns['timeout'], sets=AddressSets(write, interval=dns['refresh']))
+        with open(pid_file, 'wt') as fh:
+            fh.write('%d\n' % os.getpid())
+        try:
+            sys.stderr.write('DNS forwarder on %s:%d\n' % (dns['listen'], dns['port']))
+            serve(forwarder, dns['listen'], dns['port'], refresh, dns['refresh'], stats_file)
+        except OSError as e:
+            sys.stderr.write('! Unable to serve DNS on %s:%d: %s\n' % (dns['listen'], dns['port'], e))
+            return 1
+        finally:
+            os.unlink(pid_file)
+        return 0
+
+    @staticmethod
+    def stats(stats_file):
+        import json
+        try:
+            with open(stats_file, 'rt') as fh:
+                stats = json.load(fh)
+        except (IOError, ValueError):
+            sys.stderr.write('! No DNS forwarder stats in "%s"\n' % stats_file)
+            return 1
+        counters = stats['counters']
+        for name, value in sorted(counters.items()):
+            sys.stdout.write('%-24s %s\n' % (name, round(value, 6) if isinstance(value, float) else value))
+        lookups = counters['hits'] + counters['negative_hits'] + counters['misses']
+        if lookups:
+            ratio = (counters['hits'] + counters['negative_hits']) / lookups
+            sys.stdout.write('%-24s %.1f%%\n' % ('hit_ratio', ratio * 100))
+        upstream = counters['upstream_queries'] - counters['upstream_errors']
+        if upstream > 0:
+            sys.stdout.write('%-24s %.1f ms\n' % ('upstream_mean', counters['upstream_seconds_total'] / upstream * 1e3))
+        for domain, ips in sorted(stats['routes'].items()):
+            sys.stdout.write('%s %s\n' % (domain, ' '.join(ips)))
+        return 0
+
+
+class Metrics(ArgParseTree):
+    """\
+    Prometheus metrics
+
+    Report per profile whether it is up, its tunnel uptime, IPs and tun byte counters, the route and
+    domain counts, the last health hook result and the reconnects, in the Prometheus text format.
+    Printed once, served on --listen, or written to a --textfile for the node exporter. The commands
+    run to collect them are shown on stderr
+    """
+    def args(self, parser):
+        parser.add_argument('--listen', default=None,
+                            help="Serve the metrics over HTTP on [address:]port, e.g.: 127.0.0.1:9732")
+        parser.add_argument('--textfile', default=None,
+                            help="Write the metrics to this file, e.g. in the node exporter textfile directory")
+        parser.add_argument('--interval', default=0, type=int,
+                            help="Seconds between writes of --textfile, 0 to write once (default: 0)")
+
+    def run(self, args):
+        sessions = {}  # profile name: (Settings.config_mtimes(), Session)
+
+        def collect():
+            import json
+            import contextlib
+            from vpnporthole import metrics
+
+            samples = []
+            with contextlib.redirect_stdout(sys.stderr):
+                for name in sorted(Settings.list_profile_names()):
+                    try:
+                        # A new Session when the settings or profile file changed
+                        mtimes = Settings.config_mtimes(name)
+                        if name not in sessions or sessions[name][0] != mtimes:
+                            sessions[name] = (mtimes, new_session(name)[1])
+                        samples.extend(metrics.profile_samples(name, sessions[name][1].metrics()))
+                        error = 0
+                    except Exception as e:
+                        sys.stderr.write('! Unable to collect metrics for "%s": %s\n' % (name, e))
+                        error = 1
+                    samples.append(('vpnp_scrape_errors', {'profile': name}, error))
+            try:
+                with open(os.path.join(Settings.cache_dir('dns'), 'stats.json'), 'rt') as fh:
+                    samples.extend(metrics.dns_samples(json.load(fh)))
+            except (IOError, ValueError):
+                pass
+            return metrics.render(samples)
+
+        if args.listen:
+            return self.serve(args.listen, collect)
+        if args.textfile:
+            from vpnporthole.metrics import write_textfile
+            import time
+            while True:
+                write_textfile(args.textfile, collect())
+                if not args.interval:
+                    return 0
+                time.sleep(args.interval)
+        sys.stdout.write(collect())
+        return 0
+
+    @staticmethod
+    def serve(listen, collect):
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = collect().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        address, _, port = listen.rpartition(':')
+        try:
+            server = HTTPServer((address or '127.0.0.1', int(port)), Handler)
+        except (OSError, ValueError) as e:
+            sys.stderr.write('! Unable to serve metrics on "%s": %s\n' % (listen, e))
+            return 1
+        sys.stderr.write('Serving metrics on http://%s:%d/metrics\n' % server.server_address)
+        server.serve_forever()
+        return 0
+
+
 class Docs(ArgParseTree):
     """\
     vpn-porthole documentation
@@ -250,7 +906,10 @@ class Docs(ArgParseTree):
         return 0
 
 
-def main():
+def run(argv=None):
+    """
+    Run a vpnp command in this process, returns the exitcode
+    """
     m = Main()
     Build(m)
     Start(m)
@@ -259,21 +918,36 @@ def main():
     Refresh(m)
     Stop(m)
     Restart(m)
+    Standby(m)
     AddRoute(m)
     DelRoute(m)
     AddDomain(m)
     DelDomain(m)
     Info(m)
+    Logs(m)
+    Watch(m)
+    Bench(m)
     Shell(m)
+    Which(m)
+    Check(m)
+    Dns(m)
+    Metrics(m)
     Rm(m)
     Docs(m)
 
     try:
-        return m.main()
+        return m.main(argv)
+    except VpnpError as e:
+        sys.stderr.write('! %s\n' % e)
+        return e.exitcode
     except KeyboardInterrupt:
         sys.stderr.write('^C\n')
         return 3
 
 
+def main():
+    return run()
+
+
 if __name__ == "__main__":
     exit(main())
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import socket
+
+# Commands that vpnpd runs for the client, others need the terminal or stdin of the client
+SERVED = ('status', 'health', 'refresh', 'add-route', 'del-route', 'add-domain', 'del-domain', 'info',
+          'which', 'check')
+
+
+def socket_path():
+    """
+    The socket of vpnpd, in the cache directory of Settings.cache_dir('vpnpd')
+    """
+    root = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(root, 'vpn-porthole', 'vpnpd', 'vpnpd.sock')
+
+
+def served(argv):
+    """
+    Whether vpnpd can run the command, one that reads a route file or stdin runs here
+    """
+    if os.environ.get('VPNP_NO_DAEMON'):
+        return False
+    if not argv or argv[0] not in SERVED:
+        return False
+    return not any(a in ('-', '-f', '--file') or a.startswith('--file=') for a in argv[1:])
+
+
+def call(argv, path=None):
+    """
+    Run the command in vpnpd, passing on its output, returns the exitcode, or None if vpnpd is not
+    running or the command needs to ask for e.g. a password. A vpnpd that fails part way returns
+    3, rather than running the command twice
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path or socket_path())
+    except OSError:
+        sock.close()
+        return None
+
+    with sock, sock.makefile('rwb') as fh:
+        try:
+            fh.write(json.dumps({'argv': argv}).encode('utf-8') + b'\n')
+            fh.flush()
+            for line in fh:
+                msg = json.loads(line.decode('utf-8'))
+                if 'exitcode' in msg:
+                    return msg['exitcode']
+                if 'unattended' in msg:
+                    return None
+                stream = sys.stdout if 'stdout' in msg else sys.stderr
+                stream.write(msg.get('stdout', msg.get('stderr')))
+                stream.flush()
+        except (OSError, ValueError) as e:
+            sys.stderr.write('! Lost vpnpd: %s\n' % e)
+            return 3
+    sys.stderr.write('! vpnpd closed the connection\n')
+    return 3
+
+
+def main():
+    argv = sys.argv[1:]
+    if served(argv):
+        exitcode = call(argv)
+        if exitcode is not None:
+            return exitcode
+
+    from vpnporthole.cli import run
+    return run(argv)
+
+
+if __name__ == "__main__":
+    exit(main())
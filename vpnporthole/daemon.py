@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import threading
+import traceback
+import socketserver
+
+from docker.client import from_env
+
+from vpnporthole import cli
+from vpnporthole.client import served, socket_path
+from vpnporthole.lock import running
+from vpnporthole.session import Session
+from vpnporthole.settings import Settings
+from vpnporthole.system import SystemCalls
+from vpnporthole.argparsetree import ArgParseTree
+
+
+class Unattended(BaseException):
+    """
+    Raised for what vpnpd would have to ask for, e.g. a blank sudo password or username, so the
+    client runs the command itself. Not an Exception, so that the commands pass it on
+    """
+
+
+def unattended(text, secret):
+    raise Unattended(text)
+
+
+class ThreadStreams(object):
+    """
+    Stands in for sys.stdout or sys.stderr, writing to the stream that the current thread uses,
+    else to the default
+    """
+    def __init__(self, default):
+        self.__default = default
+        self.__local = threading.local()
+
+    def use(self, stream):
+        self.__local.stream = stream
+
+    def __getattr__(self, name):
+        return getattr(getattr(self.__local, 'stream', None) or self.__default, name)
+
+
+class Reply(object):
+    """
+    A text stream that keeps what is written as messages of {name: text} for the client, which
+    are only sent once the command has run, as the client may have to run it again itself
+    """
+    encoding = 'utf-8'
+
+    def __init__(self, messages, name):
+        self.__messages = messages
+        self.__name = name
+
+    def write(self, text):
+        if text:
+            self.__messages.append({self.__name: text})
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+class Sessions(object):
+    """
+    The settings of each profile, reloaded when its files change, and a Docker client per Docker
+    environment, shared by the commands that vpnpd runs
+    """
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__envs = {}  # profile name: (Settings, docker env)
+        self.__clients = {}  # docker env: APIClient
+
+    def new_settings(self, profile_name):
+        with self.__lock:
+            return Settings.load(profile_name, prompt=unattended)
+
+    def new_session(self, profile_name):
+        settings = self.new_settings(profile_name)
+        with self.__lock:
+            cached = self.__envs.get(profile_name)
+        if cached and cached[0] is settings:
+            env = cached[1]
+        else:
+            env = SystemCalls('vpnpd', settings).get_docker_env()
+            with self.__lock:
+                self.__envs[profile_name] = (settings, env)
+
+        key = json.dumps(env, sort_keys=True)
+        with self.__lock:
+            if key not in self.__clients:
+                self.__clients[key] = from_env(environment=env).api
+            client = self.__clients[key]
+        return settings, Session(settings, docker_client=client)
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Handler(socketserver.StreamRequestHandler):
+    """
+    Reads {"argv": [...]} and runs the command, replying with its output as {"stdout": text} and
+    {"stderr": text}, then {"exitcode": n}. Replies {"unattended": text} instead if the command
+    needs what only the client can ask for
+    """
+    def handle(self):
+        try:
+            argv = [str(a) for a in json.loads(self.rfile.readline().decode('utf-8'))['argv']]
+        except (ValueError, KeyError, TypeError):
+            return
+
+        messages = []
+        sys.stdout.use(Reply(messages, 'stdout'))
+        sys.stderr.use(Reply(messages, 'stderr'))
+        try:
+            messages.append({'exitcode': run(argv)})
+        except Unattended as e:
+            messages = [{'unattended': str(e)}]
+        finally:
+            sys.stdout.use(None)
+            sys.stderr.use(None)
+        try:
+            for msg in messages:
+                self.wfile.write(json.dumps(msg).encode('utf-8') + b'\n')
+            self.wfile.flush()
+        except OSError:
+            pass  # The client has gone
+
+
+def run(argv):
+    if not served(argv):
+        sys.stderr.write('! vpnpd does not run "%s"\n' % ' '.join(argv[:1]))
+        return 2
+    try:
+        exitcode = cli.run(argv)
+    except SystemExit as e:  # --help, and usage errors
+        exitcode = e.code if isinstance(e.code, int) else 0 if e.code is None else 1
+    except Exception:
+        sys.stderr.write('! %s' % traceback.format_exc())
+        exitcode = 3
+    return exitcode or 0
+
+
+class Daemon(ArgParseTree):
+    """\
+    vpn-porthole daemon
+
+    Runs vpnp commands sent by the vpnp client over a Unix socket, reusing the settings and the
+    Docker client across commands
+    """
+    def args(self, parser):
+        parser.add_argument('--detach', default=False, action='store_true',
+                            help="Run in the background, if not already running")
+        parser.add_argument('--stop', default=False, action='store_true',
+                            help="Stop the background daemon")
+
+    def run(self, args):
+        cache_dir = Settings.cache_dir('vpnpd')
+        path = socket_path()
+        pid_file = os.path.join(cache_dir, 'vpnpd.pid')
+        if args.stop:
+            pid = running(pid_file)
+            if not pid:
+                sys.stderr.write('! vpnpd is not running\n')
+                return 1
+            import signal
+            os.kill(pid, signal.SIGTERM)
+            return 0
+
+        if running(pid_file):
+            if args.detach:
+                return 0
+            sys.stderr.write('! vpnpd is already running\n')
+            return 1
+        if args.detach:
+            import subprocess
+            argv = [sys.executable, '-m', 'vpnporthole.daemon']
+            with open(os.devnull, 'r+b') as devnull, open(os.path.join(cache_dir, 'vpnpd.log'), 'ab') as log:
+                subprocess.Popen(argv, stdin=devnull, stdout=devnull, stderr=log, start_new_session=True)
+            return 0
+
+        if os.path.exists(path):
+            os.unlink(path)
+        server = Server(path, Handler)
+        os.chmod(path, 0o600)
+
+        import signal
+
+        def shutdown(*_):
+            threading.Thread(target=server.shutdown).start()
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+
+        sys.stdout = ThreadStreams(sys.stdout)
+        sys.stderr = ThreadStreams(sys.stderr)
+        sessions = Sessions()
+        cli.new_settings = sessions.new_settings
+        cli.new_session = sessions.new_session
+        with open(pid_file, 'wt') as fh:
+            fh.write('%d\n' % os.getpid())
+        try:
+            sys.stderr.write('vpnpd on %s\n' % path)
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.unlink(path)
+            os.unlink(pid_file)
+        return 0
+
+
+def main():
+    return Daemon().main()
+
+
+if __name__ == "__main__":
+    exit(main())
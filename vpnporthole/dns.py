@@ -0,0 +1,470 @@
+import os
+import sys
+import json
+import time
+import struct
+import asyncio
+from collections import OrderedDict
+
+TYPE_A = 1
+TYPE_SOA = 6
+TYPE_OPT = 41
+RCODE_SERVFAIL = 2
+RCODE_NXDOMAIN = 3
+RCODE_REFUSED = 5
+FLAG_QR = 0x8000
+FLAG_TC = 0x0200
+FLAG_RA = 0x0080
+
+
+def read_name(msg, offset):
+    """
+    Read a possibly compressed domain name, returns (name, offset after the name)
+
+    >>> read_name(b'\\x03www\\x07example\\x03org\\x00', 0)
+    ('www.example.org', 17)
+    """
+    labels = []
+    end = None
+    jumps = 0
+    while True:
+        length = msg[offset]
+        if length & 0xC0 == 0xC0:
+            if end is None:
+                end = offset + 2
+            jumps += 1
+            if jumps > 16:
+                raise ValueError('DNS name compression loop')
+            offset = struct.unpack_from('!H', msg, offset)[0] & 0x3FFF
+            continue
+        offset += 1
+        if length == 0:
+            break
+        labels.append(msg[offset:offset + length].decode('ascii', 'replace'))
+        offset += length
+    return '.'.join(labels), end if end is not None else offset
+
+
+def parse_question(msg):
+    """
+    Returns (id, flags, (qname, qtype, qclass), offset after the question)
+    """
+    if len(msg) < 12:
+        raise ValueError('Short DNS message')
+    msg_id, flags, qdcount = struct.unpack_from('!HHH', msg, 0)
+    if qdcount != 1:
+        raise ValueError('Expected one question, got %d' % qdcount)
+    qname, offset = read_name(msg, 12)
+    qtype, qclass = struct.unpack_from('!HH', msg, offset)
+    return msg_id, flags, (qname.lower().rstrip('.'), qtype, qclass), offset + 4
+
+
+def records(msg):
+    """
+    The resource records of a response as [(section, rtype, ttl_offset, ttl, rdata_offset), ...]
+    where section is 0 for answers, 1 for authority and 2 for additional
+    """
+    counts = struct.unpack_from('!HHH', msg, 6)
+    _, _, _, offset = parse_question(msg)
+    ret = []
+    for section, count in enumerate(counts):
+        for _ in range(count):
+            _, offset = read_name(msg, offset)
+            rtype, _, ttl, rdlength = struct.unpack_from('!HHIH', msg, offset)
+            ret.append((section, rtype, offset + 4, ttl, offset + 10))
+            offset += 10 + rdlength
+    return ret
+
+
+def a_records(msg):
+    """
+    The addresses in the answer section of a response as [(ip, ttl), ...]
+    """
+    ret = []
+    for section, rtype, _, ttl, rdata in records(msg):
+        if section == 0 and rtype == TYPE_A:
+            ret.append(('%d.%d.%d.%d' % struct.unpack_from('!BBBB', msg, rdata), ttl))
+    return ret
+
+
+def longest_suffix(table, qname):
+    """
+    The value in table of the longest domain that qname is, or is in, or None
+
+    >>> longest_suffix({'example.org': 1, 'dev.example.org': 2}, 'www.dev.example.org')
+    2
+    """
+    labels = qname.split('.')
+    for i in range(len(labels)):
+        value = table.get('.'.join(labels[i:]))
+        if value:
+            return value
+    return None
+
+
+def error_response(query, rcode):
+    """
+    A response to query with no records and the given rcode
+    """
+    msg_id, flags, _, end = parse_question(query)
+    flags = FLAG_QR | FLAG_RA | (flags & 0x7900) | rcode
+    return struct.pack('!HHHHHH', msg_id, flags, 1, 0, 0, 0) + query[12:end]
+
+
+class DnsCache(object):
+    """
+    A size bounded LRU cache of DNS responses for their TTL, capped at max_ttl. Negative
+    responses (NXDOMAIN, or no answer) are cached for the SOA minimum, capped at negative_ttl
+    """
+    def __init__(self, max_entries=10000, max_ttl=3600, negative_ttl=60, clock=time.monotonic):
+        self.__entries = OrderedDict()
+        self.__max_entries = max_entries
+        self.__max_ttl = max_ttl
+        self.__negative_ttl = negative_ttl
+        self.__clock = clock
+        self.stats = {'hits': 0, 'negative_hits': 0, 'misses': 0, 'evictions': 0}
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get(self, key, msg_id):
+        """
+        The cached response for key with msg_id and the TTLs reduced by its age, or None
+        """
+        entry = self.__entries.get(key)
+        now = self.__clock()
+        if entry is None or entry[0] <= now:
+            if entry is not None:
+                del self.__entries[key]
+            self.stats['misses'] += 1
+            return None
+        expires, stored, response, ttls, negative = entry
+        self.__entries.move_to_end(key)
+        self.stats['negative_hits' if negative else 'hits'] += 1
+
+        msg = bytearray(response)
+        struct.pack_into('!H', msg, 0, msg_id)
+        age = int(now - stored)
+        for offset, ttl in ttls:
+            struct.pack_into('!I', msg, offset, max(0, ttl - age))
+        return bytes(msg)
+
+    def clear(self):
+        self.__entries.clear()
+
+    def put(self, key, response):
+        if self.__max_entries <= 0:
+            return
+        _, flags, _, _ = parse_question(response)
+        rcode = flags & 0xF
+        if flags & FLAG_TC or rcode not in (0, RCODE_NXDOMAIN):
+            return
+        rrs = [rr for rr in records(response) if rr[1] != TYPE_OPT]
+        answers = [rr for rr in rrs if rr[0] == 0]
+        negative = rcode == RCODE_NXDOMAIN or not answers
+        if negative:
+            ttl = self.__negative_ttl
+            for section, rtype, _, rr_ttl, rdata in rrs:
+                if section == 1 and rtype == TYPE_SOA:
+                    # The SOA minimum is the last field of its rdata
+                    _, offset = read_name(response, rdata)
+                    _, offset = read_name(response, offset)
+                    minimum = struct.unpack_from('!I', response, offset + 16)[0]
+                    ttl = min(ttl, rr_ttl, minimum)
+        else:
+            ttl = min([self.__max_ttl] + [rr[3] for rr in rrs])
+        if ttl <= 0:
+            return
+
+        now = self.__clock()
+        self.__entries[key] = (now + ttl, now, response, [(rr[2], rr[3]) for rr in rrs], negative)
+        self.__entries.move_to_end(key)
+        while len(self.__entries) > self.__max_entries:
+            self.__entries.popitem(last=False)
+            self.stats['evictions'] += 1
+
+
+class _UpstreamProtocol(asyncio.DatagramProtocol):
+    def __init__(self, query, future):
+        self.__query = query
+        self.__future = future
+
+    def connection_made(self, transport):
+        transport.sendto(self.__query)
+
+    def datagram_received(self, data, addr):
+        if not self.__future.done() and data[:2] == self.__query[:2]:
+            self.__future.set_result(data)
+
+    def error_received(self, exc):
+        if not self.__future.done():
+            self.__future.set_exception(exc)
+
+
+class _ServerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, forwarder):
+        self.__forwarder = forwarder
+        self.__transport = None
+
+    def connection_made(self, transport):
+        self.__transport = transport
+
+    def datagram_received(self, data, addr):
+        asyncio.ensure_future(self.__reply(data, addr))
+
+    async def __reply(self, data, addr):
+        response = await self.__forwarder.resolve(data)
+        if response:
+            self.__transport.sendto(response, addr)
+
+
+class AddressSets(object):
+    """
+    Adds the addresses that routed domains resolve to to their kernel sets, for the TTL of the
+    answer (at least min_timeout). The additions of concurrent answers are written in one batch
+    by write([(set, ip, timeout), ...]), run in a thread, and an answer with a new address is only
+    returned once that is written, so that the first connection to it is routed. Addresses are
+    rewritten at most every interval seconds, e.g. in case the set was recreated. Failed writes
+    are reported on stderr (default: sys.stderr)
+    """
+    def __init__(self, write, min_timeout=60, interval=10, clock=time.monotonic, stderr=None):
+        self.__write = write
+        self.__stderr = stderr
+        self.__min_timeout = min_timeout
+        self.__interval = interval
+        self.__clock = clock
+        self.__routes = {}
+        self.__known = {}  # (set, ip): time until which it needs no rewrite
+        self.__pending = {}  # (set, ip): timeout
+        self.__next = None  # future of the write of the pending additions
+        self.__writer = None
+        self.stats = {'set_additions': 0, 'set_writes': 0, 'set_errors': 0}
+
+    def set_routes(self, routes):
+        """
+        routes: {domain: set name}
+        """
+        self.__routes = dict((domain.lower().rstrip('.'), name) for domain, name in routes.items())
+        names = set(self.__routes.values())
+        for key in [key for key in self.__known if key[0] not in names]:
+            del self.__known[key]
+
+    async def add(self, qname, response):
+        name = longest_suffix(self.__routes, qname)
+        if not name:
+            return
+        try:
+            addresses = a_records(response)
+        except (ValueError, IndexError, struct.error):
+            return
+        now = self.__clock()
+        new = False
+        for ip, ttl in addresses:
+            key = (name, ip)
+            if self.__known.get(key, 0) > now:
+                continue
+            self.__pending[key] = max(ttl, self.__min_timeout, self.__pending.get(key, 0))
+            new = True
+        if new:
+            if self.__next is None:
+                self.__next = asyncio.get_event_loop().create_future()
+            if self.__writer is None:
+                self.__writer = asyncio.ensure_future(self.__flush())
+            await asyncio.shield(self.__next)
+
+    async def __flush(self):
+        loop = asyncio.get_event_loop()
+        try:
+            while self.__next is not None:
+                done, self.__next = self.__next, None
+                pending, self.__pending = self.__pending, {}
+                entries = sorted((name, ip, timeout) for (name, ip), timeout in pending.items())
+                try:
+                    await loop.run_in_executor(None, self.__write, entries)
+                    self.stats['set_writes'] += 1
+                    self.stats['set_additions'] += len(entries)
+                    now = self.__clock()
+                    for (name, ip), timeout in pending.items():
+                        self.__known[(name, ip)] = now + min(timeout, self.__interval)
+                except Exception as e:
+                    self.stats['set_errors'] += 1
+                    (self.__stderr or sys.stderr).write('! Unable to add addresses to the routed sets: %s\n' % e)
+                done.set_result(None)
+            now = self.__clock()
+            for key in [key for key, until in self.__known.items() if until <= now]:
+                del self.__known[key]
+        finally:
+            self.__writer = None
+
+
+class Forwarder(object):
+    """
+    Forwards DNS queries to upstream servers by longest domain suffix match, through a cache.
+    Identical queries in flight at the same time share one upstream query. The addresses in the
+    answers for routed domains are added to their AddressSets
+    """
+    def __init__(self, cache, timeout=2.0, port=53, sets=None):
+        self.__cache = cache
+        self.__sets = sets
+        self.__timeout = timeout
+        self.__port = port
+        self.__routes = {}
+        self.__inflight = {}
+        self.stats = {'queries': 0, 'refused': 0, 'upstream_queries': 0, 'upstream_errors': 0,
+                      'upstream_seconds_total': 0.0, 'upstream_seconds_max': 0.0}
+
+    def set_routes(self, routes, routed=None):
+        """
+        routes: {domain: [upstream address, ...]}, routed: {routed domain: set name}. The cached
+        responses are dropped when the routes change, as they may be from the old upstreams
+        """
+        routes = dict((domain.lower().rstrip('.'), list(upstreams))
+                      for domain, upstreams in routes.items() if upstreams)
+        if routes != self.__routes:
+            self.__cache.clear()
+        self.__routes = routes
+        if self.__sets:
+            self.__sets.set_routes(routed or {})
+
+    def upstreams(self, qname):
+        return longest_suffix(self.__routes, qname)
+
+    def counters(self):
+        ret = dict(self.stats)
+        ret.update(self.__cache.stats)
+        if self.__sets:
+            ret.update(self.__sets.stats)
+        ret['cache_entries'] = len(self.__cache)
+        ret['domains'] = len(self.__routes)
+        return ret
+
+    def write_stats(self, path):
+        with open(path + '.tmp', 'wt') as fh:
+            json.dump({'time': time.time(), 'counters': self.counters(), 'routes': self.__routes},
+                      fh, sort_keys=True)
+        os.replace(path + '.tmp', path)
+
+    async def resolve(self, query, tcp=False):
+        self.stats['queries'] += 1
+        try:
+            msg_id, flags, key, _ = parse_question(query)
+        except (ValueError, IndexError, struct.error):
+            return None
+        if flags & FLAG_QR:
+            return None
+
+        upstreams = self.upstreams(key[0])
+        if not upstreams:
+            self.stats['refused'] += 1
+            return error_response(query, RCODE_REFUSED)
+        cached = self.__cache.get(key, msg_id)
+        if cached:
+            if self.__sets:
+                await self.__sets.add(key[0], cached)
+            return cached
+
+        inflight = self.__inflight.get((key, tcp))
+        if inflight is None:
+            inflight = asyncio.ensure_future(self.__forward(query, key, upstreams, tcp))
+            self.__inflight[(key, tcp)] = inflight
+            inflight.add_done_callback(lambda _: self.__inflight.pop((key, tcp), None))
+        response = await asyncio.shield(inflight)
+        if response is None:
+            return error_response(query, RCODE_SERVFAIL)
+        if self.__sets:
+            await self.__sets.add(key[0], response)
+        return struct.pack('!H', msg_id) + response[2:]
+
+    async def __forward(self, query, key, upstreams, tcp):
+        for upstream in upstreams:
+            self.stats['upstream_queries'] += 1
+            start = time.perf_counter()
+            try:
+                if tcp:
+                    response = await asyncio.wait_for(self.__query_tcp(query, upstream), self.__timeout)
+                else:
+                    response = await asyncio.wait_for(self.__query_udp(query, upstream), self.__timeout)
+            except (OSError, asyncio.TimeoutError, EOFError, asyncio.IncompleteReadError):
+                self.stats['upstream_errors'] += 1
+                continue
+            seconds = time.perf_counter() - start
+            self.stats['upstream_seconds_total'] += seconds
+            self.stats['upstream_seconds_max'] = max(self.stats['upstream_seconds_max'], seconds)
+            try:
+                self.__cache.put(key, response)
+            except (ValueError, IndexError, struct.error):
+                pass
+            return response
+        return None
+
+    async def __query_udp(self, query, upstream):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        transport, _ = await loop.create_datagram_endpoint(lambda: _UpstreamProtocol(query, future),
+                                                           remote_addr=(upstream, self.__port))
+        try:
+            return await future
+        finally:
+            transport.close()
+
+    async def __query_tcp(self, query, upstream):
+        reader, writer = await asyncio.open_connection(upstream, self.__port)
+        try:
+            writer.write(struct.pack('!H', len(query)) + query)
+            length = struct.unpack('!H', await reader.readexactly(2))[0]
+            return await reader.readexactly(length)
+        finally:
+            writer.close()
+
+    async def handle_tcp(self, reader, writer):
+        try:
+            while True:
+                length = struct.unpack('!H', await reader.readexactly(2))[0]
+                response = await self.resolve(await reader.readexactly(length), tcp=True)
+                if response is None:
+                    break
+                writer.write(struct.pack('!H', len(response)) + response)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+def serve(forwarder, listen, port, refresh, interval=10, stats_file=None, stderr=None):
+    """
+    Serve DNS on UDP and TCP until SIGTERM or SIGINT, calling refresh() every interval
+    seconds (in a thread) for the forwarder routes and routed domains, and writing the counters
+    to stats_file. Failed refreshes are reported on stderr (default: sys.stderr)
+    """
+    import signal
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    transport, _ = loop.run_until_complete(
+        loop.create_datagram_endpoint(lambda: _ServerProtocol(forwarder), local_addr=(listen, port)))
+    server = loop.run_until_complete(asyncio.start_server(forwarder.handle_tcp, listen, port))
+
+    async def housekeeping():
+        while True:
+            try:
+                forwarder.set_routes(*await loop.run_in_executor(None, refresh))
+            except Exception as e:
+                (stderr or sys.stderr).write('! Unable to refresh DNS routes: %s\n' % e)
+            if stats_file:
+                forwarder.write_stats(stats_file)
+            await asyncio.sleep(interval)
+
+    task = loop.create_task(housekeeping())
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, task.cancel)
+    try:
+        loop.run_until_complete(task)
+    except asyncio.CancelledError:
+        pass
+    finally:
+        if stats_file:
+            forwarder.write_stats(stats_file)
+        transport.close()
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        asyncio.set_event_loop(None)
+        loop.close()
@@ -0,0 +1,33 @@
+class VpnpError(Exception):
+    """
+    Base of the errors that vpn-porthole raises, exitcode is that of the vpnp CLI for it
+    """
+    exitcode = 3
+
+
+class ConfigError(VpnpError):
+    """
+    A settings or profile file that cannot be read or does not validate
+    """
+
+
+class ProfileNameError(ConfigError):
+    exitcode = 1
+
+
+class BuildError(VpnpError):
+    pass
+
+
+class SudoError(VpnpError):
+    pass
+
+
+class DockerEnvError(VpnpError):
+    """
+    The Docker environment, e.g. of a docker-machine, could not be found
+    """
+
+
+class LockTimeout(VpnpError):
+    exitcode = 1
@@ -43,6 +43,8 @@ class IPv4Subnet(object):
         else:
             base, size = cidr.split('/', 1)
         self._size = int(size)
+        if not 0 <= self._size <= 32:
+            raise ValueError('Bad prefix length in "%s"' % cidr)
         base = self.__mask(IPv4Address(base).int, self._size)
         self._ip = IPv4Address(base)
 
@@ -60,6 +62,14 @@ class IPv4Subnet(object):
         addr = IPv4Address(other)
         return self.__mask(addr.int, self._size) == self.__mask(self._ip.int, self._size)
 
+    @property
+    def network(self):
+        return self._ip
+
+    @property
+    def prefixlen(self):
+        return self._size
+
     def __getitem__(self, item):
         i = int(item)
         if i >= 0:
@@ -82,6 +92,121 @@ class IPv4Subnet(object):
         return hash(self.__repr__())
 
 
+class IPv4RadixTree(object):
+    """
+    Binary radix trie of IPv4Subnets, for longest-prefix-match lookups
+
+    >>> tree = IPv4RadixTree()
+    >>> tree.add('10.0.0.0/8', 'wide')
+    >>> tree.add('10.1.2.0/24', 'narrow')
+    >>> tree.lookup('10.1.2.3')
+    (<IPv4Subnet 10.1.2.0/24>, 'narrow')
+    >>> tree.lookup('10.9.9.9')
+    (<IPv4Subnet 10.0.0.0/8>, 'wide')
+    >>> tree.lookup('192.168.0.1') is None
+    True
+    """
+    __VALUE = 2
+
+    def __init__(self):
+        self.__root = [None, None, None]
+        self.__len = 0
+
+    def __len__(self):
+        return self.__len
+
+    def add(self, subnet, value):
+        subnet = IPv4Subnet(subnet)
+        raw = subnet.network.int
+        node = self.__root
+        for i in range(subnet.prefixlen):
+            bit = (raw >> (31 - i)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        if node[self.__VALUE] is None:
+            self.__len += 1
+        node[self.__VALUE] = (subnet, value)
+
+    def lookup(self, addr, prefixlen=32):
+        """
+        Find the longest subnet containing addr, considering only subnets no longer than prefixlen
+        """
+        raw = IPv4Address(addr).int
+        node = self.__root
+        found = node[self.__VALUE]
+        for i in range(prefixlen):
+            node = node[(raw >> (31 - i)) & 1]
+            if node is None:
+                break
+            if node[self.__VALUE] is not None:
+                found = node[self.__VALUE]
+        return found
+
+
+def find_overlaps(tagged_subnets):
+    """
+    Find overlapping subnets, yields (outer, outer_tag, inner, inner_tag) for each overlap
+
+    >>> list(find_overlaps([('10.0.0.0/8', 'a'), ('192.168.0.0/24', 'b'), ('10.1.0.0/16', 'b')]))
+    [(<IPv4Subnet 10.0.0.0/8>, 'a', <IPv4Subnet 10.1.0.0/16>, 'b')]
+    """
+    items = sorted(((IPv4Subnet(subnet), tag) for subnet, tag in tagged_subnets),
+                   key=lambda item: (item[0].network.int, item[0].prefixlen))
+    # CIDR ranges either nest or are disjoint, so the open ranges form a stack
+    stack = []
+    for subnet, tag in items:
+        start = subnet.network.int
+        while stack and stack[-1][0][-1].int < start:
+            stack.pop()
+        for outer, outer_tag in stack:
+            yield outer, outer_tag, subnet, tag
+        stack.append((subnet, tag))
+
+
+def read_subnets(lines):
+    """
+    Lazily parse subnets from lines of text, skipping blank lines and # comments
+
+    >>> list(read_subnets(['10.0.0.0/24  # office', '', '10.0.1.1']))
+    [<IPv4Subnet 10.0.0.0/24>, <IPv4Subnet 10.0.1.1/32>]
+    """
+    for lineno, line in enumerate(lines, 1):
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        try:
+            yield IPv4Subnet(line)
+        except (ValueError, AssertionError):
+            raise ValueError('Bad subnet on line %d: "%s"' % (lineno, line))
+
+
+def collapse_subnets(subnets):
+    """
+    Aggregate subnets into the fewest subnets covering the same addresses
+
+    >>> collapse_subnets(['10.0.1.0/24', '10.0.0.0/24', '10.0.0.128/25', '10.0.3.0/24'])
+    [<IPv4Subnet 10.0.0.0/23>, <IPv4Subnet 10.0.3.0/24>]
+    """
+    items = sorted((IPv4Subnet(subnet) for subnet in subnets),
+                   key=lambda subnet: (subnet.network.int, subnet.prefixlen))
+    stack = []
+    for subnet in items:
+        if stack and subnet in stack[-1]:
+            continue
+        stack.append(subnet)
+        while len(stack) > 1:
+            low, high = stack[-2], stack[-1]
+            size = low.prefixlen
+            if size == 0 or high.prefixlen != size:
+                break
+            span = 1 << (32 - size)
+            if low.network.int & span or high.network.int != low.network.int + span:
+                break
+            stack[-2:] = [IPv4Subnet('%s/%d' % (low.network, size - 1))]
+    return stack
+
+
 def ip_to_int(addr):
     fields = addr.split('.')
     assert len(fields) == 4
@@ -0,0 +1,117 @@
+import os
+import sys
+import json
+import time
+import fcntl
+import functools
+import threading
+
+from vpnporthole.exceptions import LockTimeout
+
+
+class Lock(object):
+    """
+    An exclusive fcntl lock on a file, reentrant within a thread, that records its holder so
+    that a process kept waiting can say who holds it. The lock goes with the process, so one
+    that is killed never leaves it held
+    """
+    __held = {}  # (path, thread): [file, depth]
+
+    def __init__(self, path, timeout=60, name=None, stderr=None):
+        """
+        A wait of over a second is noted on stderr (default: sys.stderr)
+        """
+        self.__path = path
+        self.__timeout = timeout
+        self.__name = name or os.path.splitext(os.path.basename(path))[0]
+        self.__stderr = stderr
+
+    def holder(self):
+        """
+        The pid, argv and since time of the last holder as a dict, or None
+        """
+        try:
+            with open(self.__path, 'rt') as fh:
+                return json.loads(fh.read())
+        except (IOError, ValueError):
+            return None
+
+    def describe_holder(self):
+        holder = self.holder()
+        if not holder:
+            return 'an unknown process'
+        argv = [os.path.basename(holder['argv'][0])] + holder['argv'][1:] if holder['argv'] else []
+        return 'pid %d "%s" for %ds' % (holder['pid'], ' '.join(argv), time.time() - holder['since'])
+
+    def __enter__(self):
+        key = (self.__path, threading.get_ident())
+        held = self.__held.get(key)
+        if held:
+            held[1] += 1
+            return self
+
+        fh = open(self.__path, 'a+')
+        start = time.time()
+        interval = 0.01
+        waiting = False
+        while True:
+            try:
+                fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                waited = time.time() - start
+                if waited >= self.__timeout:
+                    holder = self.describe_holder()
+                    fh.close()
+                    raise LockTimeout('Timed out after %ds waiting for the %s lock, held by %s' % (
+                        self.__timeout, self.__name, holder))
+                if not waiting and waited >= 1:
+                    (self.__stderr or sys.stderr).write('Waiting for the %s lock, held by %s\n' % (
+                        self.__name, self.describe_holder()))
+                    waiting = True
+                time.sleep(interval)
+                interval = min(interval * 2, 0.2)
+
+        fh.seek(0)
+        fh.truncate()
+        json.dump({'pid': os.getpid(), 'argv': sys.argv, 'since': time.time()}, fh)
+        fh.flush()
+        self.__held[key] = [fh, 1]
+        return self
+
+    def __exit__(self, *args):
+        key = (self.__path, threading.get_ident())
+        held = self.__held[key]
+        held[1] -= 1
+        if held[1]:
+            return
+        del self.__held[key]
+        fh = held[0]
+        fh.truncate(0)
+        fh.flush()
+        fcntl.flock(fh, fcntl.LOCK_UN)
+        fh.close()
+
+
+def running(pid_file):
+    """
+    The pid in pid_file if that process is running, else None
+    """
+    try:
+        with open(pid_file, 'rt') as fh:
+            pid = int(fh.read().strip())
+        os.kill(pid, 0)
+        return pid
+    except (IOError, ValueError, ProcessLookupError):
+        return None
+
+
+def locked(method):
+    """
+    Run the method holding the lock given by self._lock()
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock():
+            return method(self, *args, **kwargs)
+    return wrapper
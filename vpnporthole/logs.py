@@ -0,0 +1,101 @@
+import os
+import re
+import time
+
+
+def iter_lines(chunks, max_line=64 * 1024):
+    """
+    Reassemble a stream of text or byte chunks into lines, holding at most max_line
+    characters of an incomplete line
+
+    >>> list(iter_lines([b'one\\ntw', 'o\\nthr', b'ee']))
+    ['one\\n', 'two\\n', 'three']
+    """
+    partial = []
+    size = 0
+    for chunk in chunks:
+        if isinstance(chunk, bytes):
+            chunk = chunk.decode('utf-8', 'replace')
+        start = 0
+        while True:
+            end = chunk.find('\n', start)
+            if end < 0:
+                break
+            partial.append(chunk[start:end + 1])
+            yield ''.join(partial)
+            partial = []
+            size = 0
+            start = end + 1
+        if start < len(chunk):
+            partial.append(chunk[start:])
+            size += len(chunk) - start
+            if size > max_line:
+                yield ''.join(partial)
+                partial = []
+                size = 0
+    if partial:
+        yield ''.join(partial)
+
+
+def parse_since(value):
+    """
+    Convert a relative duration (e.g. "90s", "10m", "2h", "1d") or an epoch to an epoch
+
+    >>> parse_since('1500000000')
+    1500000000
+    """
+    m = re.match(r'^(?P<count>\d+)(?P<unit>[smhd]?)$', value.strip())
+    if not m:
+        raise ValueError('Bad time "%s", expected e.g.: 10m, 2h, 1d or an epoch' % value)
+    count = int(m.group('count'))
+    unit = m.group('unit')
+    if not unit:
+        return count
+    seconds = count * {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[unit]
+    return int(time.time()) - seconds
+
+
+class RotatingLog(object):
+    """
+    Writes lines to a log file capped at max_bytes of UTF-8, rotated to path.1 ... path.<backups>
+    """
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backups=5):
+        self.__path = path
+        self.__max_bytes = max_bytes
+        self.__backups = backups
+        self.__fh = None
+        self.__size = 0
+        self.__open()
+
+    @property
+    def path(self):
+        return self.__path
+
+    def __open(self):
+        self.__fh = open(self.__path, 'ab')
+        self.__size = self.__fh.tell()
+
+    def __rotate(self):
+        self.__fh.close()
+        for i in range(self.__backups - 1, 0, -1):
+            src = '%s.%d' % (self.__path, i)
+            if os.path.exists(src):
+                os.rename(src, '%s.%d' % (self.__path, i + 1))
+        if self.__backups > 0:
+            os.rename(self.__path, '%s.1' % self.__path)
+        else:
+            os.unlink(self.__path)
+        self.__open()
+
+    def write(self, line):
+        data = line.encode('utf-8', 'replace')
+        if self.__size and self.__size + len(data) > self.__max_bytes:
+            self.__rotate()
+        self.__fh.write(data)
+        self.__size += len(data)
+
+    def flush(self):
+        self.__fh.flush()
+
+    def close(self):
+        self.__fh.close()
@@ -0,0 +1,97 @@
+import os
+import time
+
+# name: (type, help)
+FAMILIES = (
+    ('vpnp_up', 'gauge', 'Whether the profile has a running container'),
+    ('vpnp_tunnel_info', 'gauge', 'The running containers of the profile and their IPs'),
+    ('vpnp_tunnel_uptime_seconds', 'gauge', 'Seconds since the container started'),
+    ('vpnp_routes', 'gauge', 'Routes installed via the containers'),
+    ('vpnp_domains', 'gauge', 'DNS domains installed for the profile'),
+    ('vpnp_health_exit_code', 'gauge', 'Exit code of the last health hook run'),
+    ('vpnp_health_duration_seconds', 'gauge', 'Duration of the last health hook run'),
+    ('vpnp_health_timestamp_seconds', 'gauge', 'Time of the last health hook run'),
+    ('vpnp_reconnects_total', 'counter', 'Restarts of the profile'),
+    ('vpnp_tun_receive_bytes_total', 'counter', 'Bytes received on the tunnel interface in the container'),
+    ('vpnp_tun_transmit_bytes_total', 'counter', 'Bytes sent on the tunnel interface in the container'),
+    ('vpnp_dns_total', 'counter', 'Counters of the split-DNS forwarder'),
+    ('vpnp_dns', 'gauge', 'Cache size, domains and slowest upstream query of the split-DNS forwarder'),
+    ('vpnp_scrape_errors', 'gauge', 'Whether the profile could not be inspected'),
+)
+
+# Values of the split-DNS forwarder stats that are not counters
+DNS_GAUGES = ('cache_entries', 'domains', 'upstream_seconds_max')
+
+
+def escape(value):
+    """
+    A label value with backslash, double quote and newline escaped
+
+    >>> print(escape('say "hi"'))
+    say \\"hi\\"
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render(samples):
+    """
+    The Prometheus text format of samples as [(name, {label: value}, value), ...], grouped by
+    family in the order of FAMILIES
+    """
+    lines = []
+    for name, kind, help in FAMILIES:
+        family = [s for s in samples if s[0] == name]
+        if not family:
+            continue
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for _, labels, value in family:
+            label_text = ','.join('%s="%s"' % (k, escape(v)) for k, v in sorted(labels.items()))
+            lines.append('%s{%s} %s' % (name, label_text, repr(float(value)) if isinstance(value, float) else value))
+    return '\n'.join(lines) + '\n'
+
+
+def profile_samples(profile, metrics, now=None):
+    """
+    Samples of a profile from Session.metrics()
+    """
+    now = now or time.time()
+    p = {'profile': profile}
+    samples = [('vpnp_up', p, 1 if metrics['tunnels'] else 0),
+               ('vpnp_routes', p, metrics['routes']),
+               ('vpnp_domains', p, metrics['domains']),
+               ('vpnp_reconnects_total', p, metrics['reconnects'])]
+    for tunnel in metrics['tunnels']:
+        t = dict(p, ip=tunnel['ip'] or '')
+        samples.append(('vpnp_tunnel_info', dict(t, container=tunnel['container']), 1))
+        if tunnel['started']:
+            samples.append(('vpnp_tunnel_uptime_seconds', t, max(0, int(now - tunnel['started']))))
+        for interface, (rx, tx) in sorted(tunnel['interfaces'].items()):
+            samples.append(('vpnp_tun_receive_bytes_total', dict(t, interface=interface), rx))
+            samples.append(('vpnp_tun_transmit_bytes_total', dict(t, interface=interface), tx))
+    health = metrics['health']
+    # A health hook that could not be run has no exit code
+    if health and isinstance(health.get('exitcode'), int):
+        samples.append(('vpnp_health_exit_code', p, health['exitcode']))
+        samples.append(('vpnp_health_duration_seconds', p, float(health['seconds'])))
+        samples.append(('vpnp_health_timestamp_seconds', p, health['time']))
+    return samples
+
+
+def dns_samples(stats):
+    """
+    Samples of the split-DNS forwarder counters from its stats file, the ones that can go down
+    as gauges
+    """
+    return [('vpnp_dns' if name in DNS_GAUGES else 'vpnp_dns_total', {'stat': name}, value)
+            for name, value in sorted(stats['counters'].items())]
+
+
+def write_textfile(path, text):
+    """
+    Replace the file atomically, so the node exporter textfile collector never reads half of it
+    """
+    temp = '%s.%d' % (path, os.getpid())
+    with open(temp, 'wt') as fh:
+        fh.write(text)
+    os.replace(temp, path)
@@ -0,0 +1,64 @@
+import ssl
+import time
+import socket
+from concurrent.futures import ThreadPoolExecutor
+
+
+def endpoint_address(endpoint, default_port=443):
+    """
+    The (host, port) of a VPN endpoint given as host, host:port, [IPv6]:port or a URL, with any
+    path, e.g. the openconnect host/usergroup form, left off. Raises ValueError if it is malformed
+
+    >>> endpoint_address('https://vpn.example.com/group')
+    ('vpn.example.com', 443)
+    >>> endpoint_address('10.1.2.3:8443')
+    ('10.1.2.3', 8443)
+    >>> endpoint_address('vpn.example.com/group')
+    ('vpn.example.com', 443)
+    >>> endpoint_address('[2001:db8::1]:8443/group')
+    ('2001:db8::1', 8443)
+    >>> endpoint_address('2001:db8::1')
+    ('2001:db8::1', 443)
+    """
+    from urllib.parse import urlsplit
+    url = urlsplit(endpoint if '://' in endpoint else '//' + endpoint)
+    if not url.hostname:
+        raise ValueError('No host in endpoint: %s' % endpoint)
+    try:
+        port = url.port
+    except ValueError:
+        if url.netloc.count(':') < 2 or '[' in url.netloc:
+            raise
+        return url.netloc, default_port  # A bare IPv6 address
+    return url.hostname, port or default_port
+
+
+def handshake(endpoint, timeout=2.0, tls=True):
+    """
+    The seconds that a TCP, and if tls a TLS, handshake with the endpoint takes, None if it fails
+    """
+    start = time.perf_counter()
+    try:
+        host, port = endpoint_address(endpoint)
+        with socket.create_connection((host, port), timeout=timeout) as sock:
+            if tls:
+                # Only the handshake time matters here, the VPN client verifies the certificate
+                context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+                with context.wrap_socket(sock, server_hostname=host):
+                    pass
+    except (OSError, ValueError):
+        return None
+    return time.perf_counter() - start
+
+
+def rank(endpoints, timeout=2.0, tls=True):
+    """
+    Handshake with the endpoints concurrently, returns [(endpoint, seconds), ...] fastest first,
+    with those that failed (seconds None) last in the given order
+    """
+    with ThreadPoolExecutor(max_workers=len(endpoints) or 1) as pool:
+        seconds = list(pool.map(lambda e: handshake(e, timeout, tls), endpoints))
+    results = list(zip(endpoints, seconds))
+    return sorted(results, key=lambda r: (r[1] is None, r[1] or 0))
@@ -1,7 +1,8 @@
-vpn = string()
+vpn = force_list(min=1)
 
 username = string(default='')
 password = string(default='')
+tunnels = integer(min=1, max=16, default=1)
 
 [subnets]
     ___many___ = boolean()
@@ -12,6 +13,28 @@ password = string(default='')
 [docker]
     machine = string(default='')
 
+[network]
+    ip = string(default='')
+
+[endpoints]
+    probe = option('tls', 'tcp', default='tls')
+    timeout = float(min=0.1, default=2.0)
+
+[routed_domains]
+    ___many___ = boolean()
+
+[routing]
+    table = integer(min=0, max=2147483646, default=0)
+    mark = integer(min=0, max=2147483647, default=0)
+
+[mtu]
+    value = integer(min=0, max=65535, default=0)
+    probe = string(default='')
+
+[standby]
+    enabled = boolean(default=False)
+    memory = string(default='256m')
+
 [build]
     [[options]]
         ___many___ = string()
@@ -20,9 +43,21 @@ password = string(default='')
         ___many___ = string()
 
 [run]
+    tunnel = string(default='tun*')
+
     [[options]]
         ___many___ = string()
 
+    [[tuning]]
+        cpuset = string(default='')
+        cpus = float(min=0, default=0)
+        memory = string(default='')
+        txqueuelen = integer(min=0, default=0)
+        [[[sysctls]]]
+            ___many___ = string()
+        [[[ulimits]]]
+            ___many___ = string()
+
     [[hooks]]
         start = string()
         up = string(default=' #!/bin/bash')
@@ -1,10 +1,35 @@
 
 [system]
     sudo = string(default='')
+    capture_lines = integer(min=0, default=1000)
+    lock_timeout = integer(min=0, default=60)
 
 [docker]
     machine = string(default='')
 
+[standby]
+    budget = string(default='1g')
+
+[network]
+    name = string(default='')
+    subnet = string(default='172.30.0.0/16')
+
+[routing]
+    tables = boolean(default=False)
+    first_table = integer(min=256, max=2147481600, default=20000)
+    priority = integer(min=2, max=32764, default=10000)
+    first_mark = integer(min=256, max=2147482000, default=30000)
+
+[dns]
+    forwarder = boolean(default=False)
+    listen = string(default='127.0.0.1')
+    port = integer(min=1, max=65535, default=5353)
+    cache_size = integer(min=0, default=10000)
+    max_ttl = integer(min=0, default=3600)
+    negative_ttl = integer(min=0, default=60)
+    timeout = float(min=0.1, default=2.0)
+    refresh = integer(min=1, default=10)
+
 [proxy]
     [[__many__]]
         http_proxy = string(default='')
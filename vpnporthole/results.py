@@ -0,0 +1,7 @@
+from collections import namedtuple
+
+ExecResult = namedtuple('ExecResult', 'exitcode lines')
+Image = namedtuple('Image', 'tag id size')
+Tunnel = namedtuple('Tunnel', 'container_id image state ip')
+SessionInfo = namedtuple('SessionInfo', ('profile images tunnels endpoint endpoints mtu mtu_source tuning network '
+                                         'table routes domains'))
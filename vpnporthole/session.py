@@ -1,19 +1,71 @@
 import os
+import re
+import json
+import time
+import uuid
+import calendar
+import shlex
+import fnmatch
 from docker.client import from_env
 from pkg_resources import resource_stream
 
-from vpnporthole.ip import IPv4Subnet
+from vpnporthole.ip import IPv4Subnet, IPv4RadixTree
+from vpnporthole.lock import Lock, locked
+from vpnporthole.exceptions import BuildError, LockTimeout
+from vpnporthole.results import Image, SessionInfo, Tunnel
 from vpnporthole.system import TmpDir, SystemCalls
 
 
 class Session(object):
     __dnsmasq_port = 53
     __ip = None
+    __ips = ()
+    # A detached container idles until the start hook is exec'd into it
+    __idle_args = ['/bin/sh', '-c', 'trap "exit 0" TERM; while :; do sleep 1; done']
+    # Run after the start hook in an idle container, so that the container ends with it
+    __end_idle = 'code=$?; kill -TERM 1; exit $code'
+    __secrets_dir = '/run/vpnp'
+    __standby_prefix = 'vpnp-standby-'
+    # The memory a standby container is counted for in the standby budget
+    __standby_label = 'vpnp.standby.memory'
+    __state = None
+    __mtu_changed = False
+    __mtu_min = 576
+    # The interfaces in the container
+    __interfaces = 'ls /sys/class/net'
+    # The interface MTUs in the container, and a binary search of the path MTU with
+    # don't-fragment pings (ICMP and IP headers are 28 bytes)
+    __mtu_interfaces = 'for i in /sys/class/net/*; do echo "${i##*/} $(cat $i/mtu)"; done'
+    __mtu_ping = ('lo=%d; hi=%d; ping -M do -c 1 -W 1 -s $lo %s >/dev/null 2>&1 || exit 1; '
+                  'while [ $lo -lt $hi ]; do mid=$(((lo + hi + 1) / 2)); '
+                  'if ping -M do -c 1 -W 1 -s $mid %s >/dev/null 2>&1; then lo=$mid; else hi=$((mid - 1)); fi; '
+                  'done; echo $((lo + 28))')
+    # The received and transmitted bytes per interface in the container
+    __tun_bytes = ('for i in /sys/class/net/*; do '
+                   'echo "${i##*/} $(cat $i/statistics/rx_bytes) $(cat $i/statistics/tx_bytes)"; done')
+    # Set the txqueuelen of the tunnel interfaces (if not 0), then print it and the given sysctls.
+    # Run as root, the image's USER may not write to /sys
+    __tuning_script = ('q=%d; for i in /sys/class/net/*; do n=${i##*/}; case $n in %s) ;; *) continue;; esac; '
+                       'if [ $q -gt 0 ]; then err=$({ echo $q > $i/tx_queue_len; } 2>&1) || echo "error $n $err"; fi; '
+                       'echo "txqueuelen $n $(cat $i/tx_queue_len)"; done; '
+                       'for k in %s; do echo "sysctl $k $(cat /proc/sys/$(echo $k | tr . /))"; done')
 
-    def __init__(self, settings):
+    def __init__(self, settings, stdout=None, stderr=None, docker_client=None, system_calls=None):
+        """
+        Output goes to stdout and stderr (default: sys.stdout and sys.stderr). A long running
+        caller can share a Docker APIClient, and pass its own SystemCalls, across sessions
+        """
         self.__settings = settings
-        self.__sc = SystemCalls(self._name(), self.__settings)
-        self.__dc = from_env(environment=self.__sc.get_docker_env()).api
+        self.__sc = system_calls or SystemCalls(self._name(), self.__settings, stdout, stderr)
+        self.__dc = docker_client or from_env(environment=self.__sc.get_docker_env()).api
+
+    def _lock(self):
+        """
+        The lock of this profile, held for operations that change its containers or routes
+        """
+        path = os.path.join(self.__settings.cache_dir('locks'), 'profile-%s.lock' % self.__settings.profile_name)
+        return Lock(path, self.__settings.lock_timeout(), 'profile "%s"' % self.__settings.profile_name,
+                    self.__sc.stderr)
 
     def _local_user(self):
         return os.environ['USER']
@@ -21,6 +73,7 @@ class Session(object):
     def _name(self):
         return "vpnp/%s_%s" % (self.__settings.profile_name, self.__settings.ctx.local.user.name,)
 
+    @locked
     def build(self):
         name = self._name()
 
@@ -43,73 +96,548 @@ class Session(object):
                 os.utime(user_file, (0, 0))
 
             stream = self.__dc.build(tmp.path, tag=name)
-            import json
             for buf in stream:
                 block = json.loads(buf.decode('utf-8'))
                 if 'stream' in block:
                     self.__sc.stdout.write(block['stream'])
                 if 'error' in block:
-                    self.__sc.stdout.write(block['error'] + '\n')
-                    exit(3)
+                    raise BuildError(block['error'].strip())
             # image = block['stream'].split()[2]
-            print("Name: %s" % name)
+            self.__sc.stdout.write("Name: %s\n" % name)
+            # Standby containers run the previous image
+            self.drain_standby()
             return True
 
-    def start(self):
-        if self.run():
+    @locked
+    def start(self, detach=False, credentials=None, timeout=60):
+        if self.run(detach, credentials, timeout):
             return self.local_up()
         return False
 
-    def run(self):
+    @locked
+    def run(self, detach=False, credentials=None, timeout=60):
         if self.status():
             self.__sc.stderr.write("Already running\n")
             return False
+        in_use = self.__table_in_use()
+        if in_use:
+            self.__sc.stderr.write('Routing table %d is in use by profile %s, set [routing] table or mark in the '
+                                   'profile, see "vpnp check"\n' % in_use)
+            return False
+        for subnet, outer in self.__settings.nested_subnets():
+            self.__sc.stderr.write('! Subnet %s overlaps %s in profile "%s"\n' % (
+                subnet, outer, self.__settings.profile_name))
 
         if not self._images():
             self.build()
 
         self.__ip = None
         self.__sc.container_ip(None)
+        self.__choose_endpoint()
 
-        self._container_hook('start')
-
-        self._container()
-        if not self.__ip:
+        started = []
+        for tunnel in range(self.__settings.tunnels()):
+            container_id = self.__launch(detach, credentials, timeout, exclude=started,
+                                         ip=self.__settings.network_ip(tunnel))
+            if container_id:
+                started.append(container_id)
+            elif started:
+                self.__sc.stderr.write("Failed to start tunnel %d\n" % (tunnel + 1))
+        if not started or not self._container() or not self.__ip:
             self.__sc.stderr.write("Failed to start\n")
             return False
 
-        self._container_hook('up')
+        for container_id in started:
+            self._container_hook('up', container_id)
+        self.__tune_mtu(started)
+        self.__check_tuning(started)
         self.__sc.on_connect()
         return True
 
+    @locked
+    def restart(self, detach=False, credentials=None, timeout=60):
+        """
+        Replace the running containers, counting the reconnects in the state. The health of the
+        old containers is forgotten
+        """
+        if not self.__restart(detach, credentials, timeout):
+            return False
+        self.__update_state(reconnects=self.state().get('reconnects', 0) + 1, health=None)
+        return True
+
+    def __restart(self, detach, credentials, timeout):
+        """
+        Bring up a new container alongside the running one, repoint the routes and domains
+        to it, and only then stop the old container, so traffic is never without a route
+        """
+        old = self._container()
+        if not old:
+            self.__sc.stderr.write("Not running\n")
+            return False
+        old_ip = self.__ip
+        subnets = set(self.__sc.list_routes())
+        subnets.update(self.__settings.subnets())
+        domains = set(self.__sc.list_domains())
+        domains.update(self.__settings.domains())
+        # Move off the current endpoint only if the last health check failed, else keep the fastest
+        health = self.state().get('health') or {}
+        self.__choose_endpoint(failover=health.get('exitcode', 0) != 0)
+
+        if len(self.__ips) > 1 or self.__settings.tunnels() > 1:
+            return self.__restart_rolling(subnets, domains, detach, credentials, timeout)
+        if self.__settings.network_ip():
+            return self.__restart_in_place(old, subnets, detach, credentials, timeout)
+
+        container_id = self.__launch(detach, credentials, timeout, exclude=[old['Id']])
+        if not container_id or not self._container(container_id) or not self.__ip:
+            self.__sc.stderr.write("Failed to start, still using %s\n" % old_ip)
+            self._container(old['Id'])
+            return False
+
+        self._container_hook('up', container_id)
+        self.__tune_mtu([container_id])
+        self.__check_tuning([container_id])
+        self.__sc.on_connect()
+        self.__sc.replace_routes(sorted(subnets, key=str))
+        for domain in sorted(domains):
+            self.__sc.add_domain(domain)
+
+        # Retire the old container
+        self.__retire([old['Id']])
+        self._container_hook('stop', old['Id'])
+        self.__sc.container_ip(old_ip)
+        self.__sc.on_disconnect()
+        try:
+            self.__dc.stop(old['Id'])
+            self.__dc.remove_container(old['Id'])
+        except Exception as e:
+            self.__sc.stderr.write("Error stopping: %s\n%s" % (old['Id'], e))
+        self._container(container_id)
+        return True
+
+    def __restart_in_place(self, old, subnets, detach, credentials, timeout):
+        """
+        With a static IP the routes and domains stay as they are while the container is
+        replaced, so traffic stalls rather than failing, and only missing routes are added
+        """
+        self.__retire([old['Id']])
+        self._container_hook('stop', old['Id'])
+        try:
+            self.__dc.stop(old['Id'])
+            self.__dc.remove_container(old['Id'])
+        except Exception as e:
+            self.__sc.stderr.write("Error stopping: %s\n%s" % (old['Id'], e))
+
+        container_id = self.__launch(detach, credentials, timeout)
+        if not container_id or not self._container(container_id) or not self.__ip:
+            self.__sc.stderr.write("Failed to start, routes are kept for %s\n" % self.__settings.network_ip())
+            return False
+
+        self._container_hook('up', container_id)
+        self.__sc.on_connect()
+        installed = set(self.__sc.list_routes())
+        if self.__tune_mtu([container_id]):
+            self.__sc.replace_routes(sorted(installed, key=str))
+        self.__check_tuning([container_id])
+        self.__sc.add_routes(sorted((sn for sn in subnets if sn not in installed), key=str))
+        installed = set(self.__sc.list_domains())
+        for domain in self.__settings.domains():
+            if domain not in installed:
+                self.__sc.add_domain(domain)
+        return True
+
+    def __restart_rolling(self, subnets, domains, detach, credentials, timeout):
+        """
+        Replace the tunnels one at a time, with the routes going via the other tunnels while
+        each is replaced
+        """
+        subnets = sorted(subnets, key=str)
+        ok = True
+        for old, old_ip in self._tunnels():
+            others = [ip for c, ip in self._tunnels() if c['Id'] != old['Id'] and ip]
+            if others:
+                self.__sc.container_ips(others)
+                self.__sc.replace_routes(subnets)
+
+            self.__retire([old['Id']])
+            self._container_hook('stop', old['Id'])
+            try:
+                self.__dc.stop(old['Id'])
+                self.__dc.remove_container(old['Id'])
+            except Exception as e:
+                self.__sc.stderr.write("Error stopping: %s\n%s" % (old['Id'], e))
+
+            running = [c['Id'] for c, _ in self._tunnels()]
+            ip = old_ip if self.__settings.network_ip() else None
+            container_id = self.__launch(detach, credentials, timeout, exclude=running, ip=ip)
+            if container_id:
+                self._tunnels()
+                self._container_hook('up', container_id)
+            else:
+                self.__sc.stderr.write("Failed to restart tunnel %s\n" % old_ip)
+                ok = False
+            if self._tunnels():
+                self.__sc.on_connect()
+                self.__sc.replace_routes(subnets)
+
+        tunnels = self._tunnels()
+        if not tunnels:
+            return False
+        if self.__tune_mtu([c['Id'] for c, _ in tunnels]):
+            self.__sc.replace_routes(subnets)
+        self.__check_tuning([c['Id'] for c, _ in tunnels])
+        for domain in sorted(domains):
+            self.__sc.add_domain(domain)
+        return ok
+
+    def __launch(self, detach, credentials, timeout, exclude=(), ip=None):
+        """
+        Start a new container, from the standby pool if there is one, and return its Id once
+        the start hook has connected. ip is the static IP on the vpnp network
+        """
+        if detach and credentials is None:
+            # Never prompt without a terminal, the profile must have them
+            credentials = (self.__settings.username(prompt=False), self.__settings.password(prompt=False))
+        standby_id = self.__take_standby(ip)
+        if detach:
+            return self.__start_detached(credentials, timeout, standby_id, ip)
+
+        started = False
+        try:
+            started = self._container_hook('start', standby_id, ip) == 0
+        finally:
+            if standby_id and not started:
+                self.__retire([standby_id])
+                self.__dc.stop(standby_id, timeout=1)
+        if standby_id:
+            return standby_id if started else None
+        running = [c['Id'] for c in self._containers()
+                   if c['State'] == 'running' and c['Id'] not in exclude]
+        return running[0] if running else None
+
+    def __table_in_use(self):
+        """
+        A routing table (or mark) that this profile shares with another profile and that an ip
+        rule already looks up, as (table, "names"), else None. A rule left by this profile, which
+        no other has the table of, is replaced as usual
+        """
+        clashes = self.__settings.route_table_clashes()
+        if not clashes:
+            return None
+        in_use = self.__sc.tables_in_use()
+        for table in sorted(clashes):
+            if table in in_use:
+                return table, ', '.join('"%s"' % name for name in clashes[table])
+        return None
+
+    def endpoint(self):
+        """
+        The VPN endpoint that the start hook connects to: the one chosen at the last start or
+        restart, or else the first
+        """
+        endpoints = self.__settings.vpn_endpoints()
+        endpoint = self.state().get('endpoint')
+        return endpoint if endpoint in endpoints else endpoints[0]
+
+    def __choose_endpoint(self, failover=False):
+        """
+        With several VPN endpoints, handshake with them all at once and choose the fastest that
+        answers, or with failover (the tunnel was unhealthy) the fastest but for the current one.
+        The handshake times are recorded in the state
+        """
+        endpoints = self.__settings.vpn_endpoints()
+        if len(endpoints) < 2:
+            return
+        from vpnporthole.probe import rank
+        ranked = rank(endpoints, self.__settings.endpoint_timeout(), self.__settings.endpoint_probe() == 'tls')
+        for endpoint, seconds in ranked:
+            probe = '%.1f ms' % (seconds * 1e3) if seconds is not None else 'no answer'
+            self.__sc.stdout.write('Probe: %s\t%s\n' % (endpoint, probe))
+        candidates = [endpoint for endpoint, seconds in ranked if seconds is not None]
+        if not candidates:
+            self.__sc.stderr.write('No endpoint answered, trying them in order\n')
+            candidates = endpoints
+        current = self.state().get('endpoint')
+        if failover and current in candidates and len(candidates) > 1:
+            candidates.remove(current)
+        self.__sc.stdout.write('Endpoint: %s\n' % candidates[0])
+        self.__update_state(endpoint=candidates[0],
+                            endpoints=[[e, round(s * 1e3, 1) if s is not None else None] for e, s in ranked])
+
+    def __tune_mtu(self, container_ids):
+        """
+        Set the route MTU from the profile, or else from the path MTU through the tunnels, and
+        record it. Returns True if it changed
+        """
+        mtu = self.__settings.route_mtu() or self.__discover_mtu(container_ids)
+        self.__mtu_changed = mtu != self.state().get('mtu')
+        if self.__mtu_changed:
+            self.__update_state(mtu=mtu)
+        self.__sc.route_mtu(mtu)
+        return self.__mtu_changed
+
+    def __discover_mtu(self, container_ids):
+        """
+        The smallest path MTU through the tunnels, probed with pings to the profile's mtu probe
+        address, or else the smallest tunnel interface MTU. None if there is no tunnel interface
+        """
+        mtus = []
+        for container_id in container_ids:
+            _, lines = self.__sc.docker_exec_lines(self.__dc, container_id, ['/bin/sh', '-c', self.__mtu_interfaces])
+            interfaces = dict((w[0], int(w[1])) for w in (line.split() for line in lines)
+                              if len(w) == 2 and w[1].isdigit())
+            tunnels = [mtu for name, mtu in interfaces.items() if self.__is_tunnel(name)]
+            if not tunnels:
+                continue
+            mtu = min(tunnels + [mtu for name, mtu in interfaces.items() if name.startswith('eth')])
+            probe = self.__settings.mtu_probe()
+            if probe and mtu > self.__mtu_min:
+                script = self.__mtu_ping % (self.__mtu_min - 28, mtu - 28, shlex.quote(probe), shlex.quote(probe))
+                exitcode, lines = self.__sc.docker_exec_lines(self.__dc, container_id, ['/bin/sh', '-c', script])
+                if exitcode == 0 and lines and lines[-1].strip().isdigit():
+                    mtu = int(lines[-1])
+                else:
+                    self.__sc.stderr.write("Unable to probe the path MTU to %s\n" % probe)
+            mtus.append(mtu)
+        return min(mtus) if mtus else None
+
+    def __check_tuning(self, container_ids):
+        """
+        Set the txqueuelen of the tun interfaces, and check the containers against the
+        [run][[tuning]] of the profile, warning of any value that did not take. The effective
+        values of the first tunnel are recorded
+        """
+        wanted = self.__settings.tuning()
+        effective = {}
+        for container_id in container_ids if wanted else ():
+            values = self.__tuning_values(container_id)
+            for name, value in sorted(wanted.items()):
+                if values.get(name) != value:
+                    self.__sc.stderr.write("WARNING: %s is %s in %s, not %s\n" % (
+                        name, values.get(name) or 'unset', container_id[:12], value))
+            effective = effective or dict((name, values.get(name)) for name in wanted)
+        if effective or self.state().get('tuning'):
+            self.__update_state(tuning=effective)
+
+    def __tuning_values(self, container_id):
+        """
+        The cgroup limits and ulimits that Docker gave the container, and its sysctls and tun
+        txqueuelen as seen inside it, by the names of Settings.tuning()
+        """
+        host = self.__dc.inspect_container(container_id)['HostConfig']
+        values = {
+            'cpuset': host.get('CpusetCpus') or '',
+            'cpus': '%g' % ((host.get('NanoCpus') or 0) / 1e9),
+            'memory': str(host.get('Memory') or 0),
+        }
+        for ulimit in host.get('Ulimits') or []:
+            values['ulimit %s' % ulimit['Name']] = '%d:%d' % (ulimit['Soft'], ulimit['Hard'])
+
+        sysctls = sorted(name[7:] for name in self.__settings.tuning() if name.startswith('sysctl '))
+        script = self.__tuning_script % (self.__settings.tuning_txqueuelen(), self.__settings.tunnel_interfaces(),
+                                         ' '.join(shlex.quote(k) for k in sysctls))
+        _, lines = self.__sc.docker_exec_lines(self.__dc, container_id, ['/bin/sh', '-c', script], user='root')
+        queues = set()
+        for words in (line.split(None, 2) for line in lines):
+            if len(words) >= 2 and words[0] == 'error':
+                self.__sc.stderr.write("WARNING: unable to set the txqueuelen of %s in %s: %s\n" % (
+                    words[1], container_id[:12], words[2].strip() if len(words) == 3 else 'failed'))
+            elif len(words) == 3 and words[0] == 'txqueuelen':
+                queues.add(words[2].strip())
+            elif len(words) >= 2 and words[0] == 'sysctl':
+                values['sysctl %s' % words[1]] = ' '.join(words[2].split()) if len(words) == 3 else ''
+        if queues:
+            values['txqueuelen'] = ' '.join(sorted(queues))
+        return values
+
+    def state(self, reload=False):
+        """
+        What was recorded about the profile when it was last started, e.g. the route MTU. With
+        reload, as last written by any vpnp process
+        """
+        if self.__state is None or reload:
+            try:
+                with open(self.__state_file(), 'rt') as fh:
+                    self.__state = json.load(fh)
+            except (IOError, ValueError):
+                self.__state = {}
+        return self.__state
+
+    def __update_state(self, **values):
+        state = dict(self.state())
+        state.update(values)
+        path = self.__state_file()
+        temp = '%s.%d' % (path, os.getpid())
+        with open(os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wt') as fh:
+            json.dump(state, fh, sort_keys=True)
+        os.replace(temp, path)
+        self.__state = state
+
+    def __retire(self, container_ids):
+        """
+        Record containers that are about to be stopped, so that "watch" leaves their routes be
+        """
+        retired = list(container_ids)
+        retired.extend(i for i in self.state(reload=True).get('retired', []) if i not in retired)
+        self.__update_state(retired=retired[:16])
+
+    def __state_file(self):
+        return os.path.join(self.__settings.cache_dir('state'), '%s.json' % self.__settings.profile_name)
+
+    def check_overlaps(self, subnets=None):
+        overlaps = self.__settings.overlaps(subnets)
+        for subnet, other, other_name in overlaps:
+            self.__sc.stderr.write('! Subnet %s overlaps %s in profile "%s"\n' % (subnet, other, other_name))
+        return not overlaps
+
+    def __tmpfs_options(self):
+        return ['--tmpfs', '%s:rw,noexec,nosuid,size=64k,mode=0700,uid=%d' % (
+            self.__secrets_dir, self.__settings.ctx.local.user.uid)]
+
+    def __start_detached(self, credentials, timeout, container_id=None, ip=None):
+        """
+        Run the container in the background (or use the given standby container), deliver
+        the credentials through a tmpfs and exec the start hook with them on stdin, then wait
+        until the tunnel interface is up and the health hook, if the profile has one, passes.
+        Returns the container Id, or None on failure
+        """
+        secrets = os.path.join(self.__secrets_dir, 'credentials')
+
+        if not container_id:
+            container_id = self.__sc.docker_run_detached(self._name(), self.__idle_args,
+                                                         self.__tmpfs_options() + self.__network_options(ip=ip))
+        if not container_id:
+            return None
+
+        try:
+            if self.__sc.docker_exec_input(container_id, ['/bin/sh', '-c', 'umask 077 && cat > %s' % secrets],
+                                           '%s\n%s\n' % credentials) != 0:
+                raise RuntimeError('Unable to deliver credentials')
+            # The start hook output goes to the container log, see `vpnp logs`
+            exec_id = self.__sc.docker_exec_detached(
+                self.__dc, container_id,
+                ['/bin/sh', '-c', 'VPNP_VPN_ADDR=%s /vpnp/start < %s > /proc/1/fd/1 2>&1; %s' % (
+                    shlex.quote(self.endpoint()), secrets, self.__end_idle)])
+
+            deadline = time.time() + timeout
+            interval = 0.1
+            while time.time() < deadline:
+                time.sleep(interval)
+                interval = min(interval * 2, 1)
+                state = self.__dc.exec_inspect(exec_id)
+                if not state['Running']:
+                    raise RuntimeError('Start hook exited with %s' % state['ExitCode'])
+                if self._container(container_id) and self.__tunnel_up(container_id) and (
+                        not self.__settings.has_hook('health') or self._container_hook('health', container_id) == 0):
+                    return container_id
+            raise RuntimeError('Tunnel not up after %ds' % timeout)
+        except Exception as e:
+            self.__sc.stderr.write('%s\n' % e)
+            self.__retire([container_id])
+            self.__dc.stop(container_id)
+            return None
+        finally:
+            try:
+                self.__dc.exec_start(self.__dc.exec_create(container_id, ['rm', '-f', secrets])['Id'])
+            except Exception:
+                pass
+
+    def __tunnel_up(self, container_id):
+        _, lines = self.__sc.docker_exec_lines(self.__dc, container_id, ['/bin/sh', '-c', self.__interfaces])
+        return any(self.__is_tunnel(name) for name in lines)
+
+    def __is_tunnel(self, name):
+        return fnmatch.fnmatchcase(name, self.__settings.tunnel_interfaces())
+
+    @locked
     def local_up(self):
         self._container()
-        for subnet in self.__settings.subnets():
-            self.__sc.add_route(subnet)
+        self.check_overlaps()
+        if self.__settings.routed_domains() and not self.__settings.dns_forwarder():
+            self.__sc.stderr.write('WARNING: routed_domains need the split-DNS forwarder, see [dns] in settings.conf\n')
+        installed = set()
+        if self.__settings.network_ip():
+            # Routes to the static IP may have been kept by `stop --keep-routes`
+            installed.update(self.__sc.list_routes())
+            if installed and self.__mtu_changed:
+                self.__sc.replace_routes(sorted(installed, key=str))
+        self.__sc.add_routes([sn for sn in self.__settings.subnets() if sn not in installed])
 
         for domain in self.__settings.domains():
             self.__sc.add_domain(domain)
         return True
 
+    @locked
     def add_route(self, subnet):
         subnet = IPv4Subnet(subnet)
         self._container()
+        self.check_overlaps([subnet])
         self.__sc.add_route(subnet)
         return True
 
+    @locked
     def del_route(self, subnet):
-        subnet = IPv4Subnet(subnet)
+        return self.del_routes([subnet])
+
+    @locked
+    def add_routes(self, subnets):
+        subnets = [IPv4Subnet(subnet) for subnet in subnets]
         self._container()
-        for sn in self.__sc.list_routes():
-            if sn in subnet:
-                self.__sc.del_route(sn)
+        self.check_overlaps(subnets)
+        self.__sc.add_routes(subnets)
         return True
 
+    @locked
+    def del_routes(self, subnets):
+        tree = IPv4RadixTree()
+        for subnet in subnets:
+            tree.add(subnet, True)
+        self._container()
+        self.__sc.del_routes([sn for sn in self.__sc.list_routes()
+                              if tree.lookup(sn.network, sn.prefixlen)])
+        return True
+
+    def routes(self):
+        self._container()
+        return self.__sc.list_routes()
+
+    @property
+    def ip(self):
+        return self.__ip
+
+    def dns_routes(self):
+        """
+        The installed domains of this profile and the container IPs that answer for them, as
+        {domain: [ip, ...]}, for the split-DNS forwarder
+        """
+        ips = [ip for _, ip in self._tunnels() if ip]
+        if not ips:
+            return {}
+        return dict((domain, ips) for domain in self.__sc.list_domains())
+
+    def routed_sets(self):
+        """
+        The routed domains of this profile, when running, and the kernel set that their addresses
+        go in, as {domain: set}, for the split-DNS forwarder
+        """
+        route_set = self.__sc.route_set()
+        if not route_set or not [ip for _, ip in self._tunnels() if ip]:
+            return {}
+        return dict((domain, route_set) for domain in self.__settings.routed_domains())
+
+    def add_routed_addresses(self, entries):
+        """
+        Route the addresses, as [(ip, timeout), ...], that the routed domains resolved to
+        """
+        self.__sc.add_to_set(entries)
+
+    @locked
     def add_domain(self, domain):
         self._container()
         self.__sc.add_domain(domain)
         return True
 
+    @locked
     def del_domain(self, domain):
         self._container()
         domains = self.__sc.list_domains()
@@ -122,9 +650,16 @@ class Session(object):
             return True
         return False
 
-    def stop(self):
-        self.local_down()
-        self._container_hook('stop')
+    @locked
+    def stop(self, keep_routes=False):
+        if keep_routes and self.__settings.network_ip():
+            self._container()
+        else:
+            self.local_down()
+        tunnels = self._tunnels()
+        self.__retire([c['Id'] for c, _ in tunnels])
+        for container, _ in tunnels:
+            self._container_hook('stop', container['Id'])
         self.__sc.container_ip(None)
 
         running = [c['Id'] for c in self._containers() if c['State'] == 'running']
@@ -139,6 +674,7 @@ class Session(object):
             self.__dc.remove_container(id)
         return True
 
+    @locked
     def local_down(self):
         self._container()
         self.__sc.del_all_domains()
@@ -146,8 +682,10 @@ class Session(object):
         self.__sc.on_disconnect()
         return True
 
+    @locked
     def purge(self):
         self.stop()
+        self.drain_standby()
         for image in self._images():
             self.__dc.remove_image(image, force=True)
         return True
@@ -160,25 +698,125 @@ class Session(object):
         self.__sc.docker_shell(container['Id'])
         return True
 
+    def describe(self):
+        """
+        The images of the profile, and its tunnels, VPN endpoint with the handshake times (in ms) of
+        the endpoints, route MTU, effective tuning, network, routing table, routes and domains when
+        running, as a SessionInfo
+        """
+        images = [Image(i['RepoTags'][0], i['Id'][7:19], i['Size']) for i in self._images()]
+        tunnels = self._tunnels()
+        info = SessionInfo(profile=self.__settings.profile_name, images=images, tunnels=[], endpoint=None,
+                           endpoints=[], mtu=None, mtu_source=None, tuning=[], network=None, table=None, routes=[],
+                           domains=[])
+        if self.__ip is None or not tunnels:
+            return info
+        mtu = self.__settings.route_mtu() or self.state().get('mtu')
+        endpoints = self.__settings.vpn_endpoints()
+        return info._replace(
+            tunnels=[Tunnel(c['Id'], c['Image'], c['State'], ip) for c, ip in tunnels],
+            endpoint=self.endpoint(),
+            endpoints=[tuple(e) for e in self.state().get('endpoints', []) if e[0] in endpoints],
+            mtu=mtu,
+            mtu_source=('profile' if self.__settings.route_mtu() else 'discovered') if mtu else None,
+            tuning=sorted((name, value) for name, value in (self.state().get('tuning') or {}).items()
+                          if name in self.__settings.tuning()),
+            network=self.__settings.network_name(),
+            table=self.__sc.route_table(),
+            routes=self.__sc.list_routes(),
+            domains=self.__sc.list_domains())
+
     def info(self):
-        for image in self._images():
-            print('Image: %s\t%s\t%.1f MB' % (image['RepoTags'][0],
-                                              image['Id'][7:19],
-                                              image['Size'] / 1024 / 1024,))
+        info = self.describe()
+        out = self.__sc.stdout
+        for image in info.images:
+            out.write('Image: %s\t%s\t%.1f MB\n' % (image.tag, image.id, image.size / 1024 / 1024))
+        for tunnel in info.tunnels:
+            out.write('Container: %s\t%s\t%s\n' % (tunnel.image, tunnel.state, tunnel.container_id[7:19]))
+        for tunnel in info.tunnels:
+            out.write('IP: %s\n' % tunnel.ip)
+        if info.endpoint:
+            out.write('Endpoint: %s\n' % info.endpoint)
+        for endpoint, ms in info.endpoints:
+            out.write('Probe: %s\t%s\n' % (endpoint, '%.1f ms' % ms if ms is not None else 'no answer'))
+        if info.mtu:
+            out.write('MTU: %d\tadvmss %d\t%s\n' % (info.mtu, info.mtu - 40, info.mtu_source))
+        for name, value in info.tuning:
+            out.write('Tuning: %s\t%s\n' % (name, value if value is not None else 'unset'))
+        if info.network:
+            out.write('Network: %s\n' % info.network)
+        if info.table:
+            out.write('Table: %d\tpriority %d\n' % (info.table, self.__settings.rule_priority()))
+        for subnet in info.routes:
+            out.write('Route: %s\n' % subnet)
+        for domain in info.domains:
+            out.write('Domain: %s\n' % domain)
+        return True
+
+    def metrics(self):
+        """
+        The operational state of the profile for the metrics exporter: its tunnels with their
+        start time and tun interface byte counters, the route and domain counts, and the last
+        health hook result and the reconnects from the state, as last written by any vpnp
+        """
+        state = self.state(reload=True)
+        tunnels = []
+        for container, ip in self._tunnels():
+            started = self.__dc.inspect_container(container)['State'].get('StartedAt') or ''
+            try:
+                started = calendar.timegm(time.strptime(started[:19], '%Y-%m-%dT%H:%M:%S'))
+            except ValueError:
+                started = None
+            _, lines = self.__sc.docker_exec_lines(self.__dc, container['Id'], ['/bin/sh', '-c', self.__tun_bytes])
+            counters = [w for w in (line.split() for line in lines)
+                        if len(w) == 3 and self.__is_tunnel(w[0]) and w[1].isdigit() and w[2].isdigit()]
+            interfaces = dict((w[0], (int(w[1]), int(w[2]))) for w in counters)
+            tunnels.append({'container': container['Id'][:12], 'ip': ip, 'started': started,
+                            'interfaces': interfaces})
+        return {
+            'tunnels': tunnels,
+            'routes': len(self.__sc.list_routes()) if tunnels else 0,
+            'domains': len(self.__sc.list_domains()),
+            'health': state.get('health'),
+            'reconnects': state.get('reconnects', 0),
+        }
+
+    def exec_lines(self, args):
+        """
+        Run a command in the container, returning an ExecResult, or None if not running
+        """
         container = self._container()
-        if self.__ip is None:
-            return True
-        print('Container: %s\t%s\t%s' % (container['Image'],
-                                         container['State'],
-                                         container['Id'][7:19],))
-        if container:
-            print('IP: %s' % self.__ip)
-            subnets = self.__sc.list_routes()
-            for subnet in subnets:
-                print('Route: %s' % subnet)
-            domains = self.__sc.list_domains()
-            for domain in domains:
-                print('Domain: %s' % domain)
+        if not container:
+            return None
+        return self.__sc.docker_exec_lines(self.__dc, container['Id'], args)
+
+    def gateway(self):
+        """
+        The address of the host as seen from the container
+        """
+        container = self._container()
+        if not container:
+            return None
+        network = self.__dc.inspect_container(container)['NetworkSettings']
+        if network.get('Gateway'):
+            return network['Gateway']
+        networks = network.get('Networks') or {}
+        preferred = networks.get(self.__settings.network_name()) or {}
+        return preferred.get('Gateway') or next(
+            (n['Gateway'] for n in networks.values() if n.get('Gateway')), None)
+
+    def logs(self, sinks, follow=False, since=None, tail='all'):
+        container = self._container()
+        if not container:
+            self.__sc.stderr.write("Not running\n")
+            return False
+
+        from vpnporthole.logs import iter_lines
+        stream = self.__dc.logs(container['Id'], stream=True, follow=follow, since=since, tail=tail)
+        for line in iter_lines(stream):
+            for sink in sinks:
+                sink.write(line)
+                sink.flush()
         return True
 
     def _images(self):
@@ -198,41 +836,165 @@ class Session(object):
         name = self._name()
         all_containers = self.__dc.containers(all=True)
         return [c for c in all_containers
-                if c['Image'] == name]
+                if c['Image'] == name and not self.__is_standby(c)]
+
+    @classmethod
+    def __is_standby(cls, container):
+        return any(n.startswith('/' + cls.__standby_prefix) for n in container.get('Names') or [])
+
+    def __container_name(self, standby=False):
+        base = '%s_%s' % (self.__settings.profile_name, self.__settings.ctx.local.user.name)
+        base = re.sub(r'[^a-zA-Z0-9_.-]', '_', base)
+        return '%s%s-%s' % (self.__standby_prefix if standby else 'vpnp-', base, uuid.uuid4().hex[:8])
+
+    def _standby_containers(self):
+        name = self._name()
+        return [c for c in self.__dc.containers()
+                if c['Image'] == name and self.__is_standby(c)]
+
+    @locked
+    def standby(self):
+        """
+        Start a container that idles until it is taken by `start`, so that `start` only needs
+        to authenticate. All standby containers share the standby memory budget, which counts
+        the standby memory of each. They run with the memory of the tuning, if any, as a limit
+        set now would still hold once the container is taken
+        """
+        if self._standby_containers():
+            return True
+        if not self._images():
+            self.build()
 
-    def _container(self):
-        running = [c for c in self._containers()
-                   if c['State'] == 'running']
-        if not running:
-            self.__ip = None
+        memory = self.__settings.standby_memory()
+        used = 0
+        for c in self.__dc.containers():
+            if self.__is_standby(c):
+                labels = self.__dc.inspect_container(c)['Config'].get('Labels') or {}
+                used += int(labels.get(self.__standby_label) or 0)
+        if used + memory > self.__settings.standby_budget():
+            self.__sc.stderr.write("Standby memory budget exceeded: %d + %d > %d bytes\n" % (
+                used, memory, self.__settings.standby_budget()))
+            return False
+
+        options = ['--name', self.__container_name(standby=True), '--label', '%s=%d' % (self.__standby_label, memory)]
+        options.extend(self.__tmpfs_options())
+        options.extend(self.__network_options(static=False))
+        return self.__sc.docker_run_detached(self._name(), self.__idle_args, options) is not None
+
+    @locked
+    def drain_standby(self):
+        for c in self._standby_containers():
+            try:
+                self.__dc.stop(c['Id'], timeout=1)
+            except Exception as e:
+                self.__sc.stderr.write("Error stopping: %s\n%s" % (c['Id'], e))
+        return True
+
+    def __take_standby(self, ip=None):
+        for c in self._standby_containers():
+            try:
+                self.__dc.rename(c['Id'], self.__container_name())
+            except Exception:
+                continue  # Taken by another vpnp
+            ip = ip or self.__settings.network_ip()
+            if ip:
+                # Move it from the dynamic range to the static IP of this profile
+                try:
+                    name = self.__settings.network_name()
+                    self.__dc.disconnect_container_from_network(c['Id'], name)
+                    self.__dc.connect_container_to_network(c['Id'], name, ipv4_address=ip)
+                except Exception as e:
+                    self.__sc.stderr.write("Unable to assign %s to standby: %s\n" % (ip, e))
+                    self.__dc.stop(c['Id'], timeout=1)
+                    return None
+            return c['Id']
+        return None
+
+    def __network_options(self, static=True, ip=None):
+        """
+        docker run options to attach to the vpnp network, with the static IP of this profile
+        (or the given IP)
+        """
+        name = self.__settings.network_name()
+        if not name:
+            return []
+        self.__ensure_network(name)
+        options = ['--network', name]
+        if static:
+            options.extend(['--ip', ip or self.__settings.network_ip()])
+        return options
+
+    def __ensure_network(self, name):
+        if any(n['Name'] == name for n in self.__dc.networks(names=[name])):
+            return
+        from docker.types import IPAMConfig, IPAMPool
+        subnet = self.__settings.network_subnet()
+        pool = IPAMPool(subnet=str(subnet), gateway=str(subnet[1]),
+                        iprange=str(self.__settings.network_dynamic_range()))
+        try:
+            self.__dc.create_network(name, driver='bridge', ipam=IPAMConfig(pool_configs=[pool]),
+                                     options={'com.docker.network.bridge.name': self.__settings.network_bridge()},
+                                     check_duplicate=True)
+        except Exception as e:
+            # Possibly created concurrently by another vpnp
+            if not any(n['Name'] == name for n in self.__dc.networks(names=[name])):
+                raise e
+
+    def _container(self, container_id=None):
+        tunnels = self._tunnels(container_id)
+        if not tunnels:
             return None
-        if len(running) > 1:
-            print('WARNING: there is more than one container: %s' % running)
+        if len(tunnels) > self.__settings.tunnels():
+            self.__sc.stderr.write('WARNING: there is more than one container: %s\n' % [c for c, _ in tunnels])
+        return tunnels[0][0]
 
-        container = running[0]
-        info = self.__dc.inspect_container(container)
-        if info:
-            self.__ip = info['NetworkSettings']['IPAddress']
-        else:
-            self.__ip = None
-        self.__sc.container_ip(self.__ip)
+    def _tunnels(self, container_id=None):
+        """
+        The running containers of this profile (or just the given one) and their IPs as
+        [(container, ip), ...], the routes then go via all of these IPs
+        """
+        tunnels = [(c, self.__container_ip(c)) for c in self._containers()
+                   if c['State'] == 'running' and container_id in (None, c['Id'])]
+        self.__ips = [ip for _, ip in tunnels if ip]
+        self.__ip = self.__ips[0] if self.__ips else None
+        self.__sc.container_ips(self.__ips)
+        if tunnels:
+            self.__sc.route_mtu(self.__settings.route_mtu() or self.state().get('mtu'))
+        return tunnels
 
-        return container
+    def __container_ip(self, container):
+        info = self.__dc.inspect_container(container)
+        if not info:
+            return None
+        network = info['NetworkSettings']
+        if network['IPAddress']:
+            return network['IPAddress']
+        # On a user defined network the address is only given per network
+        networks = network.get('Networks') or {}
+        preferred = networks.get(self.__settings.network_name()) or {}
+        return preferred.get('IPAddress') or next(
+            (n['IPAddress'] for n in networks.values() if n.get('IPAddress')), None)
 
-    def _container_hook(self, hook):
+    def _container_hook(self, hook, container_id=None, ip=None):
 
         if hook == 'start':
             args = ['/vpnp/start']
             name = self._name()
 
-            pe = self.__sc.docker_run_expect(name, args)
+            env = {'VPNP_VPN_ADDR': self.endpoint()}
+            if container_id:
+                args = ['/bin/sh', '-c', '/vpnp/start; %s' % self.__end_idle]
+                pe = self.__sc.docker_exec_expect(container_id, args, env)
+            else:
+                options = ['-e', 'VPNP_VPN_ADDR=%s' % env['VPNP_VPN_ADDR']] + self.__network_options(ip=ip)
+                pe = self.__sc.docker_run_expect(name, args, options)
             try:
                 old_pwd = None
                 while True:
                     i = pe.expect(['Username:', 'Password:', 'Established', 'Login failed.'])
                     if i < 0:
                         pe.wait()
-                        return pe.exitstatus
+                        return pe.exitstatus or 1
                     if i == 0:
                         pe.sendline(self.__settings.username())
                     if i == 1:
@@ -255,14 +1017,129 @@ class Session(object):
                 raise
             return 0
         else:
-            container = self._container()
-            if container:
-                return self.__sc.docker_exec(self.__dc, container['Id'], ['/vpnp/%s' % hook])
+            if not container_id:
+                container = self._container()
+                container_id = container['Id'] if container else None
+            if container_id:
+                return self.__sc.docker_exec(self.__dc, container_id, ['/vpnp/%s' % hook])
 
+    @locked
     def health(self):
-        if self._container():
+        """
+        Run the health hook, recording its exit code and duration in the state. A hook that
+        could not be run counts as failed
+        """
+        start = time.perf_counter()
+        exitcode = self.__health()
+        if exitcode is None:
+            exitcode = 1
+        if exitcode != 127:
+            self.__update_state(health={'exitcode': exitcode, 'seconds': round(time.perf_counter() - start, 6),
+                                        'time': int(time.time())})
+        return exitcode
+
+    def __health(self):
+        tunnels = self._tunnels()
+        if not tunnels:
+            return 127  # "command not found"
+        if len(tunnels) == 1:
             return self._container_hook('health')
-        return 127  # "command not found"
+
+        # Route only via the healthy tunnels
+        exitcode = 0
+        healthy = []
+        for container, ip in tunnels:
+            code = self._container_hook('health', container['Id'])
+            if code == 0:
+                healthy.append(ip)
+            else:
+                self.__sc.stderr.write("Tunnel %s is unhealthy\n" % ip)
+                exitcode = exitcode or code or 1
+        if healthy:
+            stale = [subnet for subnet, vias in self.__sc.list_nexthops() if sorted(vias) != sorted(healthy)]
+            self.__sc.container_ips(healthy)
+            self.__sc.replace_routes(stale)
+            self.__sc.container_ips(self.__ips)
+        return exitcode
+
+    def watch(self):
+        """
+        Follow the Docker events of the profile's containers, but for the standby ones, and as
+        soon as one exits other than by "stop" or "restart", e.g. the VPN client failed or it ran
+        out of memory, take the routes and domains off it. Yields the Id of each such container
+        once it is handled
+        """
+        ips = dict((c['Id'], ip) for c, ip in self._tunnels() if ip)
+        filters = {'type': 'container', 'event': ['start', 'die'], 'image': self._name()}
+        for event in self.__events(filters):
+            container_id = event.get('id') or event['Actor']['ID']
+            # Standby containers carry no routes, and a taken one is renamed before it does
+            name = event.get('Actor', {}).get('Attributes', {}).get('name', '')
+            if name.startswith(self.__standby_prefix):
+                continue
+            if event.get('Action', event.get('status')) == 'start':
+                ips.update((c['Id'], ip) for c, ip in self._tunnels() if ip)
+                continue
+            ip = ips.pop(container_id, None)
+            if container_id in self.state(reload=True).get('retired', ()):
+                continue
+            # A standby container that was taken is on its static IP
+            static = [self.__settings.network_ip(tunnel) for tunnel in range(self.__settings.tunnels())]
+            try:
+                with self._lock():
+                    handled = self.__tunnel_died([ip] + static)
+            except LockTimeout as e:
+                self.__sc.stderr.write("%s\n" % e)
+                continue
+            if handled:
+                yield container_id
+
+    def __events(self, filters):
+        """
+        The Docker event stream, resubscribed from the last event when the client times out
+        waiting or the connection drops
+        """
+        since = None
+        last = 0
+        while True:
+            try:
+                for event in self.__dc.events(since=since, decode=True, filters=filters):
+                    nano = event.get('timeNano') or event.get('time', 0) * 10 ** 9
+                    if nano <= last:
+                        continue  # Replayed from the same second
+                    last = nano
+                    since = nano // 10 ** 9
+                    yield event
+            except Exception as e:
+                if 'timed out' not in str(e):
+                    self.__sc.stderr.write("Docker events: %s\n" % e)
+                    time.sleep(1)
+
+    def __tunnel_died(self, ips):
+        """
+        Take the routes and domains off those of ips that are no longer running, on to the
+        remaining tunnels if there are any. Returns False if there was nothing to do
+        """
+        running = [ip for _, ip in self._tunnels() if ip]
+        dead = sorted(set(ip for ip in ips if ip and ip not in running))
+        self.__sc.container_ips(dead + running)
+        stale = [subnet for subnet, vias in self.__sc.list_nexthops() if set(vias) & set(dead)]
+        domains = self.__sc.list_domains()
+        if not stale and not (domains and not running):
+            self.__sc.container_ips(running)
+            return False
+        if running:
+            self.__sc.container_ips(running)
+            self.__sc.replace_routes(stale)
+            for domain in domains:
+                self.__sc.add_domain(domain)
+            return True
+        self.__sc.container_ips(dead)
+        self.__sc.del_all_routes(stale)
+        self.__sc.del_all_domains()
+        self.__sc.on_disconnect()
+        self.__sc.container_ips(running)
+        return True
 
     def refresh(self):
         if self._container():
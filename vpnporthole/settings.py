@@ -1,23 +1,37 @@
 import sys
 import os
+import re
+import zlib
 from configobj import ConfigObj, get_extra_values, DuplicateError
 from validate import Validator
 from pkg_resources import resource_stream
 
-from vpnporthole.ip import IPv4Subnet
+from vpnporthole.ip import IPv4Address, IPv4Subnet, find_overlaps
+from vpnporthole.exceptions import ConfigError, ProfileNameError, SudoError
 
 
 class Settings(object):
     __sudo_password = None
     __ctx = None
-
-    def __init__(self, profile_name):
+    __ctx_cache = {}
+    __template_cache = {}
+    __render_cache = {}  # (profile name, template hash): (ctx digest, rendered)
+    __digest = None
+    __loaded = {}  # (profile name, prompt): (mtimes of its config files, Settings)
+    __all_subnets = None  # (mtimes of the profile files, [(subnet, profile name), ...])
+    __dns = None
+
+    def __init__(self, profile_name, stdout=None, prompt=None):
+        """
+        Raises ConfigError for a settings or profile file that does not validate. Notes are
+        written to stdout (default: sys.stdout). A username or password that is left blank is
+        asked for with prompt(text, secret), without a prompt it is an error
+        """
         self.__profile_name = profile_name
-        self.__ensure_config_setup()
+        self.__prompt = prompt
+        self.__ensure_config_setup(stdout or sys.stdout)
         self.__settings = self.__get_settings()
         self.__profile = self.__get_profile(profile_name)
-        if not self.__settings or not self.__profile:
-            exit(3)
 
     @property
     def profile_name(self):
@@ -33,17 +47,20 @@ class Settings(object):
             return machine
         return None
 
-    def username(self):
+    def username(self, prompt=True):
         usr = self.__extract(self.__profile['username'])
         if not usr:
-            usr = input("")
+            if not (prompt and self.__prompt):
+                raise ConfigError('No username in profile "%s"' % self.__profile_name)
+            usr = self.__prompt('', False)
         return usr
 
-    def password(self):
+    def password(self, prompt=True):
         pwd = self.__extract(self.__profile['password'])
         if not pwd:
-            import getpass
-            pwd = getpass.getpass('')
+            if not (prompt and self.__prompt):
+                raise ConfigError('No password in profile "%s"' % self.__profile_name)
+            pwd = self.__prompt('', True)
         return pwd
 
     def sudo(self):
@@ -54,11 +71,179 @@ class Settings(object):
         if not pwd:
             if self.__sudo_password is not None:
                 return self.__sudo_password
-            import getpass
-            pwd = getpass.getpass('Enter sudo password:')
+            if not self.__prompt:
+                raise SudoError('No sudo password in the settings')
+            pwd = self.__prompt('Enter sudo password:', True)
             Settings.__sudo_password = pwd
         return self.__extract(pwd)
 
+    def capture_lines(self):
+        return self.__settings['system']['capture_lines']
+
+    def lock_timeout(self):
+        return self.__settings['system']['lock_timeout']
+
+    def standby_enabled(self):
+        return self.__profile['standby']['enabled']
+
+    def standby_memory(self):
+        return self.__parse_size(self.__profile['standby']['memory'])
+
+    def standby_budget(self):
+        return self.__parse_size(self.__settings['standby']['budget'])
+
+    def network_name(self):
+        """
+        The vpnp Docker network, None when containers use the default bridge
+        """
+        name = self.__settings['network']['name']
+        if not name or any(o.split('=')[0] in ('--net', '--network') for o in self.run_options()):
+            return None
+        return name
+
+    def network_bridge(self):
+        """
+        The host interface of the network of the containers, named after the vpnp network when
+        vpnp creates it, else docker0 of the default bridge
+        """
+        name = self.network_name()
+        return 'br-%s' % name[:12] if name else 'docker0'
+
+    def network_subnet(self):
+        return IPv4Subnet(self.__settings['network']['subnet'])
+
+    def network_dynamic_range(self):
+        """
+        The upper half of the network subnet, from which Docker assigns addresses to
+        containers without a static IP, e.g. standby containers
+        """
+        subnet = self.network_subnet()
+        half = 2 ** (32 - subnet.prefixlen) // 2
+        return IPv4Subnet('%s/%d' % (subnet[half], subnet.prefixlen + 1))
+
+    def network_ip(self, tunnel=0):
+        """
+        The static container IP of this profile (and tunnel): configured, or derived from the
+        profile and user name so that it is stable across restarts. None when there is no
+        vpnp network
+        """
+        if not self.network_name():
+            return None
+        ip = self.__profile['network']['ip']
+        if ip:
+            return str(IPv4Address(IPv4Subnet(ip).network.int + tunnel))
+        # Skip the network address and the gateway, and stay below the dynamic range
+        subnet = self.network_subnet()
+        hosts = 2 ** (32 - subnet.prefixlen) // 2 - 2
+        key = '%s_%s' % (self.profile_name, self.ctx.local.user.name)
+        if tunnel:
+            key += '_%d' % tunnel
+        return str(subnet[2 + zlib.crc32(key.encode('utf-8')) % hosts])
+
+    def route_tables(self):
+        """
+        With [routing] tables, the two routing tables of this profile, which take turns to hold
+        its routes: configured, or derived from the profile and user name. Else None
+        """
+        routing = self.__settings['routing']
+        if not routing['tables']:
+            return None
+        table = self.__profile['routing']['table']
+        if not table:
+            key = '%s_%s' % (self.profile_name, self.ctx.local.user.name)
+            table = routing['first_table'] + 2 * (zlib.crc32(key.encode('utf-8')) % 1000)
+        return table, table + 1
+
+    def route_mark(self):
+        """
+        The fwmark, and the routing table, of the traffic to the addresses of the routed domains:
+        configured, or derived from the profile and user name
+        """
+        mark = self.__profile['routing']['mark']
+        if not mark:
+            key = '%s_%s' % (self.profile_name, self.ctx.local.user.name)
+            mark = self.__settings['routing']['first_mark'] + zlib.crc32(key.encode('utf-8')) % 1000
+        return mark
+
+    def route_table_clashes(self):
+        """
+        The routing tables (and marks) of this profile that other profiles have too, configured or
+        derived, as {table: [profile name, ...]}
+        """
+        mine = set(self.__own_tables())
+        clashes = {}
+        if not mine:
+            return clashes
+        for name in sorted(self.list_profile_names()):
+            if name == self.profile_name:
+                continue
+            try:
+                other = self.load(name)
+            except ConfigError:
+                continue  # Reported when the profile is used
+            for table in mine.intersection(other.__own_tables()):
+                clashes.setdefault(table, []).append(name)
+        return clashes
+
+    def __own_tables(self):
+        tables = list(self.route_tables() or ())
+        if self.routed_domains():
+            tables.append(self.route_mark())
+        return tables
+
+    def rule_priority(self):
+        """
+        The priority of the ip rules that look up the routing tables of the profiles
+        """
+        return self.__settings['routing']['priority']
+
+    def tunnels(self):
+        return self.__profile['tunnels']
+
+    def route_mtu(self):
+        return self.__profile['mtu']['value'] or None
+
+    def mtu_probe(self):
+        return self.__profile['mtu']['probe'] or None
+
+    def tunnel_interfaces(self):
+        """
+        The name, or glob, of the tunnel interfaces in the container
+        """
+        tunnel = self.__profile['run']['tunnel']
+        if not re.match(r'^[\w.*?\[\]-]+$', tunnel):
+            raise ConfigError('Bad [run] tunnel "%s" in profile "%s"' % (tunnel, self.__profile_name))
+        return tunnel
+
+    def dns_forwarder(self):
+        """
+        The [dns] settings when the split-DNS forwarder is enabled, else None
+        """
+        if self.__dns is None:
+            self.__dns = self.__forwarder(self.__settings) or {}
+        return dict(self.__dns) if self.__dns else None
+
+    @classmethod
+    def forwarder_settings(cls):
+        """
+        The [dns] settings when the split-DNS forwarder is enabled, else None, read from
+        settings.conf without a profile
+        """
+        return cls.__forwarder(cls.__get_settings())
+
+    @staticmethod
+    def __forwarder(settings):
+        dns = settings['dns']
+        return dict(dns) if dns['forwarder'] else None
+
+    @staticmethod
+    def __parse_size(value):
+        units = {'': 1, 'b': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+        value = value.strip().lower()
+        if value and value[-1] in units:
+            return int(float(value[:-1]) * units[value[-1]])
+        return int(value)
+
     def build_files(self):
         ret = {}
         for filename, content in self.__profile['build']['files'].iteritems():
@@ -79,6 +264,16 @@ class Settings(object):
                 ret[filename] = content
         return ret
 
+    def has_hook(self, hook):
+        """
+        Whether the profile has the hook, not just the default empty script
+        """
+        content = self.__profile['run']['hooks'].get(hook)
+        if not content:
+            return False
+        lines = [line.strip() for line in self.__file_content(content).splitlines()]
+        return any(line and not line.startswith('#') for line in lines)
+
     def __file_content(self, value):
         from textwrap import dedent
         if value.startswith((' ', '\n', '\t', '\\')):
@@ -91,12 +286,38 @@ class Settings(object):
                 raise FileNotFoundError('"%s"' % value)
 
     def __render_template(self, content):
-        from tempita import Template
-        template = Template(content)
+        """
+        Render content with the ctx. Compiled templates are cached by content hash, and the
+        rendered output by profile and content hash for the current ctx digest only. Rendered
+        output can hold SHELL: secrets, so it is only kept in memory
+        """
+        import hashlib
+        template_hash = hashlib.sha1(content.encode('utf-8')).hexdigest()
+        key = (self.__profile_name, template_hash)
+        digest = self.__ctx_digest()
+
+        cached = self.__render_cache.get(key)
+        if cached is not None and cached[0] == digest:
+            return cached[1]
+
+        template = self.__template_cache.get(template_hash)
+        if template is None:
+            from tempita import Template
+            template = Template(content)
+            self.__template_cache[template_hash] = template
 
         result = template.substitute(**{k: self.ctx[k] for k in self.ctx})
+        self.__render_cache[key] = (digest, result)
         return result
 
+    def __ctx_digest(self):
+        if self.__digest is None:
+            import json
+            import hashlib
+            ctx = json.dumps(self.ctx, sort_keys=True, default=str)
+            self.__digest = hashlib.sha1(ctx.encode('utf-8')).hexdigest()
+        return self.__digest
+
     def build_options(self):
         ret = {}
         for k, v in self.__profile['build']['options'].iteritems():
@@ -111,6 +332,53 @@ class Settings(object):
             args.extend(value.split(' ', 1))
         return args
 
+    def tuning_options(self):
+        """
+        docker run options for the [run][[tuning]] of the profile
+        """
+        tuning = self.__profile['run']['tuning']
+        args = []
+        if tuning['cpuset']:
+            args.extend(['--cpuset-cpus', tuning['cpuset']])
+        if tuning['cpus']:
+            args.extend(['--cpus', '%g' % tuning['cpus']])
+        if tuning['memory']:
+            args.extend(['--memory', str(self.tuning_memory())])
+        for key in sorted(tuning['sysctls'].keys()):
+            args.extend(['--sysctl', '%s=%s' % (key, tuning['sysctls'][key])])
+        for key in sorted(tuning['ulimits'].keys()):
+            args.extend(['--ulimit', '%s=%s' % (key, tuning['ulimits'][key])])
+        return args
+
+    def tuning_memory(self):
+        memory = self.__profile['run']['tuning']['memory']
+        return self.__parse_size(memory) if memory else None
+
+    def tuning_txqueuelen(self):
+        return self.__profile['run']['tuning']['txqueuelen']
+
+    def tuning(self):
+        """
+        The values that the containers should have with the [run][[tuning]] of the profile, as
+        strings by the names that `vpnp info` shows them with
+        """
+        tuning = self.__profile['run']['tuning']
+        values = {}
+        if tuning['cpuset']:
+            values['cpuset'] = tuning['cpuset']
+        if tuning['cpus']:
+            values['cpus'] = '%g' % tuning['cpus']
+        if tuning['memory']:
+            values['memory'] = str(self.tuning_memory())
+        if tuning['txqueuelen']:
+            values['txqueuelen'] = str(tuning['txqueuelen'])
+        for key, value in tuning['sysctls'].items():
+            values['sysctl %s' % key] = ' '.join(value.split())
+        for key, value in tuning['ulimits'].items():
+            soft, _, hard = value.partition(':')
+            values['ulimit %s' % key] = '%s:%s' % (soft, hard or soft)
+        return values
+
     def __extract(self, value):
         if value and value.startswith('SHELL:'):
             import subprocess
@@ -118,21 +386,80 @@ class Settings(object):
         return value
 
     def vpn(self):
-        return self.__profile['vpn']
+        """
+        The first VPN endpoint
+        """
+        return self.vpn_endpoints()[0]
+
+    def vpn_endpoints(self):
+        return list(self.__profile['vpn'])
+
+    def endpoint_probe(self):
+        """
+        How the endpoints are probed when there are several: 'tls' or 'tcp' handshakes
+        """
+        return self.__profile['endpoints']['probe']
+
+    def endpoint_timeout(self):
+        return self.__profile['endpoints']['timeout']
 
     def subnets(self):
         return [IPv4Subnet(k)
                 for k, v in self.__profile['subnets'].items()
                 if v is True]
 
+    def nested_subnets(self):
+        """
+        Subnets of the profile that overlap another of its subnets, as [(subnet, outer), ...]
+        """
+        return [(inner, outer) for outer, _, inner, _ in find_overlaps((subnet, None) for subnet in self.subnets())]
+
+    def overlaps(self, subnets=None):
+        """
+        Find overlaps between subnets (defaulting to those of this profile) and the subnets
+        of all other profiles, returns [(subnet, other_subnet, other_profile_name), ...]
+        """
+        if subnets is None:
+            subnets = self.subnets()
+        tagged = [(subnet, None) for subnet in subnets]
+        tagged.extend((subnet, name) for subnet, name in self.all_subnets()
+                      if name != self.profile_name)
+
+        ret = []
+        for outer, outer_name, inner, inner_name in find_overlaps(tagged):
+            if outer_name is None and inner_name is not None:
+                ret.append((outer, inner, inner_name))
+            elif inner_name is None and outer_name is not None:
+                ret.append((inner, outer, outer_name))
+        return ret
+
     def domains(self):
+        """
+        The domains resolved via the profile, including the routed domains
+        """
         return [k
                 for k, v in self.__profile['domains'].items()
+                if v is True] + self.routed_domains()
+
+    def routed_domains(self):
+        """
+        The domains whose resolved addresses are routed via the profile
+        """
+        return [k
+                for k, v in self.__profile['routed_domains'].items()
                 if v is True]
 
     @property
     def ctx(self):
         if not self.__ctx:
+            # Reuse the ctx of an earlier instance with the same unresolved options, so
+            # that SHELL: options are only run once per process
+            key = (self.profile_name, tuple(self.vpn_endpoints()),
+                   tuple(sorted(self.__profile['build']['options'].items())))
+            self.__ctx = self.__ctx_cache.get(key)
+            if self.__ctx:
+                return self.__ctx
+
             import pwd
             import grp
 
@@ -153,7 +480,11 @@ class Settings(object):
             local.user = user
 
             vpn = dotdict()
+            vpn.endpoints = self.vpn_endpoints()
             vpn.addr = self.vpn()
+            if len(vpn.endpoints) > 1:
+                # The endpoint is chosen at start, and passed to the start hook
+                vpn.addr = '${VPNP_VPN_ADDR:-%s}' % vpn.addr
 
             option = dotdict()
             for k, v in self.build_options().items():
@@ -173,6 +504,7 @@ class Settings(object):
             ctx.option = option
 
             self.__ctx = ctx
+            self.__ctx_cache[key] = ctx
 
         return self.__ctx
 
@@ -181,7 +513,18 @@ class Settings(object):
         return os.path.expanduser('~/.config/vpn-porthole')
 
     @classmethod
-    def __ensure_config_setup(cls):
+    def cache_dir(cls, *parts):
+        """
+        A directory under ~/.cache/vpn-porthole (or $XDG_CACHE_HOME), created if needed
+        """
+        root = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+        path = os.path.join(root, 'vpn-porthole', *parts)
+        if not os.path.exists(path):
+            os.makedirs(path, mode=0o700)
+        return path
+
+    @classmethod
+    def __ensure_config_setup(cls, stdout):
         root = cls.__default_settings_root()
         if not os.path.exists(root):
             os.makedirs(root)
@@ -191,7 +534,7 @@ class Settings(object):
             with open(settings_file, 'w+b') as fh:
                 content = resource_stream("vpnporthole", "resources/settings.conf").read()
                 fh.write(content)
-            print("* Wrote: %s" % settings_file)
+            stdout.write("* Wrote: %s\n" % settings_file)
 
         root = os.path.join(root, 'profiles')
         if not os.path.exists(root):
@@ -202,7 +545,7 @@ class Settings(object):
                 with open(profile_file, 'w+b') as fh:
                     content = resource_stream("vpnporthole", "resources/example.conf").read()
                     fh.write(content)
-                print("* Wrote: %s" % profile_file)
+                stdout.write("* Wrote: %s\n" % profile_file)
 
     @classmethod
     def __get_settings(cls):
@@ -211,25 +554,55 @@ class Settings(object):
         settings_file = os.path.join(config_root, 'settings.conf')
         settings_spec_lines = resource_stream("vpnporthole", "resources/settings.spec").readlines()
 
-        settings = cls.__load_configobj(settings_file, settings_spec_lines)
-        if not settings:
-            exit(3)
-        return settings
+        return cls.__load_configobj(settings_file, settings_spec_lines)
 
     @classmethod
     def __get_profile(cls, name):
         config_root = cls.__default_settings_root()
 
         if name in ('all',):
-            sys.stderr.write('! Invalid profile name "%s"\n' % name)
-            exit(1)
+            raise ProfileNameError('Invalid profile name "%s"' % name)
 
         session_file = os.path.join(config_root, 'profiles', '%s.conf' % name)
         session_spec_lines = resource_stream("vpnporthole", "resources/profile.spec").readlines()
 
-        profile = cls.__load_configobj(session_file, session_spec_lines)
+        return cls.__load_configobj(session_file, session_spec_lines)
+
+    @classmethod
+    def config_files(cls, profile_name):
+        """
+        The settings file and the file of the profile, whose changes a cached Settings misses
+        """
+        config_root = cls.__default_settings_root()
+        return [os.path.join(config_root, 'settings.conf'),
+                os.path.join(config_root, 'profiles', '%s.conf' % profile_name)]
 
-        return profile
+    @classmethod
+    def load(cls, profile_name, prompt=None):
+        """
+        The Settings of a profile, shared until the settings or profile file changes, for long
+        running processes such as vpnpd and the DNS forwarder
+        """
+        mtimes = cls.config_mtimes(profile_name)
+        cached = cls.__loaded.get((profile_name, prompt))
+        if cached and cached[0] == mtimes:
+            return cached[1]
+        settings = cls(profile_name, prompt=prompt)
+        cls.__loaded[(profile_name, prompt)] = (mtimes, settings)
+        return settings
+
+    @classmethod
+    def config_mtimes(cls, profile_name):
+        """
+        The mtimes of config_files(), None for a missing file, which change with the settings
+        """
+        mtimes = []
+        for path in cls.config_files(profile_name):
+            try:
+                mtimes.append(os.stat(path).st_mtime)
+            except OSError:
+                mtimes.append(None)
+        return mtimes
 
     @classmethod
     def list_profile_names(cls):
@@ -244,24 +617,50 @@ class Settings(object):
             names.append(name)
         return names
 
+    @classmethod
+    def all_subnets(cls):
+        """
+        Subnets of all profiles as [(subnet, profile_name), ...], parsed again only when a
+        profile file is added, removed or changed
+        """
+        mtimes = []
+        for name in sorted(cls.list_profile_names()):
+            try:
+                mtimes.append((name, os.stat(cls.config_files(name)[1]).st_mtime))
+            except OSError:
+                mtimes.append((name, None))
+        if cls.__all_subnets and cls.__all_subnets[0] == mtimes:
+            return list(cls.__all_subnets[1])
+        ret = []
+        for name, _ in mtimes:
+            try:
+                profile = cls.__get_profile(name)
+            except ConfigError:
+                continue  # Reported when the profile is used
+            ret.extend((IPv4Subnet(k), name)
+                       for k, v in profile['subnets'].items()
+                       if v is True)
+        cls.__all_subnets = (mtimes, ret)
+        return list(ret)
+
     @classmethod
     def __load_configobj(cls, config_file, spec_lines):
+        """
+        Raises ConfigError, with the unknown keys and bad values, if the file does not validate
+        """
         try:
             confobj = ConfigObj(config_file, configspec=spec_lines, raise_errors=True,
                                 interpolation=False)
         except DuplicateError as e:
-            sys.stderr.write('! Bad config file "%s": %s\n' % (config_file, e))
-            return None
+            raise ConfigError('Bad config file "%s": %s' % (config_file, e))
         except Exception as e:
-            sys.stderr.write('! Bad config file "%s": %s\n' % (config_file, e))
-            return None
+            raise ConfigError('Bad config file "%s": %s' % (config_file, e))
 
         bad_values = []
         bad_keys = []
         result = confobj.validate(Validator())
         if result is False:
-            sys.stderr.write('! Unable to validate config file "%s":\n' % config_file)
-            return None
+            raise ConfigError('Unable to validate config file "%s"' % config_file)
         if result is not True:
             def walk(node, dir):
                 for key, item in node.items():
@@ -277,13 +676,14 @@ class Settings(object):
             for path, key in extra:
                 bad_keys.append(list(path) + [key])
 
+        errors = []
         if bad_keys:
-            sys.stderr.write('! Unknown keys in config file "%s":\n' % config_file)
+            errors.append('Unknown keys in config file "%s":' % config_file)
             for key in bad_keys:
-                sys.stderr.write('  - /%s\n' % '/'.join(key))
+                errors.append('  - /%s' % '/'.join(key))
 
         if bad_values:
-            sys.stderr.write('! Bad values in settings file "%s":\n' % config_file)
+            errors.append('Bad values in settings file "%s":' % config_file)
             for key in bad_values:
                 value = confobj
                 try:
@@ -291,8 +691,8 @@ class Settings(object):
                         value = value[k]
                 except KeyError:
                     value = '<missing>'
-                sys.stderr.write('  - /%s = %s\n' % ('/'.join(key), value))
+                errors.append('  - /%s = %s' % ('/'.join(key), value))
 
-        if bad_keys or bad_values:
-            return None
+        if errors:
+            raise ConfigError('\n'.join(errors))
         return confobj
@@ -1,24 +1,90 @@
 import os
 import sys
 import re
+import glob
 import subprocess
+from collections import deque
 
 from pexpect import spawn as pe_spawn, TIMEOUT, EOF
 
+from vpnporthole.ip import IPv4Subnet
+from vpnporthole.lock import Lock, locked
+from vpnporthole.exceptions import SudoError
+from vpnporthole.results import ExecResult
+
 
 class SystemCallsBase(object):
     _ip = None
+    _ips = ()
+    _mtu = None
     __docker_bin = None
     __sudo_cache = None
     __sudo_prompt = 'SUDO PASSWORD: '
 
-    def __init__(self, tag, settings):
+    def __init__(self, tag, settings, stdout=None, stderr=None):
+        """
+        The commands run and their output are written to stdout, and errors to stderr (default:
+        sys.stdout and sys.stderr at the time of writing)
+        """
         self._tag = tag
         self._settings = settings
         self.__cb_sudo = self._settings.sudo
+        self.__stdout = stdout
+        self.__stderr = stderr
+
+    def _lock(self):
+        """
+        The host-wide lock, held while changing the routes and resolver settings
+        """
+        return Lock(os.path.join(self._settings.cache_dir('locks'), 'host.lock'), self._settings.lock_timeout(),
+                    stderr=self.stderr)
 
     def container_ip(self, ip):
-        self._ip = ip
+        self.container_ips([ip] if ip else [])
+
+    def container_ips(self, ips):
+        """
+        The container IPs that routes go via, more than one for a multipath route
+        """
+        self._ips = list(ips)
+        self._ip = self._ips[0] if self._ips else None
+
+    def route_mtu(self, mtu):
+        """
+        The MTU, and the matching TCP MSS, of the routes via the container
+        """
+        self._mtu = mtu
+
+    def _route_args(self):
+        args = []
+        if self._mtu:
+            args.extend(['mtu', str(self._mtu), 'advmss', str(self._mtu - 40)])
+        return args + self._nexthop_args()
+
+    def _nexthop_args(self):
+        if len(self._ips) > 1:
+            return [arg for ip in self._ips for arg in ('nexthop', 'via', ip)]
+        return ['via', self._ip]
+
+    def _parse_nexthops(self, lines):
+        """
+        Parse `ip route show` output into [(subnet, [via, ...]), ...] for the routes via the
+        container IPs. Multipath routes list their nexthops on the following lines
+        """
+        routes = []
+        for line in lines:
+            words = line.split()
+            if not words:
+                continue
+            if words[0] != 'nexthop':
+                try:
+                    routes.append((IPv4Subnet(words[0]), []))
+                except ValueError:
+                    routes.append((None, []))  # e.g. "default"
+            routes[-1][1].extend(words[i + 1] for i, word in enumerate(words[:-1]) if word == 'via')
+        ips = set(self._ips)
+        return [(subnet, vias) for subnet, vias in routes
+                if subnet is not None and ips.intersection(vias)]
 
     def on_connect(self):
         pass
@@ -32,14 +98,57 @@ class SystemCallsBase(object):
     def del_route(self, subnet):
         pass
 
+    @locked
+    def add_routes(self, subnets):
+        for subnet in subnets:
+            self.add_route(subnet)
+
+    @locked
+    def del_routes(self, subnets):
+        for subnet in subnets:
+            self.del_route(subnet)
+
+    @locked
+    def replace_routes(self, subnets):
+        """
+        Point the given routes at the current container IP, adding any that are missing
+        """
+        for subnet in subnets:
+            self.del_route(subnet)
+            self.add_route(subnet)
+
     def list_routes(self):
+        return [subnet for subnet, _ in self.list_nexthops()]
+
+    def route_table(self):
+        """
+        The routing table that holds the routes of the profile, None for the main table
+        """
+        return None
+
+    def tables_in_use(self):
+        """
+        The routing tables that ip rules look up, as a set of numbers
+        """
+        return set()
+
+    def route_set(self):
+        """
+        The kernel set of the addresses that the routed domains resolve to, None if not supported
+        """
+        return None
+
+    def add_to_set(self, entries):
+        pass
+
+    def list_nexthops(self):
         return []
 
+    @locked
     def del_all_routes(self, other_subnets):
         subnets = set(self.list_routes())
         subnets.update(other_subnets)
-        for subnet in subnets:
-            self.del_route(subnet)
+        self.del_routes(sorted(subnets, key=str))
 
     def add_domain(self, domain):
         pass
@@ -50,6 +159,32 @@ class SystemCallsBase(object):
     def list_domains(self):
         return []
 
+    def _dns_servers(self):
+        """
+        The name servers for the domains as [(address, port), ...]: the split-DNS forwarder when
+        it is enabled, else the containers
+        """
+        dns = self._settings.dns_forwarder()
+        if dns:
+            return [(dns['listen'], dns['port'])]
+        return [(ip, 53) for ip in self._ips]
+
+    def _tagged_files(self, pattern):
+        """
+        The names of the files matching pattern that mention the tag, read directly rather than
+        with grep as the split-DNS forwarder polls this
+        """
+        names = []
+        for path in glob.glob(pattern):
+            try:
+                with open(path, 'rt') as fh:
+                    if self._tag in fh.read():
+                        names.append(os.path.basename(path))
+            except (IOError, UnicodeDecodeError):
+                pass
+        return names
+
+    @locked
     def del_all_domains(self):
         domains = self.list_domains()
         for domain in domains:
@@ -67,15 +202,74 @@ class SystemCallsBase(object):
         p = self._popen(args, env=self.get_docker_env())
         p.wait()
 
-    def docker_run_expect(self, image, args):
+    def docker_run_expect(self, image, args, options=()):
 
         all_args = [self.docker_bin, 'run', '-it', '--rm', '--privileged']
+        all_args.extend(options)
+        all_args.extend(self.__tuning_options(options))
         all_args.extend([os.path.expanduser(os.path.expandvars(o)) for o in self._settings.run_options()])
         all_args.extend([image])
         all_args.extend(args)
 
         self.__print_cmd(all_args)
-        return Pexpect(self.__args_to_string(all_args), env=self.get_docker_env())
+        return Pexpect(self.__args_to_string(all_args), env=self.get_docker_env(),
+                       max_lines=self._settings.capture_lines(), sink=self.stdout)
+
+    def docker_exec_expect(self, container_id, args, env=None):
+        all_args = [self.docker_bin, 'exec', '-it']
+        for name, value in sorted((env or {}).items()):
+            all_args.extend(['-e', '%s=%s' % (name, value)])
+        all_args.append(container_id)
+        all_args.extend(args)
+
+        self.__print_cmd(all_args)
+        return Pexpect(self.__args_to_string(all_args), env=self.get_docker_env(),
+                       max_lines=self._settings.capture_lines(), sink=self.stdout)
+
+    def docker_run_detached(self, image, args, options=()):
+        all_args = [self.docker_bin, 'run', '-d', '--rm', '--privileged']
+        all_args.extend(options)
+        all_args.extend(self.__tuning_options(options))
+        all_args.extend([os.path.expanduser(os.path.expandvars(o)) for o in self._settings.run_options()])
+        all_args.extend([image])
+        all_args.extend(args)
+
+        p = self._popen(all_args, env=self.get_docker_env(), stdout=subprocess.PIPE)
+        out, _ = p.communicate()
+        if p.returncode != 0:
+            return None
+        return out.decode('utf-8').strip()
+
+    def __tuning_options(self, options):
+        """
+        The [run][[tuning]] options of the profile, but for those that are in options
+        """
+        tuning = self._settings.tuning_options()
+        return [arg for flag, value in zip(tuning[::2], tuning[1::2]) if flag not in options for arg in (flag, value)]
+
+    def docker_exec_input(self, container_id, args, data):
+        all_args = [self.docker_bin, 'exec', '-i', container_id]
+        all_args.extend(args)
+        p = self._popen(all_args, env=self.get_docker_env(), stdin=subprocess.PIPE)
+        p.communicate(data.encode('utf-8'))
+        return p.returncode
+
+    def docker_exec_lines(self, docker_client, container_id, args, user=''):
+        """
+        Run a command in the container, as user (default: the image's USER), returning an
+        ExecResult of its exitcode and lines of output
+        """
+        self.__print_cmd(args, 'exec')
+        exe = docker_client.exec_create(container_id, args, stderr=False, user=user)
+        output = docker_client.exec_start(exe['Id'])
+        exitcode = docker_client.exec_inspect(exe['Id'])['ExitCode']
+        return ExecResult(exitcode, output.decode('utf-8', 'replace').splitlines())
+
+    def docker_exec_detached(self, docker_client, container_id, args):
+        self.__print_cmd(args, 'exec -d')
+        exe = docker_client.exec_create(container_id, args)
+        docker_client.exec_start(exe['Id'], detach=True)
+        return exe['Id']
 
     def __sudo(self):
         if self.__sudo_cache is None:
@@ -84,12 +278,19 @@ class SystemCallsBase(object):
             self.__sudo_cache = [exe, '-S', '-p', self.__sudo_prompt]
         return self.__sudo_cache
 
-    def _shell(self, args):
+    def _shell(self, args, max_lines=None):
+        """
+        Run a command, returning (exitstatus, lines), where at most max_lines of output are kept
+        (defaults to the capture_lines setting, 0 for all lines when parsing the output)
+        """
         self.__print_cmd(args)
         if args[0] == 'sudo':
             args = self.__sudo() + args[1:]
 
-        pe = Pexpect(self.__args_to_string(args), ignores=(self.__sudo_prompt,), stdout=False)
+        if max_lines is None:
+            max_lines = self._settings.capture_lines()
+        pe = Pexpect(self.__args_to_string(args), ignores=(self.__sudo_prompt,), stdout=False,
+                     max_lines=max_lines)
 
         pe.timeout = 10
 
@@ -100,23 +301,24 @@ class SystemCallsBase(object):
                 if asked_sudo:
                     pe.send(chr(3))
                     pe.wait()
-                    sys.stderr.write('Sudo password was wrong\n')
-                    exit(3)
+                    raise SudoError('Sudo password was wrong')
                 asked_sudo = True
                 pe.sendline(self.__cb_sudo())
                 continue
             break
-        while len(pe.logfile.lines) and not pe.logfile.lines[0].strip():
-            pe.logfile.lines = pe.logfile.lines[1:]
+        pe.logfile.finish()
+        lines = pe.logfile.lines
+        while lines and not lines[0].strip():
+            lines.popleft()
         pe.close()
-        return pe.exitstatus, pe.logfile.lines
+        return pe.exitstatus, list(lines)
 
     def _shell_check(self, args):
         exitstatus, lines = self._shell(args)
         if exitstatus != 0:
-            sys.stderr.write("Error running: %s\n" % ' '.join(args))
+            self.stderr.write("Error running: %s\n" % ' '.join(args))
             for line in lines:
-                sys.stderr.write("%s\n" % line)
+                self.stderr.write("%s\n" % line)
         return exitstatus, lines
 
     def _popen(self, args, *vargs, **kwargs):
@@ -124,7 +326,7 @@ class SystemCallsBase(object):
         try:
             return subprocess.Popen(args, *vargs, **kwargs)
         except IOError as e:
-            sys.stderr.write('Error running: %s\n%s\n' % (' '.join(args), e))
+            self.stderr.write('Error running: %s\n%s\n' % (' '.join(args), e))
             raise
 
     def docker_exec(self, docker_client, container_id, args):
@@ -141,16 +343,16 @@ class SystemCallsBase(object):
             line = errcode.sub(lambda a: '', line)
             if m:
                 return int(m.group('code'))
-            sys.stdout.write(line)
+            self.stdout.write(line)
         return None
 
     @property
     def stdout(self):
-        return sys.stdout
+        return self.__stdout or sys.stdout
 
     @property
     def stderr(self):
-        return sys.stderr
+        return self.__stderr or sys.stderr
 
     def __print_cmd(self, args, scope=None):
         if scope:
@@ -158,7 +360,7 @@ class SystemCallsBase(object):
         else:
             line = ' >$ '
         line += self.__args_to_string(args)
-        sys.stdout.write(line + '\n')
+        self.stdout.write(line + '\n')
 
     def __args_to_string(self, args):
         def q(s):
@@ -179,21 +381,28 @@ class SystemCallsBase(object):
 
 class Pexpect(pe_spawn):
     class Out(object):
+        """
+        Streams output to the sink, and captures complete lines into a ring buffer of at
+        most max_lines (unbounded if 0 or None)
+        """
         lines = None
         ignore = 0
         _stdout = True
+        max_partial = 64 * 1024
 
-        def __init__(self, ignores, stdout):
+        def __init__(self, ignores, stdout, max_lines=None, sink=None):
             self.__ignores = ignores
-            self.lines = []
+            self.lines = deque(maxlen=max_lines or None)
             self._stdout = stdout
+            self.__sink = sink
+            self.__partial = ''
+
+        @property
+        def sink(self):
+            return self.__sink or sys.stdout
 
         def write(self, b):
-            try:
-                st = b.decode("utf-8", "replace")
-            except UnicodeDecodeError as e:
-                print("! except: UnicodeDecodeError: %s" % e)
-                st = '\r\n'
+            st = b.decode("utf-8", "replace")
 
             for line in st.splitlines(True):
                 ignore = line.startswith(self.__ignores)
@@ -203,16 +412,29 @@ class Pexpect(pe_spawn):
                     self.ignore -= 1
                     return
                 if not ignore:
-                    self.lines.append(line)
+                    self.__capture(line)
                 if self._stdout:
-                    sys.stdout.write('%s' % line)
+                    self.sink.write('%s' % line)
+
+        def __capture(self, piece):
+            # Output arrives in arbitrary chunks, so only capture whole lines
+            self.__partial += piece
+            if piece.endswith('\n') or len(self.__partial) > self.max_partial:
+                self.lines.append(self.__partial)
+                self.__partial = ''
+
+        def finish(self):
+            if self.__partial:
+                self.lines.append(self.__partial)
+                self.__partial = ''
 
         def flush(self):
-            sys.stdout.flush()
+            self.sink.flush()
 
-    def __init__(self, cmd, ignores=('Password', 'Username'), stdout=True, env=None):
+    def __init__(self, cmd, ignores=('Password', 'Username'), stdout=True, env=None,
+                 max_lines=None, sink=None):
         super(Pexpect, self).__init__(cmd, env=env)
-        self.logfile = self.Out(ignores, stdout)
+        self.logfile = self.Out(ignores, stdout, max_lines, sink)
 
     def expect(self, pattern, **kwargs):
         pattern.insert(0, EOF)
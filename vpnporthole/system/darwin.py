@@ -1,11 +1,11 @@
 import os
-import sys
 import subprocess
 import tempfile
-import glob
 import re
 
 from vpnporthole.ip import IPv4Subnet
+from vpnporthole.lock import locked
+from vpnporthole.exceptions import DockerEnvError
 from vpnporthole.system.base import SystemCallsBase
 
 
@@ -16,11 +16,12 @@ class SystemCalls(SystemCallsBase):
         super(SystemCalls, self).__init__(*args, **kwargs)
         self.__docker_env = self.__get_docker_env()
 
+    @locked
     def on_connect(self):
         self.__host_ssh_check(['sudo', '/usr/local/sbin/iptables',
                                '-t', 'nat',
                                '-A', 'POSTROUTING',
-                               '-o', 'docker0',
+                               '-o', self._settings.network_bridge(),
                                '-j', 'MASQUERADE'])
 
         self.__host_ssh_check(['sudo', '/usr/local/sbin/iptables',
@@ -28,58 +29,80 @@ class SystemCalls(SystemCallsBase):
                                '-i', 'eth1',
                                '-j', 'ACCEPT'])
 
-        if self._ip:
-            self._shell(['sudo', 'route', '-n', 'add', '%s/32' % self._ip, self.__host_ip()])
+        for ip in self._ips:
+            self._shell(['sudo', 'route', '-n', 'add', '%s/32' % ip, self.__host_ip()])
 
+    @locked
     def on_disconnect(self):
-        if self._ip:
-            self._shell(['sudo', 'route', '-n', 'delete', '%s/32' % self._ip, self.__host_ip()])
+        for ip in self._ips:
+            self._shell(['sudo', 'route', '-n', 'delete', '%s/32' % ip, self.__host_ip()])
 
+    @locked
     def add_route(self, subnet):
         if self._ip:
-            self.__host_ssh_check(['sudo', 'ip', 'route', 'add', str(subnet), 'via', self._ip])
+            self.__host_ssh_check(['sudo', 'ip', 'route', 'add', str(subnet)] + self._route_args())
 
         self._shell_check(['sudo', 'route', '-n', 'add', str(subnet), self.__host_ip()])
 
+    @locked
+    def replace_routes(self, subnets):
+        if not self._ip or not subnets:
+            return
+        # The local routes point at the docker-machine VM, only the VM routes need repointing
+        route = ' '.join(self._route_args())
+        self.__host_ssh_check(['sudo', 'sh', '-c', '; '.join(
+            'ip route replace %s %s' % (subnet, route) for subnet in subnets)])
+
+    @locked
     def del_route(self, subnet):
         self._shell(['sudo', 'route', '-n', 'delete', str(subnet)])
 
         self.__host_ssh(['sudo', 'ip', 'route', 'del', str(subnet)])
 
     def list_routes(self):
+        if len(self._ips) > 1:
+            return super(SystemCalls, self).list_routes()
         subnets = []
         if not self._ip:
             return []
-        _, lines = self.__host_ssh(['ip', 'route', 'show', 'via', self._ip])
+        _, lines = self.__host_ssh(['ip', 'route', 'show', 'via', self._ip], max_lines=0)
         for line in lines:
             subnets.append(IPv4Subnet(line.split()[0]))
         return subnets
 
+    def list_nexthops(self):
+        if len(self._ips) <= 1:
+            return [(subnet, [self._ip]) for subnet in self.list_routes()]
+        # Filtering on "via" does not match multipath routes
+        return self._parse_nexthops(self.__host_ssh(['ip', 'route', 'show'], max_lines=0)[1])
+
+    @locked
     def add_domain(self, domain):
         if not self._ip:
             return
         with tempfile.NamedTemporaryFile() as temp:
-            temp.file.write(bytes('nameserver %s  # %s\n' % (self._ip, self._tag), 'utf-8'))
+            servers = self._dns_servers()
+            lines = ['nameserver %s  # %s\n' % (ip, self._tag) for ip, _ in servers]
+            if servers[0][1] != 53:
+                # A resolver file has one port for all of its name servers
+                lines.append('port %d\n' % servers[0][1])
+            temp.file.write(bytes(''.join(lines), 'utf-8'))
             os.chmod(temp.name, 0o644)
             temp.file.flush()
             self._shell_check(['sudo', 'cp', temp.name, '/etc/resolver/%s' % domain])
             temp.close()
 
+    @locked
     def del_domain(self, domain):
         self._shell(['sudo', 'rm', '/etc/resolver/%s' % domain])
 
     def list_domains(self):
-        domains = []
-        all_files = glob.glob('/etc/resolver/*')
-        if all_files:
-            for line in self._shell(['grep', '-l', self._tag] + all_files)[1]:
-                domains.append(os.path.basename(line.strip()))
-        return domains
-
-    def __host_ssh(self, args):
+        return self._tagged_files('/etc/resolver/*')
+
+    def __host_ssh(self, args, max_lines=None):
         base = ['docker-machine', 'ssh', self.__docker_env['DOCKER_MACHINE_NAME']]
         base.extend(args)
-        return self._shell(base)
+        return self._shell(base, max_lines)
 
     def __host_ssh_check(self, args):
         base = ['docker-machine', 'ssh', self.__docker_env['DOCKER_MACHINE_NAME']]
@@ -114,25 +137,20 @@ class SystemCalls(SystemCallsBase):
                 try:
                     environ[var] = os.environ[var]
                 except KeyError as e:
-                    sys.stderr.write('! %s not found in environment\n' % e)
-                    exit(3)
+                    raise DockerEnvError('%s not found in environment' % e)
         else:
             env_patten = re.compile('export (?P<name>.*)="(?P<value>.*)"')
             try:
                 stdout = subprocess.check_output(['docker-machine', 'env', machine])
             except subprocess.CalledProcessError:
-                sys.stderr.write('! Failed to get env for docker-machine "%s"\n' % (machine,))
                 stdout = subprocess.check_output(['docker-machine', 'ls'])
-                sys.stderr.write(stdout.decode())
-                exit(3)
+                raise DockerEnvError('Failed to get env for docker-machine "%s"\n%s' % (machine, stdout.decode()))
             for line in stdout.decode().split('\n'):
                 m = env_patten.match(line)
                 if m:
                     environ[m.group('name')] = m.group('value')
             for var in vars:
                 if var not in environ:
-                    sys.stderr.write(
-                        '! Expected "%s" in env for docker-machine "%s"\n' % (var, machine))
-                    exit(3)
+                    raise DockerEnvError('Expected "%s" in env for docker-machine "%s"' % (var, machine))
 
         return environ
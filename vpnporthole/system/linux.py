@@ -1,45 +1,266 @@
-import glob
 import os
 import tempfile
 
 from vpnporthole.ip import IPv4Subnet
+from vpnporthole.lock import locked
 from vpnporthole.system.base import SystemCallsBase
 
 
 class SystemCalls(SystemCallsBase):
 
+    @locked
     def add_route(self, subnet):
-        if self._ip:
-            self._shell_check(['sudo', 'ip', 'route', 'add', str(subnet), 'via', self._ip])
+        if self._settings.route_tables():
+            self.add_routes([subnet])
+        elif self._ip:
+            self._shell_check(['sudo', 'ip', 'route', 'add', str(subnet)] + self._route_args())
 
+    @locked
     def del_route(self, subnet):
-        self._shell(['sudo', 'ip', 'route', 'del', str(subnet)])
+        if self._settings.route_tables():
+            self.del_routes([subnet])
+        else:
+            self._shell(['sudo', 'ip', 'route', 'del', str(subnet)])
+
+    @locked
+    def add_routes(self, subnets):
+        if self._ip:
+            route = ' '.join(self._route_args())
+            rules = self.__rules() if self._settings.route_tables() else None
+            tables = self.__route_tables(rules)
+            if tables:
+                commands = ['route add %s %s table %d' % (subnet, route, tables[0]) for subnet in subnets]
+                if commands:
+                    commands.extend(self.__rule_commands(tables[0], rules))
+                self.__ip_batch(commands)
+            else:
+                self.__ip_batch(['route add %s %s' % (subnet, route) for subnet in subnets])
+
+    @locked
+    def replace_routes(self, subnets):
+        if self._ip:
+            rules = self.__rules() if self._settings.route_tables() else None
+            tables = self.__route_tables(rules)
+            if tables:
+                self.__swap_routes(tables, subnets, rules)
+            else:
+                route = ' '.join(self._route_args())
+                commands = ['route replace %s %s' % (subnet, route) for subnet in subnets]
+                self.__ip_batch(commands + self.__mark_route_commands())
+
+    @locked
+    def del_routes(self, subnets):
+        tables = self.__route_tables()
+        table = ' table %d' % tables[0] if tables else ''
+        self.__ip_batch(['route del %s%s' % (subnet, table) for subnet in subnets], check=False)
+
+    @locked
+    def del_all_routes(self, other_subnets):
+        tables = self._settings.route_tables()
+        route_set = self.route_set()
+        if not tables and not route_set:
+            return super(SystemCalls, self).del_all_routes(other_subnets)
+        priority = self._settings.rule_priority()
+        rules = self.__rules()
+        ours = []
+        commands = []
+        if tables:
+            commands.extend('rule del pref %d lookup %d' % (priority, table)
+                            for table in tables if (priority, str(table)) in rules)
+            commands.extend('route flush table %d' % table for table in tables)
+            ours.extend(str(table) for table in tables)
+        if route_set:
+            mark = self._settings.route_mark()
+            if (priority + 1, str(mark)) in rules:
+                commands.append('rule del pref %d fwmark %d lookup %d' % (priority + 1, mark, mark))
+            commands.append('route flush table %d' % mark)
+            ours.append(str(mark))
+        others = [table for p, table in rules if p in (priority, priority + 1) and table not in ours]
+        if not others and (priority - 1, 'main') in rules:
+            commands.append('rule del pref %d lookup main suppress_prefixlength 0' % (priority - 1))
+        self.__ip_batch(commands, check=False)
+        if not tables:
+            super(SystemCalls, self).del_all_routes(other_subnets)
+        if route_set:
+            self._shell(['sudo', 'iptables', '-t', 'mangle', '-D'] + self.__mark_rule())
+            self._shell(['sudo', 'ipset', 'destroy', route_set])
+
+    def route_set(self):
+        """
+        The ipset of the addresses that the routed domains of the profile resolve to, or None
+        """
+        if not self._settings.routed_domains():
+            return None
+        return 'vpnp-%d' % self._settings.route_mark()
+
+    @locked
+    def on_connect(self):
+        """
+        With routed domains, create their set, mark the traffic to the addresses in it, and route
+        the marked traffic via the containers, from a table of its own
+        """
+        route_set = self.route_set()
+        if not route_set or not self._ip:
+            return
+        mark = self._settings.route_mark()
+        self._shell_check(['sudo', 'ipset', 'create', route_set, 'hash:ip', 'timeout', '0', '-exist'])
+        if self._shell(['sudo', 'iptables', '-t', 'mangle', '-C'] + self.__mark_rule())[0] != 0:
+            self._shell_check(['sudo', 'iptables', '-t', 'mangle', '-A'] + self.__mark_rule())
+        commands = self.__mark_route_commands()
+        commands.extend(self.__rule_commands(mark, self.__rules(), 1, 'fwmark %d ' % mark))
+        self.__ip_batch(commands)
+
+    def add_to_set(self, entries):
+        """
+        Add addresses to the set of the routed domains, as [(ip, timeout), ...], in one batch.
+        Those already in it get the new timeout
+        """
+        route_set = self.route_set()
+        if not route_set or not entries:
+            return
+        with tempfile.NamedTemporaryFile() as temp:
+            temp.file.write(bytes(''.join('add %s %s timeout %d\n' % (route_set, ip, timeout)
+                                          for ip, timeout in entries), 'utf-8'))
+            os.chmod(temp.name, 0o644)
+            temp.file.flush()
+            self._shell_check(['sudo', 'ipset', '-exist', '-file', temp.name, 'restore'])
+
+    def __mark_route_commands(self):
+        """
+        The command to point the route of the marked traffic at the current container IPs
+        """
+        if not self.route_set():
+            return []
+        return ['route replace default %s table %d' % (' '.join(self._route_args()), self._settings.route_mark())]
+
+    def __mark_rule(self):
+        return ['OUTPUT', '-m', 'set', '--match-set', self.route_set(), 'dst',
+                '-j', 'MARK', '--set-mark', str(self._settings.route_mark())]
+
+    def route_table(self):
+        tables = self.__route_tables()
+        return tables[0] if tables else None
+
+    def tables_in_use(self):
+        return set(int(table) for _, table in self.__rules() if table.isdigit())
+
+    def __rules(self):
+        """
+        The ip rules as [(priority, table looked up), ...]
+        """
+        rules = []
+        for line in self._shell(['ip', 'rule', 'show'], max_lines=0)[1]:
+            words = line.split()
+            if words and words[0].endswith(':') and words[0][:-1].isdigit() and 'lookup' in words[:-1]:
+                rules.append((int(words[0][:-1]), words[words.index('lookup') + 1]))
+        return rules
+
+    def __route_tables(self, rules=None):
+        """
+        With [routing] tables, the (active, spare) routing tables of the profile, the active one
+        being the one that the ip rule looks up, else None
+        """
+        tables = self._settings.route_tables()
+        if not tables:
+            return None
+        rules = self.__rules() if rules is None else rules
+        looked_up = [table for priority, table in rules if priority == self._settings.rule_priority()]
+        if str(tables[1]) in looked_up and str(tables[0]) not in looked_up:
+            return tables[1], tables[0]
+        return tables
+
+    def __rule_commands(self, table, rules, offset=0, selector=''):
+        """
+        The commands to add the rule that looks up the table, if missing, and the rule ahead of it
+        that looks up the main table first for any but its default route, so that the routes to
+        the LAN and the containers are not taken over by the subnets of a profile
+        """
+        priority = self._settings.rule_priority()
+        commands = []
+        if (priority - 1, 'main') not in rules:
+            commands.append('rule add pref %d lookup main suppress_prefixlength 0' % (priority - 1))
+        if (priority + offset, str(table)) not in rules:
+            commands.append('rule add pref %d %slookup %d' % (priority + offset, selector, table))
+        return commands
+
+    def __table_routes(self, table):
+        subnets = []
+        for line in self._shell(['ip', 'route', 'show', 'table', str(table)], max_lines=0)[1]:
+            try:
+                subnets.append(IPv4Subnet(line.split()[0]))
+            except (ValueError, IndexError):
+                pass  # e.g. nexthop lines, or the table does not exist yet
+        return subnets
+
+    def __swap_routes(self, tables, subnets, rules):
+        """
+        Build all the routes of the profile, via the current container IPs, in the spare table and
+        switch the rule over to it, so that they all change at once. The old table is then flushed
+        """
+        active, spare = tables
+        installed = self.__table_routes(active)
+        subnets = sorted(set(subnets).union(installed), key=str)
+        route = ' '.join(self._route_args())
+        priority = self._settings.rule_priority()
+
+        commands = ['route flush table %d' % spare] if self.__table_routes(spare) else []
+        commands.extend('route add %s %s table %d' % (subnet, route, spare) for subnet in subnets)
+        commands.extend(self.__rule_commands(spare, rules))
+        if (priority, str(active)) in rules:
+            commands.append('rule del pref %d lookup %d' % (priority, active))
+        if installed:
+            commands.append('route flush table %d' % active)
+        self.__ip_batch(commands + self.__mark_route_commands())
+
+    def __ip_batch(self, commands, check=True):
+        if not commands:
+            return
+        with tempfile.NamedTemporaryFile() as temp:
+            temp.file.write(bytes(''.join('%s\n' % c for c in commands), 'utf-8'))
+            os.chmod(temp.name, 0o644)
+            temp.file.flush()
+            args = ['sudo', 'ip', '-force', '-batch', temp.name]
+            if check:
+                self._shell_check(args)
+            else:
+                self._shell(args)
 
     def list_routes(self):
+        if len(self._ips) > 1 or self._settings.route_tables():
+            return super(SystemCalls, self).list_routes()
         subnets = []
         if self._ip:
-            lines = self._shell(['ip', 'route', 'show', 'via', self._ip])[1]
+            lines = self._shell(['ip', 'route', 'show', 'via', self._ip], max_lines=0)[1]
             for line in lines:
                 subnets.append(IPv4Subnet(line.split()[0]))
         return subnets
 
+    def list_nexthops(self):
+        tables = self.__route_tables()
+        if tables:
+            return self._parse_nexthops(self._shell(['ip', 'route', 'show', 'table', str(tables[0])],
+                                                    max_lines=0)[1])
+        if len(self._ips) <= 1:
+            return [(subnet, [self._ip]) for subnet in self.list_routes()]
+        # Filtering on "via" does not match multipath routes
+        return self._parse_nexthops(self._shell(['ip', 'route', 'show'], max_lines=0)[1])
+
+    @locked
     def add_domain(self, domain):
-        if self._ip:
+        if not self._ip:
             return
         with tempfile.NamedTemporaryFile() as temp:
-            temp.file.write(bytes('server=/%s/%s  # %s\n' % (domain, self._ip, self._tag), 'utf-8'))
+            servers = [ip if port == 53 else '%s#%d' % (ip, port) for ip, port in self._dns_servers()]
+            temp.file.write(bytes(''.join('server=/%s/%s  # %s\n' % (domain, server, self._tag)
+                                          for server in servers), 'utf-8'))
             os.chmod(temp.name, 0o644)
             temp.file.flush()
             self._shell_check(['sudo', 'cp', temp.name, '/etc/NetworkManager/dnsmasq.d/%s' % domain])
             temp.close()
 
+    @locked
     def del_domain(self, domain):
         self._shell(['sudo', 'rm', '/etc/NetworkManager/dnsmasq.d/%s' % domain])
 
     def list_domains(self):
-        domains = []
-        all_files = glob.glob('/etc/NetworkManager/dnsmasq.d/*')
-        if all_files:
-            for line in self._shell(['grep', '-l', self._tag] + all_files)[1]:
-                domains.append(os.path.basename(line.strip()))
-        return domains
+        return self._tagged_files('/etc/NetworkManager/dnsmasq.d/*')